@@ -0,0 +1,78 @@
+"""Attendance storage: one subdocument per lesson vs. bitsets per subject and term.
+
+    python -m benchmarks.bench_attendance [--students 1000] [--subjects 8] [--days 180]
+
+Builds the same attendance history in both layouts and reports the BSON size
+of a student document (what MongoDB stores, keeps in cache and sends over the
+wire), the time to decode the documents from BSON, and the time to expand them
+into the record list the API returns.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import bson
+from bson import ObjectId
+
+from utils.attendance_bits import compact_attendance, expand_attendance
+
+
+def build_students(students, subjects, days):
+    subject_ids = [ObjectId() for _ in range(subjects)]
+    start = datetime(2024, 9, 2)
+    school_days = [start + timedelta(days=offset) for offset in range(days * 7 // 5)
+                   if (start + timedelta(days=offset)).weekday() < 5][:days]
+    documents = []
+    for _ in range(students):
+        attendance = [{
+            "_id": ObjectId(),
+            "date": day,
+            "status": "Present" if random.random() < 0.93 else "Absent",
+            "subName": subject_id,
+        } for subject_id in subject_ids for day in school_days]
+        documents.append({"_id": ObjectId(), "name": "Student", "rollNum": 1, "attendance": attendance})
+    return documents
+
+
+def to_bitmap(document):
+    compacted = dict(document)
+    compacted["attendance"], compacted["attendanceBits"] = compact_attendance(document)
+    return compacted
+
+
+def measure(documents):
+    encoded = [bson.encode(document) for document in documents]
+    size = sum(len(data) for data in encoded) / len(encoded)
+    start = time.perf_counter()
+    decoded = [bson.decode(data) for data in encoded]
+    decode_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    records = sum(len(expand_attendance(document)) for document in decoded)
+    expand_ms = (time.perf_counter() - start) * 1000
+    return size, decode_ms, expand_ms, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attendance layout size and speed")
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--subjects", type=int, default=8)
+    parser.add_argument("--days", type=int, default=180)
+    args = parser.parse_args()
+
+    random.seed(1)
+    records = build_students(args.students, args.subjects, args.days)
+    start = time.perf_counter()
+    bitmaps = [to_bitmap(document) for document in records]
+    convert_ms = (time.perf_counter() - start) * 1000
+
+    print(f"{args.students} students x {args.subjects} subjects x {args.days} school days")
+    print(f"{'layout':8} {'bytes/student':>14} {'bson decode ms':>15} {'expand ms':>10} {'records':>9}")
+    for name, documents in (("records", records), ("bitmap", bitmaps)):
+        size, decode_ms, expand_ms, count = measure(documents)
+        print(f"{name:8} {size:14.0f} {decode_ms:15.1f} {expand_ms:10.1f} {count:9}")
+    print(f"conversion records -> bitmap: {convert_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Per-request overhead of the old and the lean request pipeline.
+
+    python -m benchmarks.bench_pipeline [--requests 5000]
+
+Both apps serve the same trivial endpoint with no database traffic, so the
+difference is the cost of the wiring itself:
+
+  before: @app.middleware("http") (BaseHTTPMiddleware), Depends(get_database)
+          on the router and three Depends(lambda: get_collection(...)) per handler
+  after:  no BaseHTTPMiddleware, collection handles looked up in a cache
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi import APIRouter, Depends, FastAPI, Request
+
+COLLECTIONS = {name: object() for name in ("students", "sclasses", "subjects")}
+_handles = dict(COLLECTIONS)
+
+
+def get_database():
+    return COLLECTIONS
+
+
+def get_collection(name):
+    return COLLECTIONS[name]
+
+
+def build_before():
+    app = FastAPI()
+    router = APIRouter()
+
+    @app.middleware("http")
+    async def db_middleware(request: Request, call_next):
+        request.state.db = COLLECTIONS
+        return await call_next(request)
+
+    @router.get("/Students/{school_id}")
+    async def students(school_id: str,
+                       students=Depends(lambda: get_collection("students")),
+                       sclasses=Depends(lambda: get_collection("sclasses")),
+                       subjects=Depends(lambda: get_collection("subjects"))):
+        return []
+
+    app.include_router(router, dependencies=[Depends(get_database)])
+    return app
+
+
+def build_after():
+    app = FastAPI()
+    router = APIRouter()
+
+    @router.get("/Students/{school_id}")
+    async def students(school_id: str):
+        students, sclasses, subjects = _handles["students"], _handles["sclasses"], _handles["subjects"]
+        return []
+
+    app.include_router(router)
+    return app
+
+
+async def drive(app, requests):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/Students/65a000000000000000000000", "raw_path": b"/Students/65a000000000000000000000",
+        "root_path": "", "query_string": b"", "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+    async def send(message):
+        pass
+
+    async def run_once():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                await asyncio.sleep(3600)
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        await app(dict(scope), receive, send)
+
+    for _ in range(200):  # warm-up
+        await run_once()
+    start = time.perf_counter()
+    for _ in range(requests):
+        await run_once()
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+    before = asyncio.run(drive(build_before(), args.requests))
+    after = asyncio.run(drive(build_after(), args.requests))
+    print(f"before: {before:8.1f} us/request")
+    print(f"after:  {after:8.1f} us/request")
+    print(f"saved:  {before - after:8.1f} us/request ({(before - after) / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
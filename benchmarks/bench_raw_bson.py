@@ -0,0 +1,134 @@
+"""Class student list: old handler vs. the lean read path, with dicts and RawBSONDocument.
+
+    python -m benchmarks.bench_raw_bson [--students 500] [--subjects 8] [--days 180] [--rounds 20]
+
+Encodes a class of students the way the server sends them and compares, per
+request of GET /Sclass/Students/{id}:
+
+  old:   full documents decoded into dicts, ObjectIds converted by hand,
+         then validated and serialized through the response model
+  dict:  only the response fields fetched, JSON built by utils.raw_bson
+         (the current handler, default)
+  raw:   the same with RawBSONDocument (RAW_BSON_READS=1)
+
+A last line compares decoding whole documents, the case RawBSONDocument is
+made for.
+
+It reports CPU time per request and the reply size, uncompressed and with each
+wire compressor the driver supports (zstd and snappy only when installed).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from bson import ObjectId
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from controllers.sclass import CLASS_STUDENT_FIELDS, CLASS_STUDENT_PROJECTION, Student
+from utils.db import raw_codec_options
+from utils.raw_bson import json_list_response
+
+
+def build_students(students, subjects, days):
+    school, sclass = ObjectId(), ObjectId()
+    subject_ids = [ObjectId() for _ in range(subjects)]
+    start = datetime(2024, 9, 2)
+    documents = []
+    for roll in range(students):
+        documents.append({
+            "_id": ObjectId(), "name": f"Student {roll}", "rollNum": roll, "password": "$2b$12$" + "x" * 53,
+            "sclassName": sclass, "school": school, "role": "Student",
+            "examResult": [{"_id": ObjectId(), "subName": subject, "marksObtained": random.randint(1, 100)}
+                           for subject in subject_ids],
+            "attendance": [{"_id": ObjectId(), "date": start + timedelta(days=day), "subName": subject,
+                            "status": "Present" if random.random() < 0.93 else "Absent"}
+                           for subject in subject_ids for day in range(days)],
+        })
+    return documents
+
+
+def project(document):
+    return {field: document[field] for field in ("_id", *CLASS_STUDENT_PROJECTION)}
+
+
+def old_path(reply, field):
+    students = bson.decode_all(reply)
+    for student in students:
+        student['_id'] = str(student['_id'])
+        student['sclassName'] = str(student['sclassName'])
+        student['school'] = str(student['school'])
+        student.pop('password', None)
+    content = asyncio.run(serialize_response(field=field, response_content=[Student(**s) for s in students]))
+    return JSONResponse(content).body
+
+
+def lean_path(reply, codec_options):
+    return json_list_response(bson.decode_all(reply, codec_options), CLASS_STUDENT_FIELDS,
+                              id_fields=("_id", "sclassName", "school")).body
+
+
+def compressors():
+    available = [("zlib", lambda data: zlib.compress(data, 6))]
+    try:
+        import zstandard
+        available.append(("zstd", zstandard.ZstdCompressor().compress))
+    except ImportError:
+        print("zstd: pip install zstandard to measure")
+    try:
+        import snappy
+        available.append(("snappy", snappy.compress))
+    except ImportError:
+        print("snappy: pip install python-snappy to measure")
+    return available
+
+
+def timed(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        body = function()
+    return (time.perf_counter() - start) * 1000 / rounds, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lean read path with dicts and RawBSONDocument")
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--subjects", type=int, default=8)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    documents = build_students(args.students, args.subjects, args.days)
+    full_reply = b"".join(bson.encode(document) for document in documents)
+    projected_reply = b"".join(bson.encode(project(document)) for document in documents)
+    field = create_response_field("response", list[Student])
+
+    old_ms, old_body = timed(lambda: old_path(full_reply, field), args.rounds)
+    dict_ms, dict_body = timed(lambda: lean_path(projected_reply, DEFAULT_CODEC_OPTIONS), args.rounds)
+    raw_ms, raw_body = timed(lambda: lean_path(projected_reply, raw_codec_options), args.rounds)
+    assert json.loads(old_body) == json.loads(dict_body) == json.loads(raw_body), "responses differ"
+    whole_dict_ms, _ = timed(lambda: bson.decode_all(full_reply), args.rounds)
+    # Reading every top-level field, as a handler forwarding whole documents would
+    whole_raw_ms, _ = timed(lambda: [dict(d) for d in bson.decode_all(full_reply, raw_codec_options)], args.rounds)
+    wire = compressors()
+
+    print(f"{args.students} students, {args.subjects} subjects x {args.days} days of attendance each")
+    print(f"{'path':6} {'cpu ms/request':>15} {'reply bytes':>12}" + "".join(f" {name:>12}" for name, _ in wire))
+    for name, ms, reply in (("old", old_ms, full_reply), ("dict", dict_ms, projected_reply),
+                            ("raw", raw_ms, projected_reply)):
+        sizes = "".join(f" {len(compress(reply)):12}" for _, compress in wire)
+        print(f"{name:6} {ms:15.1f} {len(reply):12}{sizes}")
+    print(f"response body: {len(dict_body)} bytes, identical in all paths")
+    print(f"decoding whole documents: dict {whole_dict_ms:.1f} ms, RawBSONDocument {whole_raw_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Cold-start budget: import time, app build time and time to first request.
+
+    python -m benchmarks.bench_startup [--runs 5] [--path /docs] [--with-db]
+    python -m benchmarks.bench_startup --write-budget
+
+Every run is a fresh interpreter. The medians are compared with
+benchmarks/startup_budget.json and the script exits with status 1 when a
+phase is over budget or when a module that should load lazily (google-auth,
+passlib, werkzeug, uvicorn, numpy) is imported during startup. Without --with-db the
+Mongo warm-up ping and index check are skipped, so the numbers measure the
+Python side only.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported until a request actually needs them
+LAZY_MODULES = ("google.oauth2", "google.auth", "passlib.context", "werkzeug", "uvicorn", "numpy")
+
+CHILD = r"""
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+built = time.perf_counter()
+
+async def first_request():
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        messages.append(message)
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": PATH, "raw_path": PATH.encode(), "root_path": "",
+             "query_string": b"", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1),
+             "server": ("bench", 80)}
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        await app(scope, receive, send)
+        return started, messages[0]["status"]
+
+started, status = asyncio.run(first_request())
+done = time.perf_counter()
+print(json.dumps({
+    "import_main_ms": (imported - start) * 1000,
+    "create_app_ms": (built - imported) * 1000,
+    "lifespan_ms": (started - built) * 1000,
+    "first_request_ms": (done - start) * 1000,
+    "status": status,
+    "eager_modules": [m for m in LAZY if m in sys.modules],
+}))
+"""
+
+
+def run_once(path, with_db):
+    env = dict(os.environ)
+    if not with_db:
+        env["MONGO_WARM_UP"] = "0"
+        env["MONGO_ENSURE_INDEXES"] = "0"
+    code = f"PATH = {path!r}\nLAZY = {LAZY_MODULES!r}\n" + CHILD
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time budget")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/docs", help="route used for the first request")
+    parser.add_argument("--with-db", action="store_true", help="include the Mongo warm-up in the lifespan")
+    parser.add_argument("--write-budget", action="store_true",
+                        help="store the current medians plus 50%% headroom as the new budget")
+    args = parser.parse_args()
+
+    runs = [run_once(args.path, args.with_db) for _ in range(args.runs)]
+    phases = ("import_main_ms", "create_app_ms", "lifespan_ms", "first_request_ms")
+    medians = {phase: statistics.median(run[phase] for run in runs) for phase in phases}
+    for phase in phases:
+        print(f"{phase:18} {medians[phase]:8.1f}")
+
+    if args.write_budget:
+        with open(BUDGET_FILE, "w") as f:
+            json.dump({phase: round(value * 1.5, 1) for phase, value in medians.items()}, f, indent=2)
+            f.write("\n")
+        print(f"Budget written to {BUDGET_FILE}")
+        return
+
+    failures = []
+    eager = sorted({module for run in runs for module in run["eager_modules"]})
+    if eager:
+        failures.append(f"imported eagerly: {', '.join(eager)}")
+    if os.path.exists(BUDGET_FILE):
+        with open(BUDGET_FILE) as f:
+            budget = json.load(f)
+        for phase, limit in budget.items():
+            if medians.get(phase, 0) > limit:
+                failures.append(f"{phase} {medians[phase]:.1f} ms > budget {limit} ms")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+import asyncio
+import json
+from utils.db import get_collection
+from utils.display_names import find_infos, SUBJECT_FIELDS
+from utils.attendance_bits import STATUSES
+
+ATTENDANCE_PROJECTION = {
+    "name": 1, "rollNum": 1, "sclassName": 1,
+    "attendance.subName": 1, "attendance.date": 1, "attendance.status": 1, "attendance.subjectInfo.subName": 1,
+    "attendanceBits": 1,
+}
+
+router = APIRouter()
+
+
+class AttendanceCube:
+    """ Flat (student, subject, day, present) arrays loaded from both attendance layouts """
+
+    def __init__(self, students, subjects, student_index, subject_index, day, present):
+        self.students = students
+        self.subjects = subjects
+        self.student_index = student_index
+        self.subject_index = subject_index
+        self.day = day
+        self.present = present
+
+
+def load_attendance(query: dict) -> AttendanceCube:
+    import numpy as np
+
+    students, subjects, subject_columns = [], [], {}
+    parts = []  # (student, subject, day ordinals, present) arrays per student/entry
+
+    def subject_column(subject_id, info):
+        column = subject_columns.get(subject_id)
+        if column is None:
+            column = subject_columns[subject_id] = len(subjects)
+            subjects.append({"_id": subject_id, "subName": (info or {}).get("subName")})
+        return column
+
+    for student in get_collection("students", secondary=True).find(query, ATTENDANCE_PROJECTION):
+        row = len(students)
+        students.append({"_id": str(student["_id"]), "name": student.get("name"),
+                         "rollNum": student.get("rollNum"), "sclassName": student.get("sclassName")})
+        records = [record for record in student.get("attendance") or []
+                   if record.get("subName") is not None and record.get("date") and record.get("status") in STATUSES]
+        if records:
+            parts.append((
+                np.full(len(records), row),
+                np.fromiter((subject_column(r["subName"], r.get("subjectInfo")) for r in records), np.int64, len(records)),
+                np.fromiter((r["date"].toordinal() for r in records), np.int64, len(records)),
+                np.fromiter((STATUSES[r["status"]] for r in records), bool, len(records)),
+            ))
+        # Bitmap layout (utils/attendance_bits): unpack the bitsets instead of expanding records
+        for entry in student.get("attendanceBits") or []:
+            recorded = np.unpackbits(np.frombuffer(bytes(entry["recorded"]), np.uint8), bitorder="little").astype(bool)
+            present = np.unpackbits(np.frombuffer(bytes(entry["present"]), np.uint8), bitorder="little").astype(bool)
+            days = np.flatnonzero(recorded)
+            if len(days):
+                parts.append((np.full(len(days), row), np.full(len(days), subject_column(entry["subName"], entry.get("subjectInfo"))),
+                              days + entry["term"].toordinal(), present[days]))
+
+    missing = [subject["_id"] for subject in subjects if subject["subName"] is None]
+    if missing:
+        infos = find_infos(get_collection("subjects", secondary=True), missing, SUBJECT_FIELDS)
+        for subject in subjects:
+            if subject["subName"] is None:
+                subject["subName"] = infos.get(subject["_id"], {}).get("subName", "Unknown")
+
+    if parts:
+        student_index, subject_index, day, present = (np.concatenate(column) for column in zip(*parts))
+    else:
+        student_index = subject_index = day = np.zeros(0, np.int64)
+        present = np.zeros(0, bool)
+    return AttendanceCube(students, subjects, student_index, subject_index, day, present)
+
+
+def rate(present, lessons):
+    import numpy as np
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(lessons > 0, present / np.maximum(lessons, 1), np.nan)
+
+
+def absence_report(cube: AttendanceCube, threshold: float, window: int, min_lessons: int, flagged_only: bool,
+                   date_from: Optional[date] = None, date_to: Optional[date] = None) -> List[Dict]:
+    """ Dense students x days lesson/absence counts per subject; rates and rolling windows vectorized """
+    import numpy as np
+
+    keep = np.ones(len(cube.day), bool)
+    if date_from is not None:
+        keep &= cube.day >= date_from.toordinal()
+    if date_to is not None:
+        keep &= cube.day <= date_to.toordinal()
+    student_index, subject_index, present = cube.student_index[keep], cube.subject_index[keep], cube.present[keep]
+
+    students, subjects = len(cube.students), len(cube.subjects)
+    if not keep.any():
+        return [] if flagged_only else [{**student, "lessons": 0, "absences": 0, "attendanceRate": None, "flags": []}
+                                        for student in cube.students]
+    first_day = int(cube.day[keep].min())
+    days = int(cube.day[keep].max()) - first_day + 1
+    day = cube.day[keep] - first_day
+
+    subject_lessons = np.zeros((students, subjects), np.int64)
+    subject_absences = np.zeros((students, subjects), np.int64)
+    total_lessons = np.zeros((students, days), np.int32)
+    total_absences = np.zeros((students, days), np.int32)
+    for column in range(subjects):
+        mask = subject_index == column
+        cells = student_index[mask] * days + day[mask]
+        # students x days matrices for this subject (several lessons a day add up)
+        lessons = np.bincount(cells, minlength=students * days).reshape(students, days)
+        absences = np.bincount(cells[~present[mask]], minlength=students * days).reshape(students, days)
+        subject_lessons[:, column] = lessons.sum(axis=1)
+        subject_absences[:, column] = absences.sum(axis=1)
+        total_lessons += lessons.astype(np.int32)
+        total_absences += absences.astype(np.int32)
+
+    lessons = subject_lessons.sum(axis=1)
+    absences = subject_absences.sum(axis=1)
+    overall = rate(lessons - absences, lessons)
+    per_subject = rate(subject_lessons - subject_absences, subject_lessons)
+
+    # Rolling windows of `window` calendar days from cumulative sums
+    window = min(window, days)
+    lesson_sums = np.concatenate([np.zeros((students, 1), np.int64), np.cumsum(total_lessons, axis=1)], axis=1)
+    absence_sums = np.concatenate([np.zeros((students, 1), np.int64), np.cumsum(total_absences, axis=1)], axis=1)
+    window_lessons = lesson_sums[:, window:] - lesson_sums[:, :-window]
+    window_absences = absence_sums[:, window:] - absence_sums[:, :-window]
+    window_rates = np.where(window_lessons >= min_lessons, rate(window_lessons - window_absences, window_lessons), np.inf)
+    worst_window = window_rates.argmin(axis=1)
+    worst_rate = window_rates[np.arange(students), worst_window]
+    recent_rate = window_rates[:, -1]
+
+    overall_flag = (lessons >= min_lessons) & (overall < threshold)
+    subject_flags = (subject_lessons >= min_lessons) & (per_subject < threshold)
+    window_flag = np.isfinite(worst_rate) & (worst_rate < threshold)
+    flagged = overall_flag | subject_flags.any(axis=1) | window_flag
+
+    # Worst first: lowest overall attendance, then lowest worst-window attendance
+    order = np.lexsort((np.where(np.isfinite(worst_rate), worst_rate, 2.0), np.where(np.isnan(overall), 2.0, overall)))
+    if flagged_only:
+        order = order[flagged[order]]
+
+    def number(value):
+        value = float(value)
+        return None if value != value or value == float("inf") else round(value, 4)
+
+    report = []
+    for row in order:
+        start = date.fromordinal(first_day + int(worst_window[row]))
+        flags = (["overall"] if overall_flag[row] else []) + (["window"] if window_flag[row] else []) \
+            + [f"subject:{cube.subjects[column]['subName']}" for column in np.flatnonzero(subject_flags[row])]
+        report.append({
+            **cube.students[row],
+            "lessons": int(lessons[row]),
+            "absences": int(absences[row]),
+            "attendanceRate": number(overall[row]),
+            "recentAttendanceRate": number(recent_rate[row]),
+            "worstWindow": {
+                "start": start.isoformat(),
+                "end": (start + timedelta(days=window - 1)).isoformat(),
+                "attendanceRate": number(worst_rate[row]),
+            } if np.isfinite(worst_rate[row]) else None,
+            "subjects": [{
+                "_id": str(cube.subjects[column]["_id"]),
+                "subName": cube.subjects[column]["subName"],
+                "lessons": int(subject_lessons[row, column]),
+                "absences": int(subject_absences[row, column]),
+                "attendanceRate": number(per_subject[row, column]),
+            } for column in np.flatnonzero(subject_lessons[row])],
+            "flags": flags,
+        })
+    return report
+
+
+def build_report(query: dict, class_names: Dict, options: Dict):
+    report = absence_report(load_attendance(query), **options)
+    for item in report:
+        class_id = item["sclassName"]
+        item["sclassName"] = {"_id": str(class_id), "sclassName": class_names.get(class_id, "Unknown Class")} if class_id else None
+    return report
+
+
+def stream_json_array(items):
+    # One item per chunk: the first students reach the client while the rest is serialized
+    yield b"["
+    for index, item in enumerate(items):
+        yield (b"," if index else b"") + json.dumps(item, ensure_ascii=False).encode("utf-8")
+    yield b"]"
+
+
+async def report_response(query: dict, class_names: Dict, threshold: float, window: int, min_lessons: int, all: bool,
+                          date_from: Optional[datetime], date_to: Optional[datetime]):
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+    options = {"threshold": threshold, "window": window, "min_lessons": min_lessons, "flagged_only": not all,
+               "date_from": date_from and date_from.date(), "date_to": date_to and date_to.date()}
+    # CPU-bound NumPy work off the event loop
+    report = await asyncio.to_thread(build_report, query, class_names, options)
+    return StreamingResponse(stream_json_array(report), media_type="application/json")
+
+
+@router.get("/AbsenceReport/{school_id}")
+async def school_absence_report(school_id: str, threshold: float = 0.9, window: int = Query(28, ge=1, le=366),
+                                min_lessons: int = Query(5, ge=1), all: bool = False,
+                                date_from: Optional[datetime] = Query(None, alias="from"),
+                                date_to: Optional[datetime] = Query(None, alias="to")):
+    """ Students whose attendance rate is below `threshold` overall, in a subject or in any
+    `window`-day period, worst first. ?all=true lists every student, from/to limit the period """
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+    class_names = {sclass["_id"]: sclass["sclassName"] for sclass in
+                   get_collection("sclasses", secondary=True).find({"school": ObjectId(school_id)}, {"sclassName": 1})}
+    return await report_response({"school": ObjectId(school_id)}, class_names, threshold, window, min_lessons, all,
+                                 date_from, date_to)
+
+@router.get("/AbsenceReportClass/{class_id}")
+async def class_absence_report(class_id: str, threshold: float = 0.9, window: int = Query(28, ge=1, le=366),
+                               min_lessons: int = Query(5, ge=1), all: bool = False,
+                               date_from: Optional[datetime] = Query(None, alias="from"),
+                               date_to: Optional[datetime] = Query(None, alias="to")):
+    if not ObjectId.is_valid(class_id):
+        raise HTTPException(status_code=400, detail="Invalid class ID")
+    sclass = get_collection("sclasses", secondary=True).find_one({"_id": ObjectId(class_id)}, {"sclassName": 1})
+    if not sclass:
+        raise HTTPException(status_code=404, detail="No class found")
+    return await report_response({"sclassName": ObjectId(class_id)}, {sclass["_id"]: sclass["sclassName"]},
+                                 threshold, window, min_lessons, all, date_from, date_to)
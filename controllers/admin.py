@@ -1,10 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
-from werkzeug.security import generate_password_hash, check_password_hash
+from fastapi import APIRouter, HTTPException, Request
 from pymongo.collection import Collection
 from bson import ObjectId
 from pymongo.database import Database
 from pydantic import BaseModel, ValidationError
-from utils.db import  get_database, verify_google_token, get_collection
+from utils.db import duplicate_key_fields, verify_google_token, get_collection
+from utils.deadline import reraise_deadline
+from pymongo.errors import DuplicateKeyError
 import json
 import asyncio
 
@@ -41,9 +42,10 @@ class Admin(BaseModel):
 #     return request.state.db
 
 @router.post("/AdminGoogleLogin")
-async def google_login(data: GoogleLoginData, db: Database = Depends(get_database)):
-    admins = db["admins"]
-    google_user = verify_google_token(data.token)
+async def google_login(data: GoogleLoginData):
+    admins = get_collection("admins")
+    # Fetches Google's certificates over HTTP: keep it off the event loop
+    google_user = await asyncio.to_thread(verify_google_token, data.token)
     if google_user:
         admin = admins.find_one({'email': google_user['email']})
         if admin:
@@ -88,7 +90,7 @@ async def google_login(data: GoogleLoginData, db: Database = Depends(get_databas
 #     return admin
 
 @router.post("/AdminReg")
-async def admin_register(request: Request, db: Database = Depends(get_database)):
+async def admin_register(request: Request):
     try:
         try:
             req_body = await request.json()
@@ -97,19 +99,12 @@ async def admin_register(request: Request, db: Database = Depends(get_database))
 
         admins_collection = get_collection("admins")
         admin_data = None
-        print(admins_collection)
         if 'token' in req_body:
 
             google_user = await asyncio.to_thread(verify_google_token, req_body['token'])
             if not google_user:
                 raise HTTPException(status_code=401, detail="Invalid Google token")
 
-
-
-            existing_admin = admins_collection.find_one({'email': google_user['email']})
-            if existing_admin:
-                return {'message': 'Email already exists'}
-
             admin_data = Admin(
         **google_user,
         schoolName=req_body.get('schoolName', ''),
@@ -118,30 +113,29 @@ async def admin_register(request: Request, db: Database = Depends(get_database))
         role=req_body.get('role', 'Admin') 
     ).dict()
         else:
-            existing_admin_by_email = admins_collection.find_one({'email': req_body['email']})
-            existing_school = admins_collection.find_one({'schoolName': req_body['schoolName']})
-
-            if existing_admin_by_email:
-                return {'message': 'Email already exists'}
-            elif existing_school:
-                return {'message': 'School name already exists'}
-
             admin_data = Admin(**req_body).dict()
 
-        result = admins_collection.insert_one(admin_data)
+        # Unique email and schoolName indexes instead of find_one calls first
+        try:
+            result = admins_collection.insert_one(admin_data)
+        except DuplicateKeyError as e:
+            if 'schoolName' in duplicate_key_fields(e.details or {}):
+                return {'message': 'School name already exists'}
+            return {'message': 'Email already exists'}
         admin_data.pop('password', None)  
         admin_data['_id'] = str(result.inserted_id)  
         return admin_data
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON format")
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 @router.post("/AdminLogin")
-async def admin_login(data: AdminLoginData, db: Database = Depends(get_database)):
-    admins = db["admins"]
+async def admin_login(data: AdminLoginData):
+    admins = get_collection("admins")
     email = data.email
     password = data.password
     admin = admins.find_one({'email': email})
@@ -155,8 +149,8 @@ async def admin_login(data: AdminLoginData, db: Database = Depends(get_database)
 
 
 @router.get("/Admin/{admin_id}")
-async def get_admin_detail(admin_id: str, db: Database = Depends(get_database)):
-    admins = db["admins"]
+async def get_admin_detail(admin_id: str):
+    admins = get_collection("admins")
     admin = admins.find_one({'_id': ObjectId(admin_id)})
     if admin:
         admin['_id'] = str(admin['_id'])
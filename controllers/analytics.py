@@ -0,0 +1,192 @@
+from fastapi import APIRouter, HTTPException, Query
+from bson import ObjectId
+from typing import Dict, List, Optional
+import os
+from utils.cache import TTLCache
+from utils.db import get_collection
+from utils.display_names import find_infos, SUBJECT_FIELDS
+
+# Loaded marks per class/school; dropped by update_exam_result, the TTL bounds staleness across workers
+ANALYTICS_CACHE_TTL = float(os.environ.get("ANALYTICS_CACHE_TTL", "600"))
+
+MARKS_PROJECTION = {
+    "name": 1, "rollNum": 1, "sclassName": 1,
+    "examResult.subName": 1, "examResult.marksObtained": 1, "examResult.subjectInfo.subName": 1,
+}
+
+# Upper bound on histogram buckets per subject; `bucket` is widened past it for marks above 100
+MAX_HISTOGRAM_BUCKETS = 1000
+
+marks_cache = TTLCache(ANALYTICS_CACHE_TTL, max_entries=256)
+
+router = APIRouter()
+
+
+class MarksMatrix:
+    """ students x subjects matrix of marks, NaN where a student has no mark """
+
+    def __init__(self, students: List[dict], subjects: List[dict], marks):
+        self.students = students
+        self.subjects = subjects
+        self.marks = marks
+
+
+def load_marks(query: dict) -> MarksMatrix:
+    """ One projection-only query; subject names come from the copies stored with the marks """
+    import numpy as np
+
+    students, subjects, subject_index = [], [], {}
+    rows, columns, values = [], [], []
+    for student in get_collection("students", secondary=True).find(query, MARKS_PROJECTION):
+        row = len(students)
+        students.append({"_id": str(student["_id"]), "name": student.get("name"), "rollNum": student.get("rollNum")})
+        for result in student.get("examResult") or []:
+            subject_id, marks = result.get("subName"), result.get("marksObtained")
+            if subject_id is None or marks is None:
+                continue
+            column = subject_index.get(subject_id)
+            if column is None:
+                column = subject_index[subject_id] = len(subjects)
+                subjects.append({"_id": subject_id, "subName": (result.get("subjectInfo") or {}).get("subName")})
+            rows.append(row)
+            columns.append(column)
+            values.append(marks)
+
+    # Names missing from documents written before the copies existed: one $in
+    missing = [subject["_id"] for subject in subjects if subject["subName"] is None]
+    if missing:
+        infos = find_infos(get_collection("subjects", secondary=True), missing, SUBJECT_FIELDS)
+        for subject in subjects:
+            if subject["subName"] is None:
+                subject["subName"] = infos.get(subject["_id"], {}).get("subName", "Unknown")
+    for subject in subjects:
+        subject["_id"] = str(subject["_id"])
+
+    matrix = np.full((len(students), len(subjects)), np.nan)
+    matrix[np.asarray(rows, dtype=np.intp), np.asarray(columns, dtype=np.intp)] = values
+    return MarksMatrix(students, subjects, matrix)
+
+
+def cached_marks(key, query: dict) -> MarksMatrix:
+    return marks_cache.get_or_set(key, lambda: load_marks(query))
+
+
+def invalidate_marks(class_id=None, school_id=None):
+    """ Called by update_exam_result """
+    if class_id is not None:
+        marks_cache.invalidate(("class", str(class_id)))
+    if school_id is not None:
+        marks_cache.invalidate(("school", str(school_id)))
+
+
+def competition_ranks(values, valid):
+    """ 1 + number of strictly higher marks in the same column, for every cell (0 where no mark) """
+    import numpy as np
+
+    rows, columns = values.shape
+    if not valid.any():
+        return np.zeros(values.shape, dtype=np.int64)
+    low, high = np.nanmin(values), np.nanmax(values)
+    # Shift every column into its own disjoint range, so one sorted array serves all columns
+    span = high - low + 1
+    shifted = np.where(valid, values - low, 0) + np.arange(columns) * span
+    ordered = np.sort(shifted[valid])
+    column_ends = np.searchsorted(ordered, (np.arange(columns) + 1) * span, side="left")
+    higher = column_ends[np.newaxis, :] - np.searchsorted(ordered, shifted, side="right")
+    return np.where(valid, higher + 1, 0)
+
+
+def number(value) -> Optional[float]:
+    value = float(value)
+    return None if value != value else round(value, 2)
+
+
+def exam_statistics(data: MarksMatrix, percentiles: List[float], bucket: float, top: int) -> Dict:
+    import numpy as np
+
+    marks = data.marks
+    valid = ~np.isnan(marks)
+    counts = valid.sum(axis=0)
+    result = {"students": len(data.students), "subjects": [], "ranking": []}
+    if not data.subjects:
+        return result
+
+    # A subject only becomes a column when somebody has a mark in it, so no column is all-NaN
+    means = np.nanmean(marks, axis=0)
+    medians = np.nanmedian(marks, axis=0)
+    stds = np.nanstd(marks, axis=0)
+    lows, highs = np.nanmin(marks, axis=0), np.nanmax(marks, axis=0)
+    percentile_values = np.nanpercentile(marks, percentiles, axis=0) if percentiles else np.empty((0, marks.shape[1]))
+
+    # Histogram of every subject at once: bincount over (subject, bucket) pairs
+    upper = max(100.0, float(np.nanmax(marks)))
+    bucket = max(bucket, upper / MAX_HISTOGRAM_BUCKETS)
+    edges = np.arange(0, upper + bucket, bucket)
+    buckets = np.clip(np.digitize(np.where(valid, marks, 0), edges[1:-1]), 0, len(edges) - 2)
+    subject_columns = np.broadcast_to(np.arange(marks.shape[1]), marks.shape)
+    histogram = np.bincount((subject_columns * (len(edges) - 1) + buckets)[valid],
+                            minlength=marks.shape[1] * (len(edges) - 1)).reshape(marks.shape[1], len(edges) - 1)
+
+    ranks = competition_ranks(marks, valid)
+    best_first = np.argsort(np.where(valid, -marks, np.inf), axis=0, kind="stable")[:top]
+
+    for column, subject in enumerate(data.subjects):
+        top_students = [
+            {**data.students[row], "marksObtained": number(marks[row, column]), "rank": int(ranks[row, column])}
+            for row in best_first[:, column] if valid[row, column]
+        ]
+        result["subjects"].append({
+            "subject": subject,
+            "count": int(counts[column]),
+            "mean": number(means[column]),
+            "median": number(medians[column]),
+            "std": number(stds[column]),
+            "min": number(lows[column]),
+            "max": number(highs[column]),
+            "percentiles": {f"{p:g}": number(percentile_values[index, column]) for index, p in enumerate(percentiles)},
+            "histogram": {"edges": [number(edge) for edge in edges], "counts": histogram[column].tolist()},
+            "top": top_students,
+        })
+
+    # Overall ranking by average mark over the subjects a student has marks in
+    marked = valid.any(axis=1)
+    averages = np.where(marked, np.where(valid, marks, 0).sum(axis=1) / np.maximum(valid.sum(axis=1), 1), np.nan)
+    overall = competition_ranks(averages[:, np.newaxis], marked[:, np.newaxis])[:, 0]
+    order = np.lexsort((np.arange(len(data.students)), np.where(marked, overall, np.iinfo(np.int64).max)))
+    for row in order:
+        result["ranking"].append({
+            **data.students[row],
+            "average": number(averages[row]),
+            "rank": int(overall[row]) or None,
+            "subjectRanks": {data.subjects[column]["_id"]: int(ranks[row, column])
+                             for column in np.flatnonzero(valid[row])},
+        })
+    return result
+
+
+def validate(bucket: float, percentiles: List[float]):
+    if bucket <= 0 or 100 / bucket > MAX_HISTOGRAM_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be at least {100 / MAX_HISTOGRAM_BUCKETS:g}")
+    if any(p < 0 or p > 100 for p in percentiles):
+        raise HTTPException(status_code=400, detail="percentiles must be between 0 and 100")
+
+
+@router.get("/ExamStats/{school_id}")
+def school_exam_stats(school_id: str, percentile: List[float] = Query([10, 25, 50, 75, 90]),
+                      bucket: float = Query(10, ge=100 / MAX_HISTOGRAM_BUCKETS), top: int = Query(5, ge=0, le=100)):
+    """ Per-subject statistics, histograms, top students and ranks for a whole school """
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+    validate(bucket, percentile)
+    data = cached_marks(("school", school_id), {"school": ObjectId(school_id)})
+    return exam_statistics(data, percentile, bucket, top)
+
+@router.get("/ExamStatsClass/{class_id}")
+def class_exam_stats(class_id: str, percentile: List[float] = Query([10, 25, 50, 75, 90]),
+                     bucket: float = Query(10, ge=100 / MAX_HISTOGRAM_BUCKETS), top: int = Query(5, ge=0, le=100)):
+    """ The same for one class """
+    if not ObjectId.is_valid(class_id):
+        raise HTTPException(status_code=400, detail="Invalid class ID")
+    validate(bucket, percentile)
+    data = cached_marks(("class", class_id), {"sclassName": ObjectId(class_id)})
+    return exam_statistics(data, percentile, bucket, top)
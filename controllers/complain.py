@@ -1,23 +1,52 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Query, Response
 from pymongo import MongoClient
-from bson import ObjectId
+from bson import ObjectId, errors
 from datetime import datetime
-from typing import List
-from utils.db import get_collection, get_database
+from typing import List, Optional
+from utils.db import get_collection
 from pydantic import BaseModel
 
 router = APIRouter()
 
+# Set on a complaint page when older complaints exist; pass it back as ?cursor= for the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Page size when a cursor is given without ?limit=
+COMPLAIN_PAGE_SIZE = 100
+
+# Resolves complaint.user to the student's name (see the "user" projection below);
+# only the name is fetched, not the whole student with its marks and attendance
+AUTHOR_LOOKUP = {"$lookup": {
+    "from": "students",
+    "let": {"user": "$user"},
+    "pipeline": [
+        {"$match": {"$expr": {"$eq": ["$_id", "$$user"]}}},
+        {"$project": {"name": 1}},
+    ],
+    "as": "author",
+}}
+AUTHOR_NAME = {"$ifNull": [{"$arrayElemAt": ["$author.name", 0]}, "Unknown"]}
+
 class ComplainModel(BaseModel):
-    user: str  
+    user: str
     date: datetime
     complaint: str
-    school: str 
+    school: str
+
+
+def encode_cursor(complain):
+    return f"{complain['date'].isoformat()}_{complain['_id']}"
+
+def decode_cursor(cursor: str):
+    try:
+        date, _, complain_id = cursor.rpartition("_")
+        return datetime.fromisoformat(date), ObjectId(complain_id)
+    except (ValueError, TypeError, errors.InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 @router.post("/ComplainCreate")
-async def create_complain(complain_data: ComplainModel, db: MongoClient = Depends(get_database)):
-    complain_collection = db.get_collection("complains")
+async def create_complain(complain_data: ComplainModel):
+    complain_collection = get_collection("complains")
     complain_data = complain_data.dict()
     complain_data["user"] = ObjectId(complain_data["user"])
     complain_data["school"] = ObjectId(complain_data["school"])
@@ -25,14 +54,51 @@ async def create_complain(complain_data: ComplainModel, db: MongoClient = Depend
     return {"_id": str(result.inserted_id)}
 
 @router.get("/ComplainList/{school_id}", response_model=List[ComplainModel])
-async def list_complains(school_id: str, db: MongoClient = Depends(get_database)):
-    complain_collection = db.get_collection("complains")
-    students_collection = db.get_collection("students")
-    complains = list(complain_collection.find({"school": ObjectId(school_id)}))
+def list_complains(school_id: str, response: Response,
+                   date_from: Optional[datetime] = Query(None, alias="from"),
+                   date_to: Optional[datetime] = Query(None, alias="to"),
+                   limit: Optional[int] = Query(None, ge=1, le=1000),
+                   cursor: Optional[str] = None):
+    """ Newest complaints first, served by the (school, date, _id) index. Paged when ?limit= or
+    ?cursor= is given, otherwise every complaint of the school as before """
+    complain_collection = get_collection("complains", secondary=True)
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+
+    conditions = [{"school": ObjectId(school_id)}]
+    if date_from or date_to:
+        date_range = {}
+        if date_from:
+            date_range["$gte"] = date_from
+        if date_to:
+            date_range["$lte"] = date_to
+        conditions.append({"date": date_range})
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        conditions.append({"$or": [
+            {"date": {"$lt": last_date}},
+            {"date": last_date, "_id": {"$lt": last_id}},
+        ]})
+
+    if limit is None and cursor:
+        limit = COMPLAIN_PAGE_SIZE
+
+    pipeline = [
+        {"$match": conditions[0] if len(conditions) == 1 else {"$and": conditions}},
+        {"$sort": {"date": -1, "_id": -1}},
+    ]
+    if limit is not None:
+        # One extra document tells whether another page exists
+        pipeline.append({"$limit": limit + 1})
+    pipeline += [
+        AUTHOR_LOOKUP,
+        {"$project": {"user": AUTHOR_NAME, "date": 1, "complaint": 1, "school": 1}},
+    ]
+    complains = list(complain_collection.aggregate(pipeline))
+    if limit is not None and len(complains) > limit:
+        complains = complains[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(complains[-1])
     for complain in complains:
-        student = students_collection.find_one({"_id": complain["user"]})
-        complain["user"] = student["name"] if student else "Unknown"
         complain["_id"] = str(complain["_id"])
-        complain["user"] = str(complain["user"])
         complain["school"] = str(complain["school"])
-    return complains
\ No newline at end of file
+    return complains
@@ -0,0 +1,154 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from typing import Dict, Iterator, List, Optional
+import csv
+import io
+import os
+import tempfile
+from utils.db import get_collection
+from utils.attendance_bits import expand_attendance
+
+try:
+    import xlsxwriter
+except ImportError:  # optional dependency, CSV only without it
+    xlsxwriter = None
+
+# Students fetched per round trip and CSV rows per streamed chunk
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+CSV_CHUNK_ROWS = 500
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+MARKS_PROJECTION = {"name": 1, "rollNum": 1, "sclassName": 1, "examResult": 1}
+ATTENDANCE_PROJECTION = {"name": 1, "rollNum": 1, "sclassName": 1, "attendance": 1, "attendanceBits": 1}
+
+router = APIRouter()
+
+
+def object_id(value: str, name: str) -> ObjectId:
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+    return ObjectId(value)
+
+
+class ExportScope:
+    """ Everything resolved once before streaming: classes, subjects and the collection to read """
+
+    def __init__(self, classes: Dict[ObjectId, str], subjects: List[dict], school_id: Optional[ObjectId] = None):
+        self.classes = classes
+        self.subjects = subjects
+        self.school_id = school_id
+        self.subject_names = {subject["_id"]: subject["subName"] for subject in subjects}
+        self.students = get_collection("students", secondary=True)
+
+    @classmethod
+    def for_class(cls, class_id: str):
+        class_id = object_id(class_id, "class ID")
+        sclass = get_collection("sclasses", secondary=True).find_one({"_id": class_id}, {"sclassName": 1})
+        if not sclass:
+            raise HTTPException(status_code=404, detail="No class found")
+        subjects = list(get_collection("subjects", secondary=True)
+                        .find({"sclassName": class_id}, {"subName": 1, "sclassName": 1}).sort("subName", 1))
+        return cls({class_id: sclass["sclassName"]}, subjects)
+
+    @classmethod
+    def for_school(cls, school_id: str):
+        school_id = object_id(school_id, "school ID")
+        classes = {sclass["_id"]: sclass["sclassName"] for sclass in get_collection("sclasses", secondary=True)
+                   .find({"school": school_id}, {"sclassName": 1}).sort("sclassName", 1)}
+        subjects = list(get_collection("subjects", secondary=True)
+                        .find({"school": school_id}, {"subName": 1, "sclassName": 1}).sort([("sclassName", 1), ("subName", 1)]))
+        return cls(classes, subjects, school_id)
+
+    def subject_label(self, subject: dict) -> str:
+        # The same subject name usually exists in several classes of a school
+        if len(self.classes) > 1:
+            return f"{subject['subName']} ({self.classes.get(subject.get('sclassName'), '-')})"
+        return subject["subName"]
+
+    def iter_students(self, projection: dict) -> Iterator[dict]:
+        """ Class by class in roll number order, then (school exports) students without a known class """
+        for class_id in self.classes:
+            yield from self.students.find({"sclassName": class_id}, projection, batch_size=EXPORT_BATCH_SIZE).sort("rollNum", 1)
+        if self.school_id is not None:
+            yield from self.students.find({"school": self.school_id, "sclassName": {"$nin": list(self.classes)}},
+                                          projection, batch_size=EXPORT_BATCH_SIZE).sort("rollNum", 1)
+
+
+def marks_rows(scope: ExportScope):
+    subject_ids = [subject["_id"] for subject in scope.subjects]
+    yield ["rollNum", "name", "sclassName"] + [scope.subject_label(subject) for subject in scope.subjects]
+    for student in scope.iter_students(MARKS_PROJECTION):
+        marks = {result.get("subName"): result.get("marksObtained") for result in student.get("examResult") or []}
+        yield [student.get("rollNum"), student.get("name"), scope.classes.get(student.get("sclassName"), "")] \
+            + [marks.get(subject_id) for subject_id in subject_ids]
+
+
+def attendance_rows(scope: ExportScope):
+    yield ["rollNum", "name", "sclassName", "subject", "date", "status"]
+    for student in scope.iter_students(ATTENDANCE_PROJECTION):
+        sclass_name = scope.classes.get(student.get("sclassName"), "")
+        records = sorted(expand_attendance(student), key=lambda record: (record["date"], str(record["subName"])))
+        for record in records:
+            subject = scope.subject_names.get(record["subName"]) or (record.get("subjectInfo") or {}).get("subName", "Unknown")
+            yield [student.get("rollNum"), student.get("name"), sclass_name, subject, record["date"].date(), record["status"]]
+
+
+def stream_csv(rows) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    buffer.write("\ufeff")  # BOM, so Excel opens the UTF-8 file with the right encoding
+    writer = csv.writer(buffer)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_xlsx(rows, sheet_name: str) -> Iterator[bytes]:
+    # constant_memory flushes every row to a temporary file; the zip is assembled on close
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "default_date_format": "yyyy-mm-dd"})
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+        for row_number, row in enumerate(rows):
+            worksheet.write_row(row_number, 0, row)
+        workbook.close()
+        output.seek(0)
+        while True:
+            chunk = output.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+def export_response(rows, filename: str, format: str) -> StreamingResponse:
+    """ Stream the rows; the generator runs in the threadpool, so cursor reads do not block the loop """
+    if format == "csv":
+        return StreamingResponse(stream_csv(rows), media_type="text/csv",
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'})
+    if format == "xlsx":
+        if xlsxwriter is None:
+            raise HTTPException(status_code=501, detail="XLSX export needs the xlsxwriter package")
+        return StreamingResponse(stream_xlsx(rows, filename), media_type=XLSX_MEDIA_TYPE,
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}.xlsx"'})
+    raise HTTPException(status_code=400, detail="format must be csv or xlsx")
+
+
+@router.get("/ExportMarks/{school_id}")
+async def export_school_marks(school_id: str, format: str = "csv"):
+    return export_response(marks_rows(ExportScope.for_school(school_id)), f"marks-{school_id}", format)
+
+@router.get("/ExportMarksClass/{class_id}")
+async def export_class_marks(class_id: str, format: str = "csv"):
+    return export_response(marks_rows(ExportScope.for_class(class_id)), f"marks-{class_id}", format)
+
+@router.get("/ExportAttendance/{school_id}")
+async def export_school_attendance(school_id: str, format: str = "csv"):
+    return export_response(attendance_rows(ExportScope.for_school(school_id)), f"attendance-{school_id}", format)
+
+@router.get("/ExportAttendanceClass/{class_id}")
+async def export_class_attendance(class_id: str, format: str = "csv"):
+    return export_response(attendance_rows(ExportScope.for_class(class_id)), f"attendance-{class_id}", format)
@@ -1,10 +1,35 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from bson import ObjectId
 from datetime import datetime
 from typing import List
-from utils.db import get_database, get_collection
+import json
+import logging
+import os
+from utils.db import create_collection, get_collection, target_databases
+from utils.pubsub import CLOSED, Broker, ChangeStreamFeed, change_streams_supported, enable_pre_images
+
+logger = logging.getLogger(__name__)
+
+# Feed notice events from MongoDB change streams (needed with several workers, where serve.py turns it on;
+# needs a replica set, deletes need MongoDB 6.0+ for pre-images)
+NOTICE_CHANGE_STREAM = os.environ.get("NOTICE_CHANGE_STREAM", "0") == "1"
+# Seconds between keep-alive comments on an idle stream
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))
+# Events buffered per client before a slow client is disconnected
+SSE_QUEUE_SIZE = int(os.environ.get("SSE_QUEUE_SIZE", "100"))
+# One document per school (_id = school id) touched by DELETE /Notices/{school_id}, so the
+# change stream carries a single "cleared" event instead of one delete per notice
+NOTICE_CLEARS_COLLECTION = "noticeClears"
+
+# Set once the change feeds run: every event then comes from them, in every worker
+change_feed_active = False
+
+# Notice events per school id
+notice_events = Broker(SSE_QUEUE_SIZE)
 
 class Notice(BaseModel):
     title: str
@@ -24,17 +49,78 @@ class NoticeList(BaseModel):
 router = APIRouter()
 
 
+def notice_payload(notice):
+    return {
+        "title": notice["title"],
+        "details": notice["details"],
+        "date": notice["date"],
+        "adminID": str(notice["school"]),
+        "school": str(notice["school"]),
+        "_id": str(notice["_id"])
+    }
+
+def publish_notice(event_type: str, school, notice: dict):
+    # With the change stream on, the feed publishes every change (from any worker) instead
+    if not change_feed_active:
+        notice_events.publish(str(school), {"type": event_type, "notice": notice})
+
+def handle_notice_change(change):
+    operation = change["operationType"]
+    if change["ns"]["coll"] == NOTICE_CLEARS_COLLECTION:
+        if operation in ("insert", "update", "replace"):
+            school_id = str(change["documentKey"]["_id"])
+            notice_events.publish(school_id, {"type": "cleared", "notice": {"school": school_id}})
+        return
+    if operation == "insert":
+        event_type, notice = "created", change.get("fullDocument")
+    elif operation in ("update", "replace"):
+        event_type, notice = "updated", change.get("fullDocument")
+    elif operation == "delete":
+        event_type, notice = "deleted", change.get("fullDocumentBeforeChange")
+    else:
+        return
+    if notice is None:
+        return  # deleted before the lookup, or no pre-image recorded for the delete
+    payload = notice_payload(notice) if event_type != "deleted" else {"_id": str(notice["_id"])}
+    notice_events.publish(str(notice["school"]), {"type": event_type, "notice": payload})
+
+def start_change_feeds():
+    """ Watch notices (and clears) on every target; without a replica set, log it once and keep
+    publishing in-process """
+    global change_feed_active
+    databases = target_databases()
+    if not all(change_streams_supported(database) for database in databases):
+        logger.warning("NOTICE_CHANGE_STREAM needs a replica set: notice events stay within each worker")
+        return []
+    feeds = []
+    for database in databases:
+        # Without pre-images a delete event has no school to publish it to
+        enable_pre_images(create_collection(database, "notices"))
+        pipeline = [{"$match": {"ns.coll": {"$in": ["notices", NOTICE_CLEARS_COLLECTION]}}}]
+        feed = ChangeStreamFeed(database, handle_notice_change, pipeline=pipeline,
+                                full_document="updateLookup", full_document_before_change="whenAvailable")
+        feed.start()
+        feeds.append(feed)
+    change_feed_active = True
+    return feeds
+
+def format_event(event_id: int, event: dict):
+    data = json.dumps(jsonable_encoder(event["notice"]))
+    return f"id: {event_id}\nevent: notice.{event['type']}\ndata: {data}\n\n"
+
+
 @router.post("/NoticeCreate")
-async def create_notice(notice_data: Notice, db: MongoClient = Depends(get_database)):
-    notice_collection = db.get_collection("notices")
+async def create_notice(notice_data: Notice):
+    notice_collection = get_collection("notices")
     notice_data = notice_data.dict()
     notice_data["school"] = ObjectId(notice_data["adminID"]) 
     result = notice_collection.insert_one(notice_data)
+    publish_notice("created", notice_data["school"], notice_payload(notice_data))
     return {"_id": str(result.inserted_id)}
 
 @router.get("/NoticeList/{school_id}", response_model=List[NoticeList])
-async def list_notices(school_id: str, db: MongoClient = Depends(get_database)):
-    notice_collection = db.get_collection("notices")
+def list_notices(school_id: str):
+    notice_collection = get_collection("notices", secondary=True)
     notices = list(notice_collection.find({"school": ObjectId(school_id)}))
     
     return [
@@ -50,26 +136,59 @@ async def list_notices(school_id: str, db: MongoClient = Depends(get_database)):
     ]
 
 @router.put("/Notice/{notice_id}")
-async def update_notice(notice_id: str, notice_data: Notice, db: MongoClient = Depends(get_database)):
-    notice_collection = db.get_collection("notices")
+async def update_notice(notice_id: str, notice_data: Notice):
+    notice_collection = get_collection("notices")
     updated_data = {"$set": notice_data.dict()}
-    result = notice_collection.update_one({"_id": ObjectId(notice_id)}, updated_data)
-    if result.matched_count == 0:
+    notice = notice_collection.find_one_and_update({"_id": ObjectId(notice_id)}, updated_data,
+                                                   return_document=ReturnDocument.AFTER)
+    if notice is None:
         raise HTTPException(status_code=404, detail="Notice not found")
+    publish_notice("updated", notice["school"], notice_payload(notice))
     return {"message": "Notice updated successfully"}
 
 @router.delete("/Notice/{notice_id}")
-async def delete_notice(notice_id: str, db: MongoClient = Depends(get_database)):
-    notice_collection = db.get_collection("notices")
-    result = notice_collection.delete_one({"_id": ObjectId(notice_id)})
-    if result.deleted_count == 0:
+async def delete_notice(notice_id: str):
+    notice_collection = get_collection("notices")
+    notice = notice_collection.find_one_and_delete({"_id": ObjectId(notice_id)}, projection={"school": 1})
+    if notice is None:
         raise HTTPException(status_code=404, detail="Notice not found")
+    publish_notice("deleted", notice["school"], {"_id": notice_id})
     return {"message": "Notice deleted successfully"}
 
 @router.delete("/Notices/{school_id}")
-async def delete_notices(school_id: str, db: MongoClient = Depends(get_database)):
-    notice_collection = db.get_collection("notices")
+async def delete_notices(school_id: str):
+    notice_collection = get_collection("notices")
     result = notice_collection.delete_many({"school": ObjectId(school_id)})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="No notices found to delete")
-    return {"deleted_count": result.deleted_count}
\ No newline at end of file
+    if change_feed_active:
+        get_collection(NOTICE_CLEARS_COLLECTION).update_one(
+            {"_id": ObjectId(school_id)}, {"$set": {"clearedAt": datetime.now()}}, upsert=True)
+    publish_notice("cleared", school_id, {"school": school_id})
+    return {"deleted_count": result.deleted_count}
+
+@router.get("/NoticeStream/{school_id}")
+async def notice_stream(school_id: str):
+    """ Server-Sent Events with the school's notice changes: notice.created, notice.updated,
+    notice.deleted and notice.cleared. Events are not replayed after a reconnect, so
+    clients reload /NoticeList when the stream (re)opens """
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+
+    async def events():
+        subscription = notice_events.subscribe(school_id)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                item = await subscription.get(SSE_HEARTBEAT)
+                if item is None:
+                    yield ": ping\n\n"
+                elif item is CLOSED:
+                    return
+                else:
+                    yield format_event(*item)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
\ No newline at end of file
@@ -1,6 +1,8 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
 from utils.db import get_collection
+from utils.raw_bson import json_list_response, projection
 from bson import ObjectId, errors
 from pydantic import BaseModel, Field
 from datetime import datetime
@@ -45,42 +47,45 @@ class Student(BaseModel):
     sclassName: str
     school: str
 
+# Response fields of /Sclass/Students/{id}, in model order; password is never read, so always null
+CLASS_STUDENT_FIELDS = ("_id", "name", "rollNum", "password", "sclassName", "school")
+CLASS_STUDENT_PROJECTION = projection(field for field in CLASS_STUDENT_FIELDS if field != "password")
+
 @router.post("/SclassCreate", response_model=SclassCreate)
-async def sclass_create(sclass_data: SclassCreate, sclass_collection: Collection = Depends(lambda: get_collection('sclasses'))):
+async def sclass_create(sclass_data: SclassCreate):
+    sclass_collection = get_collection('sclasses')
     if not sclass_data.adminID or not ObjectId.is_valid(sclass_data.adminID):
         raise HTTPException(status_code=400, detail="Invalid school ID")
 
     school_id = ObjectId(sclass_data.adminID)
     
-    existing_sclass = sclass_collection.find_one({"sclassName": sclass_data.sclassName, "school": school_id})
-    print(existing_sclass)
-    if existing_sclass:
-        raise HTTPException(status_code=400, detail='Class with this name already exists in the school')
-    print('here')
     new_sclass = {
         "sclassName": sclass_data.sclassName,
         "school": school_id,
         "createdAt": sclass_data.createdAt if sclass_data.createdAt else datetime.now(),
         "updatedAt": sclass_data.updatedAt if sclass_data.updatedAt else datetime.now()  
     }
-    result = sclass_collection.insert_one(new_sclass)
-
-    created_sclass = sclass_collection.find_one({"_id": result.inserted_id})
-
+    # Unique (school, sclassName) index instead of a find_one first
+    try:
+        result = sclass_collection.insert_one(new_sclass)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail='Class with this name already exists in the school')
 
+    # The inserted document is what we just sent, no need to read it back
     response_data = {
-        '_id': str(created_sclass['_id']),  # Use 'id' to match the alias in SclassList
-        'sclassName': created_sclass['sclassName'],
-        'school': str(created_sclass['school']),
-        'createdAt': created_sclass['createdAt'].isoformat() if created_sclass.get('createdAt') else None,
-        'updatedAt': created_sclass['updatedAt'].isoformat() if created_sclass.get('updatedAt') else None
+        '_id': str(result.inserted_id),  # Use 'id' to match the alias in SclassList
+        'sclassName': new_sclass['sclassName'],
+        'school': str(new_sclass['school']),
+        'createdAt': new_sclass['createdAt'].isoformat() if new_sclass.get('createdAt') else None,
+        'updatedAt': new_sclass['updatedAt'].isoformat() if new_sclass.get('updatedAt') else None
     }
 
     return SclassList(**response_data)
 
-@router.get("/SclassList/{id}", response_model=list[SclassList])
-async def sclass_list(id: str, sclass_collection: Collection = Depends(lambda: get_collection('sclasses'))):
-    sclasses = list(sclass_collection.find({"school": ObjectId(id)}))
+@router.get("/SclassList/{school_id}", response_model=list[SclassList])
+def sclass_list(school_id: str):
+    sclass_collection = get_collection('sclasses', secondary=True)
+    sclasses = list(sclass_collection.find({"school": ObjectId(school_id)}))
     sclasses_list = []
     for sclass in sclasses:
         sclass_dict = {
@@ -95,9 +100,9 @@ async def sclass_list(id: str, sclass_collection: Collection = Depends(lambda: g
     return sclasses_list
 
 @router.get("/Sclass/{id}", response_model=Sclass)
-async def get_sclass_detail(id: str, 
-    sclass_collection: Collection = Depends(lambda: get_collection('sclasses')), 
-    admin_collection: Collection = Depends(lambda: get_collection('admins'))):
+def get_sclass_detail(id: str):
+    sclass_collection = get_collection('sclasses')
+    admin_collection = get_collection('admins')
     if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid or missing ObjectId")
     
@@ -131,21 +136,18 @@ async def get_sclass_detail(id: str,
  
 
 @router.get("/Sclass/Students/{id}", response_model=list[Student])
-async def get_sclass_students(id: str, student_collection: Collection = Depends(lambda: get_collection('students'))):
-    students = list(student_collection.find({"sclassName": ObjectId(id)}))
-    for student in students:
-        student['_id'] = str(student['_id']) 
-        student['sclassName'] = str(student['sclassName']) 
-        student['school'] = str(student['school']) 
-        student.pop('password', None) 
-    return [Student(**student) for student in students]
+def get_sclass_students(id: str):
+    student_collection = get_collection('students', secondary=True, raw=True)
+    # Exam results and attendance stay on the server
+    students = student_collection.find({"sclassName": ObjectId(id)}, CLASS_STUDENT_PROJECTION)
+    return json_list_response(students, CLASS_STUDENT_FIELDS, id_fields=("_id", "sclassName", "school"))
 
 @router.delete("/Sclass/{id}")
-async def delete_sclass(id: str, 
-                        sclass_collection: Collection = Depends(lambda: get_collection('sclasses')), 
-                        student_collection: Collection = Depends(lambda: get_collection('students')),
-                        subject_collection: Collection = Depends(lambda: get_collection('subjects')),
-                        teacher_collection: Collection = Depends(lambda: get_collection('teachers'))):
+async def delete_sclass(id: str):
+    sclass_collection = get_collection('sclasses')
+    student_collection = get_collection('students')
+    subject_collection = get_collection('subjects')
+    teacher_collection = get_collection('teachers')
     deleted_class = sclass_collection.delete_one({"_id": ObjectId(id)})
     if deleted_class.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Class not found")
@@ -156,19 +158,19 @@ async def delete_sclass(id: str,
 
     return {"message": "Class deleted successfully"}
 
-@router.delete("/Sclasses/{id}")
-async def delete_sclasses(id: str, 
-                          sclass_collection: Collection = Depends(lambda: get_collection('sclass')), 
-                          student_collection: Collection = Depends(lambda: get_collection('student')),
-                          subject_collection: Collection = Depends(lambda: get_collection('subject')),
-                          teacher_collection: Collection = Depends(lambda: get_collection('teacher'))):
-    deleted_classes = sclass_collection.delete_many({"school": id})
+@router.delete("/Sclasses/{school_id}")
+async def delete_sclasses(school_id: str):
+    sclass_collection = get_collection('sclass')
+    student_collection = get_collection('student')
+    subject_collection = get_collection('subject')
+    teacher_collection = get_collection('teacher')
+    deleted_classes = sclass_collection.delete_many({"school": school_id})
     if deleted_classes.deleted_count == 0:
         raise HTTPException(status_code=404, detail="No classes found to delete")
 
-    student_collection.delete_many({"school": id})
-    subject_collection.delete_many({"school": id})
-    teacher_collection.delete_many({"school": id})
+    student_collection.delete_many({"school": school_id})
+    subject_collection.delete_many({"school": school_id})
+    teacher_collection.delete_many({"school": school_id})
 
     return {"message": "Classes deleted successfully"}
 
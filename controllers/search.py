@@ -0,0 +1,102 @@
+from fastapi import APIRouter, HTTPException, Query
+from bson import ObjectId
+from typing import Optional
+import asyncio
+import os
+from utils.cache import TTLCache
+from utils.db import get_collection
+from utils.search import SearchIndex
+
+# Per-school index, updated by this worker's writes and rebuilt after the TTL to pick up other workers' writes
+SEARCH_INDEX_TTL = float(os.environ.get("SEARCH_INDEX_TTL", "300"))
+SEARCH_INDEX_SCHOOLS = int(os.environ.get("SEARCH_INDEX_SCHOOLS", "64"))
+
+STUDENT_PROJECTION = {"name": 1, "rollNum": 1, "school": 1, "sclassName": 1, "sclassInfo": 1}
+TEACHER_PROJECTION = {"name": 1, "email": 1, "school": 1, "teachSclass": 1}
+
+search_indexes = TTLCache(SEARCH_INDEX_TTL, max_entries=SEARCH_INDEX_SCHOOLS)
+
+router = APIRouter()
+
+
+def student_entry(student: dict):
+    class_id = student.get("sclassName")
+    document = {
+        "_id": str(student["_id"]),
+        "type": "student",
+        "name": student.get("name"),
+        "rollNum": student.get("rollNum"),
+        "sclassName": {"_id": str(class_id), **(student.get("sclassInfo") or {})} if isinstance(class_id, ObjectId) else None,
+    }
+    return document["_id"], document, [student.get("name"), student.get("rollNum")], ()
+
+
+def teacher_entry(teacher: dict):
+    class_id = teacher.get("teachSclass")
+    document = {
+        "_id": str(teacher["_id"]),
+        "type": "teacher",
+        "name": teacher.get("name"),
+        "email": teacher.get("email"),
+        "teachSclass": {"_id": str(class_id)} if class_id else None,
+    }
+    return document["_id"], document, [teacher.get("name"), teacher.get("email")], [teacher.get("email")]
+
+
+def load_index(school_id: ObjectId) -> SearchIndex:
+    """ Two projection-only queries per school """
+    students = get_collection("students", secondary=True).find({"school": school_id}, STUDENT_PROJECTION)
+    teachers = get_collection("teachers", secondary=True).find({"school": school_id}, TEACHER_PROJECTION)
+    return SearchIndex.build([*map(student_entry, students), *map(teacher_entry, teachers)])
+
+
+def school_index(school_id: ObjectId) -> SearchIndex:
+    return search_indexes.get_or_set(str(school_id), lambda: load_index(school_id))
+
+
+def index_student(student: dict):
+    """ Called after a student is registered or updated; a no-op until the school has been searched """
+    index = search_indexes.get(str(student.get("school")))
+    if index is not None:
+        index.add(*student_entry(student))
+
+
+def index_teacher(teacher: dict):
+    index = search_indexes.get(str(teacher.get("school")))
+    if index is not None:
+        index.add(*teacher_entry(teacher))
+
+
+def unindex(document: dict):
+    """ Called with the deleted student or teacher (at least _id and school) """
+    index = search_indexes.get(str(document.get("school")))
+    if index is not None:
+        index.remove(str(document["_id"]))
+
+
+def unindex_school(school_id):
+    search_indexes.invalidate(str(school_id))
+
+
+def unindex_class(kind: str, class_id):
+    """ Bulk deletes by class do not know the school: drop the class members from every loaded index """
+    field = "sclassName" if kind == "student" else "teachSclass"
+    for index in search_indexes.values():
+        index.remove_where(lambda document: document["type"] == kind and (document[field] or {}).get("_id") == str(class_id))
+
+
+@router.get("/Search/{school_id}")
+async def search(school_id: str, q: str = Query(..., min_length=1, max_length=100),
+                 limit: int = Query(10, ge=1, le=50), type: Optional[str] = None):
+    """ Students (name, roll number) and teachers (name, email) of a school matching every word
+    of `q` as a whole word, a prefix or with one typo, best `limit` first """
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+    if type not in (None, "student", "teacher"):
+        raise HTTPException(status_code=400, detail="type must be student or teacher")
+    # Building an index takes a while for a large school: off the event loop
+    # An empty index is falsy (__len__), so test for a miss explicitly
+    index = search_indexes.get(school_id)
+    if index is None:
+        index = await asyncio.to_thread(school_index, ObjectId(school_id))
+    return index.search(q, limit, None if type is None else (lambda document: document["type"] == type))
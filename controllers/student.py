@@ -2,11 +2,18 @@ from typing import List, Optional
 from bson import ObjectId
 from pydantic import BaseModel, Field
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, Depends, Body
+from fastapi import APIRouter, HTTPException, Body, Request, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 import logging
-from utils.db import get_collection, get_database
+from utils.db import ARCHIVE_COLLECTION, causal_session, get_collection, has_causal_token
+from utils.deadline import reraise_deadline
+from pymongo.errors import DuplicateKeyError
+from utils.display_names import fill_display_names
+from utils.archive import merge_history, read_history
+from controllers.analytics import invalidate_marks
+from controllers.search import index_student, unindex, unindex_class, unindex_school
+from utils.attendance_bits import (bitmap_enabled, clear_record, compact_attendance, expand_attendance,
+                                   set_day, wire_format)
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 from datetime import date
@@ -123,21 +130,11 @@ class StudentAttendance(BaseModel):
     attendance: List[AttendanceExam]
     school: str
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_pwd_context = None
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 router = APIRouter()
 
-def get_students_collection(db: MongoClient = Depends(get_database)):
-    return db.get_collection('students')
-def get_sclasses_collection(db: MongoClient = Depends(get_database)):
-    return db.get_collection('sclasses')
-def get_subjects_collection(db: MongoClient = Depends(get_database)):
-    return db.get_collection('subjects')
-def get_admins_collection(db: MongoClient = Depends(get_database)):
-    return db.get_collection('admins')
-
-
 def convert_objectid_to_str(data):
     """ Convert all ObjectId fields to strings """
     if isinstance(data, dict):
@@ -147,19 +144,27 @@ def convert_objectid_to_str(data):
     else:
         return data
 
+def get_pwd_context():
+    # passlib/bcrypt is only loaded when a password is actually hashed
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
+
 # Utility function for password hashing
 def hash_password(password: str) -> str:
     password_bytes = password.encode('utf-8')  # Encoding the password to bytes
-    hashed_password = pwd_context.hash(password_bytes)
+    hashed_password = get_pwd_context().hash(password_bytes)
     return hashed_password
 
 @router.post("/StudentReg")
-async def student_register(student: Student, students_collection: Collection = Depends(lambda: get_collection('students'))):
-    existing_student = students_collection.find_one({"rollNum": student.rollNum, "school": ObjectId(student.adminID)})
-    if existing_student:
-        raise HTTPException(status_code=400, detail="Roll number already exists")
-
+async def student_register(student: Student, request: Request, response: Response):
+    students_collection = get_collection('students')
+    with causal_session(request, response) as session:
+        return register_student(student, students_collection, session)
 
+def register_student(student: Student, students_collection: Collection, session):
     # Convert fields to ObjectId where necessary
     student_dict = student.dict()
     student_dict['school'] = ObjectId(student_dict.pop('adminID', None))
@@ -171,15 +176,25 @@ async def student_register(student: Student, students_collection: Collection = D
         if 'subName' in exam and exam['subName']:
             exam['subName'] = ObjectId(exam['subName'])
 
+    # Copy class, school and subject names next to the references (utils/display_names)
+    fill_display_names([student_dict], get_collection('sclasses'), get_collection('subjects'),
+                       get_collection('admins'), session)
+
     # Hash the password (uncomment and implement this if you want hashed passwords)
     # student_dict['password'] = hash_password(student.password)
 
-    result = students_collection.insert_one(student_dict)
+    # Unique (school, rollNum) index instead of a find_one first
+    try:
+        result = students_collection.insert_one(student_dict, session=session)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Roll number already exists")
     student_id = result.inserted_id
+    index_student(student_dict)
     return {"student_id": str(student_id)}
 
 @router.post("/StudentLogin")
-async def student_login(login_data: LoginData, students_collection: Collection = Depends(lambda: get_collection('students'))):
+async def student_login(login_data: LoginData):
+    students_collection = get_collection('students')
     # print(students_collection)
     rollNum = int(login_data.rollNum)
     # print(login_data)
@@ -193,29 +208,27 @@ async def student_login(login_data: LoginData, students_collection: Collection =
     return student_data
 
 @router.get("/Students/{school_id}", response_model=List[StudentResponseX])
-async def get_students(
-    school_id: str, 
-    students_collection: Collection = Depends(get_students_collection), 
-    sclasses_collection: Collection = Depends(get_sclasses_collection),
-    subjects_collection: Collection = Depends(get_subjects_collection)  # Add this
-):
+def get_students(school_id: str):
+    students_collection = get_collection('students', secondary=True)
+    sclasses_collection = get_collection('sclasses', secondary=True)
+    subjects_collection = get_collection('subjects', secondary=True)
     try:
         oid = ObjectId(school_id)
-        students_cursor = students_collection.find({"school": oid})
+        students = list(students_collection.find({"school": oid}, {"password": 0}))
+        # Names are stored with the references; only documents without the copies need lookups
+        fill_display_names(students, sclasses_collection, subjects_collection)
 
         student_list = []
-        for student in students_cursor:
-            student.pop('password', None)
-
+        for student in students:
             sclass_id = student.get('sclassName')
-            sclass = sclasses_collection.find_one({"_id": sclass_id}) if sclass_id else None
-            student['sclassName'] = SclassNameInfoX(_id=str(sclass['_id']), sclassName=sclass['sclassName']) if sclass else None
+            sclass = student.pop('sclassInfo', None)
+            student['sclassName'] = SclassNameInfoX(_id=str(sclass_id), sclassName=sclass['sclassName']) if sclass_id and sclass else None
 
             exam_results = []
             for res in student.get('examResult', []):
                 res_id = res.get('_id')
                 if res_id is not None:
-                    subject = subjects_collection.find_one({"_id": ObjectId(res['subName'])})
+                    subject = res.get('subjectInfo')
                     exam_results.append(ExamResultModelX(
                         _id=str(res['_id']),
                         subName=subject['subName'] if subject else 'Unknown',
@@ -224,10 +237,10 @@ async def get_students(
             student['examResult'] = exam_results
 
             attendance_records = []
-            for att in student.get('attendance', []):
+            for att in expand_attendance(student):
                 att_id = att.get('_id')
                 if att_id is not None:
-                    subject = subjects_collection.find_one({"_id": ObjectId(att['subName'])})
+                    subject = att.get('subjectInfo')
                     attendance_records.append(AttendanceModelX(
                         _id=str(att_id),
                         date=att['date'],
@@ -243,6 +256,7 @@ async def get_students(
 
         return student_list if student_list else HTTPException(status_code=404, detail="No students found")
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
  
 
@@ -253,179 +267,259 @@ def convert_document(document: Dict[str, Any]) -> Dict[str, Any]:
     return document
 
 @router.get("/Student/{student_id}")
-async def get_student_detail(student_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
-    schools_collection = db.get_collection("admins")
-    sclasses_collection = db.get_collection("sclasses")
-    subjects_collection = db.get_collection("subjects")
-
-    student = students_collection.find_one({"_id": ObjectId(student_id)})
+async def get_student_detail(student_id: str, request: Request, response: Response, attendance: str = "records",
+                             history: bool = False):
+    """ ?attendance=bitmap returns attendance as base64 bitsets (attendanceBits, see utils/attendance_bits),
+    ?history=true adds the records of archived terms (utils/archive) """
+    # Read-your-own-write route: stays on the primary unless the client sends the
+    # causal token of its last write, which makes a secondary read safe
+    secondary = has_causal_token(request)
+    with causal_session(request, response) as session:
+        return read_student_detail(student_id, secondary, session, compact=attendance == "bitmap", history=history)
+
+def read_student_detail(student_id: str, secondary: bool, session, compact: bool = False, history: bool = False):
+    students_collection = get_collection("students", secondary=secondary)
+    schools_collection = get_collection("admins", secondary=secondary)
+    sclasses_collection = get_collection("sclasses", secondary=secondary)
+    subjects_collection = get_collection("subjects", secondary=secondary)
+
+    student = students_collection.find_one({"_id": ObjectId(student_id)}, {"password": 0}, session=session)
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
-
+    if history:
+        merge_history(student, read_history(get_collection(ARCHIVE_COLLECTION, secondary=secondary),
+                                            student["_id"], session))
+
+    # A single read when the names are stored with the references; older documents cost one $in per collection
+    fill_display_names([student], sclasses_collection, subjects_collection, schools_collection, session)
+    if compact:
+        student['attendance'], bits = compact_attendance(student)
+        student['attendanceBits'] = wire_format(bits)
+    else:
+        student['attendance'] = expand_attendance(student)
+        student.pop('attendanceBits', None)
     student = convert_objectid_to_str(student)
 
-    school = schools_collection.find_one({"_id": ObjectId(student['school'])})
-    student['school'] = convert_objectid_to_str(school) if school else {"_id": student['school'], "schoolName": "Unknown School"}
-
-    sclass = sclasses_collection.find_one({"_id": ObjectId(student['sclassName'])})
-    student['sclassName'] = convert_objectid_to_str(sclass) if sclass else {"_id": student['sclassName'], "sclassName": "Unknown Class"}
+    school = student.pop('schoolInfo', None)
+    student['school'] = {"_id": student['school'], **school} if school else {"_id": student['school'], "schoolName": "Unknown School"}
 
-    for result in student.get("examResult", []):
-        subject = subjects_collection.find_one({"_id": ObjectId(result["subName"])})
-        result["subName"] = convert_objectid_to_str(subject) if subject else {"_id": result["subName"], "subName": "Unknown Subject"}
+    sclass = student.pop('sclassInfo', None)
+    student['sclassName'] = {"_id": student['sclassName'], **sclass} if sclass else {"_id": student['sclassName'], "sclassName": "Unknown Class"}
 
-    for record in student.get("attendance", []):
-        subject = subjects_collection.find_one({"_id": ObjectId(record["subName"])})
-        record["subName"] = convert_objectid_to_str(subject) if subject else {"_id": record["subName"], "subName": "Unknown Subject"}
-
-    student.pop("password", None)
+    for record in student.get("examResult", []) + student.get("attendance", []) + student.get("attendanceBits", []):
+        subject = record.pop("subjectInfo", None)
+        record["subName"] = {"_id": record["subName"], **subject} if subject else {"_id": record["subName"], "subName": "Unknown Subject"}
 
     return student
 
 @router.delete("/Student/{student_id}")
-async def delete_student(student_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
-    result = students_collection.delete_one({"_id": ObjectId(student_id)})
-    if result.deleted_count == 0:
+async def delete_student(student_id: str):
+    students_collection = get_collection("students")
+    deleted_student = students_collection.find_one_and_delete({"_id": ObjectId(student_id)}, {"school": 1})
+    if not deleted_student:
         raise HTTPException(status_code=404, detail="Student not found")
+    get_collection(ARCHIVE_COLLECTION).delete_many({"student": deleted_student["_id"]})
+    unindex(deleted_student)
     return {"message": "Student deleted successfully"}
 
 @router.delete("/Students/{school_id}")
-async def delete_students(school_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
+async def delete_students(school_id: str):
+    students_collection = get_collection("students")
     result = students_collection.delete_many({"school": ObjectId(school_id)})
+    get_collection(ARCHIVE_COLLECTION).delete_many({"school": ObjectId(school_id)})
+    unindex_school(school_id)
     if result.deleted_count == 0:
         return {"message": "No students found to delete"}
     return {"deleted_count": result.deleted_count}
 
 @router.delete("/StudentsClass/{class_id}")
-async def delete_students_by_class(class_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
+async def delete_students_by_class(class_id: str):
+    students_collection = get_collection("students")
+    # Archived terms carry no class, so they are found through the student ids
+    student_ids = students_collection.distinct("_id", {"sclassName": ObjectId(class_id)})
     result = students_collection.delete_many({"sclassName": ObjectId(class_id)})
+    if student_ids:
+        get_collection(ARCHIVE_COLLECTION).delete_many({"student": {"$in": student_ids}})
+    unindex_class("student", class_id)
     if result.deleted_count == 0:
         return {"message": "No students found to delete"}
     return {"deleted_count": result.deleted_count}
 
 @router.put("/Students/{student_id}", response_model=UpdateStudentModel)
-async def update_student(student_id: str, student_data: UpdateStudentModel = Body(...), db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
-
-
-    updated_student = students_collection.find_one_and_update(
-        {"_id": ObjectId(student_id)},
-        {"$set": student_data.dict(exclude_unset=True)},
-        return_document=True
-    )
+async def update_student(student_id: str, request: Request, response: Response, student_data: UpdateStudentModel = Body(...)):
+    students_collection = get_collection("students")
+    changes = student_data.dict(exclude_unset=True)
+    # A new class or school is stored as a reference, with a fresh name snapshot (utils/display_names);
+    # a stale snapshot would keep the old name on /Student, /Students and in search
+    stale_snapshots = {}
+    for field, snapshot_field in (("sclassName", "sclassInfo"), ("school", "schoolInfo")):
+        if field in changes:
+            if changes[field] and ObjectId.is_valid(changes[field]):
+                changes[field] = ObjectId(changes[field])
+            stale_snapshots[snapshot_field] = ""
+
+    with causal_session(request, response) as session:
+        fill_display_names([changes], get_collection('sclasses'), get_collection('subjects'),
+                           get_collection('admins'), session, arrays=())
+        update = {"$set": changes}
+        stale_snapshots = {field: "" for field in stale_snapshots if field not in changes}
+        if stale_snapshots:
+            update["$unset"] = stale_snapshots
+        try:
+            updated_student = students_collection.find_one_and_update(
+                {"_id": ObjectId(student_id)},
+                update,
+                return_document=True,
+                session=session
+            )
+        except DuplicateKeyError:
+            # rollNum changed to one already taken in the school (unique index)
+            raise HTTPException(status_code=400, detail="Roll number already exists")
 
     if not updated_student:
         raise HTTPException(status_code=404, detail="Student not found")
+    index_student(updated_student)
 
     updated_student.pop('password', None)  # Remove password from response
-    return updated_student
+    return convert_objectid_to_str(updated_student)
 
 
 @router.put("/UpdateExamResult/{student_id}", response_model=StudentExam)
-async def update_exam_result(student_id: str, exam_data: ExamResultModel, students_collection: Collection = Depends(get_students_collection), sclasses_collection: Collection = Depends(get_sclasses_collection), schools_collection: Collection = Depends(get_admins_collection)):
+async def update_exam_result(student_id: str, exam_data: ExamResultModel, request: Request, response: Response):
+    students_collection = get_collection('students')
+    sclasses_collection = get_collection('sclasses')
+    subjects_collection = get_collection('subjects')
+    schools_collection = get_collection('admins')
     try:
-        student = students_collection.find_one({"_id": ObjectId(student_id)})
-        if not student:
-            raise HTTPException(status_code=404, detail="Student not found")
-
-        # Find the exam result if it already exists
-        existing_result_index = next((index for (index, d) in enumerate(student.get("examResult", [])) if d["_id"] == ObjectId(exam_data.id)), -1)
-
-        # Update the existing exam result or append a new one
-        if existing_result_index != -1:
-            student["examResult"][existing_result_index]["subName"] = ObjectId(exam_data.subName)
-            student["examResult"][existing_result_index]["marksObtained"] = exam_data.marksObtained
-        else:
-            new_exam_result = {
-                "_id": ObjectId(exam_data.id) if exam_data.id else ObjectId(),
-                "subName": ObjectId(exam_data.subName),
-                "marksObtained": exam_data.marksObtained
-            }
-            student["examResult"].append(new_exam_result)
-
-        # Update the student document in the database
-        students_collection.update_one({"_id": ObjectId(student_id)}, {"$set": {"examResult": student["examResult"]}})
-
-        # Fetch updated student data
-        student = students_collection.find_one({"_id": ObjectId(student_id)})
-
-
-        # Convert ObjectIds to strings and fetch related objects
-        student = convert_objectid_to_str(student)
-        student['rollNum'] = student['rollNum']
-
-
-        # Fetch and format sclassName details
-        if student['sclassName']:
-            sclass = sclasses_collection.find_one({"_id": ObjectId(student['sclassName'])})
-            student['sclassName'] = sclass['sclassName']
-
-        # Fetch and format school details
-        if student['school']:
-            school = schools_collection.find_one({"_id": ObjectId(student['school'])})
-            student['school'] = school['schoolName']
-
-        student.pop("password", None)  # Remove password from the response
-        student.pop("adminID", None)  # Remove adminID if it's not needed in the response
-
-        return StudentExam(**student)
+        with causal_session(request, response) as session:
+            student = students_collection.find_one({"_id": ObjectId(student_id)}, session=session)
+            if not student:
+                raise HTTPException(status_code=404, detail="Student not found")
+
+            # Find the exam result if it already exists
+            existing_result_index = next((index for (index, d) in enumerate(student.get("examResult", [])) if d["_id"] == ObjectId(exam_data.id)), -1)
+
+            # Update the existing exam result or append a new one
+            if existing_result_index != -1:
+                if student["examResult"][existing_result_index]["subName"] != ObjectId(exam_data.subName):
+                    student["examResult"][existing_result_index].pop("subjectInfo", None)
+                student["examResult"][existing_result_index]["subName"] = ObjectId(exam_data.subName)
+                student["examResult"][existing_result_index]["marksObtained"] = exam_data.marksObtained
+            else:
+                new_exam_result = {
+                    "_id": ObjectId(exam_data.id) if exam_data.id else ObjectId(),
+                    "subName": ObjectId(exam_data.subName),
+                    "marksObtained": exam_data.marksObtained
+                }
+                student["examResult"].append(new_exam_result)
+
+            # Store the subject, class and school names with the references (one $in for whatever is missing)
+            fill_display_names([student], sclasses_collection, subjects_collection, schools_collection, session,
+                               arrays=("examResult",))
+            update = {"examResult": student["examResult"]}
+            update.update({field: student[field] for field in ("sclassInfo", "schoolInfo") if field in student})
+
+            # Update the student document in the database and fetch the updated data
+            student = students_collection.find_one_and_update({"_id": ObjectId(student_id)}, {"$set": update},
+                                                              return_document=ReturnDocument.AFTER, session=session)
+            # Exam statistics of the class and school are recomputed on the next request
+            invalidate_marks(student.get("sclassName"), student.get("school"))
+
+
+            # Convert ObjectIds to strings and fetch related objects
+            student['attendance'] = expand_attendance(student)
+            student = convert_objectid_to_str(student)
+            student['rollNum'] = student['rollNum']
+
+
+            # Class and school names come from the stored copies
+            if student['sclassName']:
+                student['sclassName'] = student.get('sclassInfo', {}).get('sclassName', "Unknown Class")
+
+            if student['school']:
+                student['school'] = student.get('schoolInfo', {}).get('schoolName', "Unknown School")
+
+            student.pop("password", None)  # Remove password from the response
+            student.pop("adminID", None)  # Remove adminID if it's not needed in the response
+
+            return StudentExam(**student)
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
     
 @router.put("/StudentAttendance/{student_id}", response_model=StudentAttendance)
-async def update_student_attendance(student_id: str, attendance_data: AttendanceRequest, students_collection: Collection = Depends(get_students_collection), sclasses_collection: Collection = Depends(get_sclasses_collection), schools_collection: Collection = Depends(get_admins_collection)):
+async def update_student_attendance(student_id: str, attendance_data: AttendanceRequest, request: Request, response: Response):
+    students_collection = get_collection('students')
+    sclasses_collection = get_collection('sclasses')
+    subjects_collection = get_collection('subjects')
+    schools_collection = get_collection('admins')
     try:
-        student = students_collection.find_one({"_id": ObjectId(student_id)})
-        if not student:
-            raise HTTPException(status_code=404, detail="Student not found")
-
-        # Find the attendance record if it already exists
-        existing_attendance_index = next((index for (index, d) in enumerate(student.get("attendance", [])) if d["_id"] == ObjectId(attendance_data.id)), -1)
-
-        # Update the existing attendance record or append a new one
-        if existing_attendance_index != -1:
-            student["attendance"][existing_attendance_index]["date"] = attendance_data.date
-            student["attendance"][existing_attendance_index]["status"] = attendance_data.status
-            student["attendance"][existing_attendance_index]["subName"] = ObjectId(attendance_data.subName)
-        else:
-            new_attendance_record = {
-                "_id": ObjectId(attendance_data.id) if attendance_data.id else ObjectId(),
-                "date": attendance_data.date,
-                "status": attendance_data.status,
-                "subName": ObjectId(attendance_data.subName)
-            }
-            student["attendance"].append(new_attendance_record)
-
-        # Update the student document in the database
-        students_collection.update_one({"_id": ObjectId(student_id)}, {"$set": {"attendance": student["attendance"]}})
-
-        # Fetch updated student data
-        student = students_collection.find_one({"_id": ObjectId(student_id)})
-
-        # Convert ObjectIds to strings and fetch related objects
-        student = convert_objectid_to_str(student)
-        student['rollNum'] = student['rollNum']
-
-
-        # Fetch and format sclassName details
-        if student['sclassName']:
-            sclass = sclasses_collection.find_one({"_id": ObjectId(student['sclassName'])})
-            student['sclassName'] = sclass['sclassName']
-
-        # Fetch and format school details
-        if student['school']:
-            school = schools_collection.find_one({"_id": ObjectId(student['school'])})
-            student['school'] = school['schoolName']
-
-        student.pop("password", None)  # Remove password from the response
-        student.pop("adminID", None)  # Remove adminID if it's not needed in the response
-
-        return StudentAttendance(**student)
+        with causal_session(request, response) as session:
+            student = students_collection.find_one({"_id": ObjectId(student_id)}, session=session)
+            if not student:
+                raise HTTPException(status_code=404, detail="Student not found")
+
+            # Find the attendance record if it already exists
+            existing_attendance_index = next((index for (index, d) in enumerate(student.get("attendance", [])) if d["_id"] == ObjectId(attendance_data.id)), -1)
+
+            stored_as_bit = False
+            if bitmap_enabled():
+                # Compact layout: the record becomes a bit; stored records move to bitsets on the way
+                if existing_attendance_index != -1:
+                    del student["attendance"][existing_attendance_index]
+                    existing_attendance_index = -1
+                student["attendance"], student["attendanceBits"] = compact_attendance(student)
+                if attendance_data.id and ObjectId.is_valid(attendance_data.id):
+                    clear_record(student["attendanceBits"], ObjectId(attendance_data.id))
+                stored_as_bit = set_day(student["attendanceBits"], ObjectId(attendance_data.subName), attendance_data.date, attendance_data.status)
+
+            # Update the existing attendance record or append a new one
+            if existing_attendance_index != -1:
+                if student["attendance"][existing_attendance_index]["subName"] != ObjectId(attendance_data.subName):
+                    student["attendance"][existing_attendance_index].pop("subjectInfo", None)
+                student["attendance"][existing_attendance_index]["date"] = attendance_data.date
+                student["attendance"][existing_attendance_index]["status"] = attendance_data.status
+                student["attendance"][existing_attendance_index]["subName"] = ObjectId(attendance_data.subName)
+            elif not stored_as_bit:
+                new_attendance_record = {
+                    "_id": ObjectId(attendance_data.id) if attendance_data.id else ObjectId(),
+                    "date": attendance_data.date,
+                    "status": attendance_data.status,
+                    "subName": ObjectId(attendance_data.subName)
+                }
+                student["attendance"].append(new_attendance_record)
+
+            # Store the subject, class and school names with the references (one $in for whatever is missing)
+            fill_display_names([student], sclasses_collection, subjects_collection, schools_collection, session,
+                               arrays=("attendance", "attendanceBits"))
+            update = {"attendance": student["attendance"]}
+            if "attendanceBits" in student:
+                update["attendanceBits"] = student["attendanceBits"]
+            update.update({field: student[field] for field in ("sclassInfo", "schoolInfo") if field in student})
+
+            # Update the student document in the database and fetch the updated data
+            student = students_collection.find_one_and_update({"_id": ObjectId(student_id)}, {"$set": update},
+                                                              return_document=ReturnDocument.AFTER, session=session)
+
+            # Convert ObjectIds to strings and fetch related objects
+            student['attendance'] = expand_attendance(student)
+            student = convert_objectid_to_str(student)
+            student['rollNum'] = student['rollNum']
+
+
+            # Class and school names come from the stored copies
+            if student['sclassName']:
+                student['sclassName'] = student.get('sclassInfo', {}).get('sclassName', "Unknown Class")
+
+            if student['school']:
+                student['school'] = student.get('schoolInfo', {}).get('schoolName', "Unknown School")
+
+            student.pop("password", None)  # Remove password from the response
+            student.pop("adminID", None)  # Remove adminID if it's not needed in the response
+
+            return StudentAttendance(**student)
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Endpoint do aktualizacji obecności studenta
@@ -489,42 +583,61 @@ async def update_student_attendance(student_id: str, attendance_data: Attendance
 
 # Endpoint do usuwania obecności wszystkich studentów w szkole
 @router.delete("/RemoveAllStudentsSubAtten/{school_id}")
-async def clear_all_students_attendance(school_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
-    result = students_collection.update_many({"school": ObjectId(school_id)}, {"$set": {"attendance": []}})
+async def clear_all_students_attendance(school_id: str):
+    students_collection = get_collection("students")
+    result = students_collection.update_many({"school": ObjectId(school_id)}, {"$set": {"attendance": []}, "$unset": {"attendanceBits": ""}})
+    get_collection(ARCHIVE_COLLECTION).update_many({"school": ObjectId(school_id)}, {"$unset": {"attendance": "", "attendanceBits": ""}})
     return {"modified_count": result.modified_count}
 
 # Endpoint do usuwania obecności wszystkich studentów w danym przedmiocie
 @router.delete("/RemoveAllStudentsAtten/{subject_id}")
-async def clear_all_students_attendance_by_subject(subject_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
-    result = students_collection.update_many({"attendance.subName": ObjectId(subject_id)}, {"$pull": {"attendance": {"subName": ObjectId(subject_id)}}})
+async def clear_all_students_attendance_by_subject(subject_id: str):
+    students_collection = get_collection("students")
+    result = students_collection.update_many(
+        {"$or": [{"attendance.subName": ObjectId(subject_id)}, {"attendanceBits.subName": ObjectId(subject_id)}]},
+        {"$pull": {"attendance": {"subName": ObjectId(subject_id)}, "attendanceBits": {"subName": ObjectId(subject_id)}}}
+    )
+    get_collection(ARCHIVE_COLLECTION).update_many(
+        {"$or": [{"attendance.subName": ObjectId(subject_id)}, {"attendanceBits.subName": ObjectId(subject_id)}]},
+        {"$pull": {"attendance": {"subName": ObjectId(subject_id)}, "attendanceBits": {"subName": ObjectId(subject_id)}}}
+    )
     return {"modified_count": result.modified_count}
 
 @router.delete("/RemoveStudentSubAtten/{subject_id}")
-async def remove_student_attendance_by_subject(student_id: str, subject_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
+async def remove_student_attendance_by_subject(student_id: str, subject_id: str):
+    students_collection = get_collection("students")
     
     result = students_collection.update_one(
-        {"_id": ObjectId(student_id)},
-        {"$pull": {"attendance": {"subName": ObjectId(subject_id)}}}
+        {"_id": ObjectId(student_id),
+         "$or": [{"attendance.subName": ObjectId(subject_id)}, {"attendanceBits.subName": ObjectId(subject_id)}]},
+        {"$pull": {"attendance": {"subName": ObjectId(subject_id)}, "attendanceBits": {"subName": ObjectId(subject_id)}}}
+    )
+    archived = get_collection(ARCHIVE_COLLECTION).update_many(
+        {"student": ObjectId(student_id),
+         "$or": [{"attendance.subName": ObjectId(subject_id)}, {"attendanceBits.subName": ObjectId(subject_id)}]},
+        {"$pull": {"attendance": {"subName": ObjectId(subject_id)}, "attendanceBits": {"subName": ObjectId(subject_id)}}}
     )
 
-    if result.modified_count == 0:
+    if result.modified_count == 0 and archived.modified_count == 0:
         raise HTTPException(status_code=404, detail="No attendance record found for the subject")
     return {"message": "Attendance record removed"}
 
 # Usuwanie wszystkich obecności studenta
 @router.delete("/RemoveStudentAtten/{student_id}")
-async def remove_student_attendance(student_id: str, db: MongoClient = Depends(get_database)):
-    students_collection = db.get_collection("students")
+async def remove_student_attendance(student_id: str):
+    students_collection = get_collection("students")
     
     result = students_collection.update_one(
-        {"_id": ObjectId(student_id)},
-        {"$set": {"attendance": []}}
+        {"_id": ObjectId(student_id),
+         "$or": [{"attendance.0": {"$exists": True}}, {"attendanceBits": {"$exists": True}}]},
+        {"$set": {"attendance": []}, "$unset": {"attendanceBits": ""}}
+    )
+    archived = get_collection(ARCHIVE_COLLECTION).update_many(
+        {"student": ObjectId(student_id), "$or": [{"attendance": {"$exists": True}}, {"attendanceBits": {"$exists": True}}]},
+        {"$unset": {"attendance": "", "attendanceBits": ""}}
     )
 
-    if result.modified_count == 0:
+    if result.modified_count == 0 and archived.modified_count == 0:
         raise HTTPException(status_code=404, detail="No attendance records found")
     return {"message": "All attendance records cleared"}
 
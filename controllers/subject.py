@@ -2,9 +2,12 @@ from typing import List, Optional
 from bson import ObjectId
 from pydantic import BaseModel, Field
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException
 import logging
-from utils.db import get_collection, get_database
+from utils.db import get_collection
+from utils.deadline import reraise_deadline
+from utils.raw_bson import json_list_response, projection
+from pymongo.errors import BulkWriteError
 from pymongo import MongoClient
 
 # class TeacherInfo(BaseModel):
@@ -43,6 +46,10 @@ class SubjectFree(BaseModel):
     sclassName: Optional[str] = None
     school: Optional[str] = None
 
+# Response fields of the raw BSON list routes, in model order
+CLASS_SUBJECT_FIELDS = ("subName", "subCode", "sessions", "sclassName", "school")
+FREE_SUBJECT_FIELDS = ("_id", "subName", "subCode", "sessions", "sclassName", "school")
+
 class SubjectCreate(BaseModel):
     subjects: List[Subject]
     adminID: str
@@ -79,15 +86,6 @@ def convert_objectid_to_str(obj):
 async def subject_create(subject_data: SubjectCreate):
     subjects_collection = get_collection('subjects')
 
-    for subject in subject_data.subjects:
-        existing_subject = subjects_collection.find_one({
-            'subCode': subject.subCode,
-            'school': ObjectId(subject_data.adminID)
-        })
-
-        if existing_subject:
-            raise HTTPException(status_code=400, detail=f'Subject with subCode {subject.subCode} already exists')
-
     new_subjects = [{
         'subName': subject.subName,
         'subCode': subject.subCode,
@@ -96,19 +94,35 @@ async def subject_create(subject_data: SubjectCreate):
         'school': ObjectId(subject_data.adminID)
     } for subject in subject_data.subjects]
 
+    # One insert_many, the unique (school, subCode) index rejects duplicates. Unordered, so every
+    # conflicting subCode is reported at once
     try:
-        inserted_ids = subjects_collection.insert_many(new_subjects).inserted_ids
-        # Convert ObjectId fields to strings for response
-        converted_ids = [convert_objectid_to_str(id) for id in inserted_ids]
-        return {"inserted_ids": converted_ids}
+        inserted_ids = subjects_collection.insert_many(new_subjects, ordered=False).inserted_ids
+    except BulkWriteError as e:
+        # (school, subCode) is the only unique index besides _id, and the _ids are fresh
+        conflicts = [error for error in e.details.get('writeErrors', []) if error.get('code') == 11000]
+        if not conflicts:
+            raise HTTPException(status_code=500, detail=str(e))
+        # All or nothing, as before: take back the subjects that did get in
+        failed = {error['index'] for error in e.details['writeErrors']}
+        subjects_collection.delete_many({'_id': {'$in': [subject['_id'] for index, subject in enumerate(new_subjects)
+                                                         if index not in failed]}})
+        codes = list(dict.fromkeys(new_subjects[error['index']]['subCode'] for error in conflicts))
+        if len(codes) == 1:
+            raise HTTPException(status_code=400, detail=f'Subject with subCode {codes[0]} already exists')
+        raise HTTPException(status_code=400, detail=f'Subjects with subCodes {", ".join(codes)} already exist')
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
+    # Convert ObjectId fields to strings for response
+    converted_ids = [convert_objectid_to_str(id) for id in inserted_ids]
+    return {"inserted_ids": converted_ids}
 
 @router.get("/AllSubjects/{school_id}")
-async def all_subjects(school_id: str, db: MongoClient = Depends(get_database)) -> List[SubjectResponse]:
-    subjects_collection = db.get_collection('subjects')
-    sclasses_collection = db.get_collection('sclasses')
-    teachers_collection = db.get_collection('teachers')
+def all_subjects(school_id: str) -> List[SubjectResponse]:
+    subjects_collection = get_collection('subjects', secondary=True)
+    sclasses_collection = get_collection('sclasses', secondary=True)
+    teachers_collection = get_collection('teachers', secondary=True)
 
     subjects_cursor = subjects_collection.find({'school': ObjectId(school_id)})
     enhanced_subjects = []
@@ -136,11 +150,11 @@ async def all_subjects(school_id: str, db: MongoClient = Depends(get_database))
     return enhanced_subjects
 
 @router.get("/ClassSubjects/{class_id}")
-async def class_subjects(class_id: str) -> List[Subject]:
-    subjects_collection = get_collection('subjects')
-    subjects = list(subjects_collection.find({'sclassName': ObjectId(class_id)}))
+def class_subjects(class_id: str) -> List[Subject]:
+    subjects_collection = get_collection('subjects', secondary=True, raw=True)
+    subjects = list(subjects_collection.find({'sclassName': ObjectId(class_id)}, projection(CLASS_SUBJECT_FIELDS)))
     if subjects:
-        return [convert_objectid_to_str(subject) for subject in subjects]
+        return json_list_response(subjects, CLASS_SUBJECT_FIELDS, id_fields=("sclassName", "school"))
     else:
         raise HTTPException(status_code=404, detail="No subjects found")
     
@@ -150,28 +164,24 @@ def get_teacher_name(teacher_id):
     return teacher['name'] if teacher else "Unknown"
 
 @router.get("/FreeSubjectList/{sclass_id}", response_model=List[SubjectFree])
-async def free_subject_list(sclass_id: str, db: MongoClient = Depends(get_database)):
-    subjects_collection = db.get_collection("subjects")
+def free_subject_list(sclass_id: str):
+    subjects_collection = get_collection("subjects", raw=True)
 
     try:
-        subjects = list(subjects_collection.find({"sclassName": ObjectId(sclass_id), "teacher": {"$exists": False}}))
-
-        # Convert ObjectId fields to strings
-        print(subjects)
-        for subject in subjects:
-            subject['_id'] = str(subject['_id'])
-            subject['sclassName'] = str(subject['sclassName'])
-            subject['school'] = str(subject['school'])
-
+        subjects = list(subjects_collection.find({"sclassName": ObjectId(sclass_id), "teacher": {"$exists": False}},
+                                                 projection(FREE_SUBJECT_FIELDS)))
         if subjects:
-            return subjects
+            return json_list_response(subjects, FREE_SUBJECT_FIELDS, id_fields=("_id", "sclassName", "school"))
         else:
             raise HTTPException(status_code=404, detail="No subjects found")
+    except HTTPException:
+        raise
     except Exception as e:
+        reraise_deadline(e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/Subject/{subject_id}", response_model=SubjectResponse)
-async def get_subject_detail(subject_id: str):
+def get_subject_detail(subject_id: str):
     # Validate the subject_id
     try:
         valid_subject_id = ObjectId(subject_id)
@@ -217,7 +227,8 @@ async def delete_subject(subject_id: str):
     # Update related teachers and students
     teachers_collection.update_one({'teachSubject': ObjectId(subject_id)}, {'$unset': {'teachSubject': ''}})
     students_collection.update_many({}, {'$pull': {'examResult': {'subName': ObjectId(subject_id)}}})
-    students_collection.update_many({}, {'$pull': {'attendance': {'subName': ObjectId(subject_id)}}})
+    students_collection.update_many({}, {'$pull': {'attendance': {'subName': ObjectId(subject_id)},
+                                                   'attendanceBits': {'subName': ObjectId(subject_id)}}})
 
     return {"message": "Subject deleted successfully"}
 
@@ -240,7 +251,7 @@ async def delete_subjects(school_id: str):
     # Update students
     students_collection.update_many(
         {},
-        {'$set': {'examResult': None, 'attendance': None}}
+        {'$set': {'examResult': None, 'attendance': None}, '$unset': {'attendanceBits': ''}}
     )
 
     return {"message": f"Subjects deleted successfully for school {school_id}"}
@@ -264,7 +275,7 @@ async def delete_subjects_by_class(class_id: str):
     # Update students
     students_collection.update_many(
         {},
-        {'$set': {'examResult': None, 'attendance': None}}
+        {'$set': {'examResult': None, 'attendance': None}, '$unset': {'attendanceBits': ''}}
     )
 
     return {"message": f"Subjects deleted successfully for class {class_id}"}
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel, Field
+from bson import ObjectId
+from datetime import datetime
+from typing import List, Optional
+from controllers.complain import AUTHOR_LOOKUP, AUTHOR_NAME
+from utils.cache import TTLCache
+from utils.db import get_collection
+
+# Seconds a summary is served from memory; the dashboard tolerates slightly stale counts
+SUMMARY_CACHE_TTL = float(os.environ.get("SUMMARY_CACHE_TTL", "10"))
+SUMMARY_RECENT_ITEMS = int(os.environ.get("SUMMARY_RECENT_ITEMS", "5"))
+
+summary_cache = TTLCache(SUMMARY_CACHE_TTL)
+
+
+class RecentNotice(BaseModel):
+    id: str = Field(..., alias='_id')
+    title: str
+    details: str
+    date: datetime
+
+
+class RecentComplain(BaseModel):
+    id: str = Field(..., alias='_id')
+    user: str
+    date: datetime
+    complaint: str
+
+
+class NoticeSummary(BaseModel):
+    count: int
+    recent: List[RecentNotice]
+
+
+class ComplainSummary(BaseModel):
+    count: int
+    recent: List[RecentComplain]
+
+
+class SchoolSummary(BaseModel):
+    students: int
+    teachers: int
+    sclasses: int
+    subjects: int
+    notices: NoticeSummary
+    complains: ComplainSummary
+    generatedAt: datetime
+
+
+router = APIRouter()
+
+
+def count_and_recent(collection, school_id: ObjectId, project: dict, lookup: Optional[list] = None):
+    """ Count of the school's documents and the newest few, in one $facet aggregation """
+    recent = [{"$sort": {"date": -1}}, {"$limit": SUMMARY_RECENT_ITEMS}] + (lookup or []) + [{"$project": project}]
+    result = list(collection.aggregate([
+        {"$match": {"school": school_id}},
+        {"$facet": {"count": [{"$count": "n"}], "recent": recent}},
+    ]))
+    facets = result[0] if result else {"count": [], "recent": []}
+    count = facets["count"][0]["n"] if facets["count"] else 0
+    for item in facets["recent"]:
+        item["_id"] = str(item["_id"])
+    return {"count": count, "recent": facets["recent"]}
+
+
+def build_summary(school_id: ObjectId):
+    school_filter = {"school": school_id}
+    notices = count_and_recent(
+        get_collection("notices", secondary=True), school_id,
+        {"title": 1, "details": 1, "date": 1},
+    )
+    complains = count_and_recent(
+        get_collection("complains", secondary=True), school_id,
+        {"date": 1, "complaint": 1, "user": AUTHOR_NAME},
+        lookup=[AUTHOR_LOOKUP],
+    )
+    return {
+        "students": get_collection("students", secondary=True).count_documents(school_filter),
+        "teachers": get_collection("teachers", secondary=True).count_documents(school_filter),
+        "sclasses": get_collection("sclasses", secondary=True).count_documents(school_filter),
+        "subjects": get_collection("subjects", secondary=True).count_documents(school_filter),
+        "notices": notices,
+        "complains": complains,
+        "generatedAt": datetime.utcnow(),
+    }
+
+
+@router.get("/SchoolSummary/{school_id}", response_model=SchoolSummary)
+def school_summary(school_id: str):
+    if not ObjectId.is_valid(school_id):
+        raise HTTPException(status_code=400, detail="Invalid school ID")
+    return summary_cache.get_or_set(school_id, lambda: build_summary(ObjectId(school_id)))
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field
 from typing import Collection, Optional, List
 from pymongo import MongoClient
 from bson import ObjectId
-from utils.db import get_collection, get_database
+from utils.db import get_collection
+from pymongo.errors import DuplicateKeyError
+from controllers.search import index_teacher, unindex, unindex_class, unindex_school
 from datetime import datetime
 
 class Attendance(BaseModel):
@@ -97,12 +99,9 @@ def convert_objectid_to_str(data):
         return data
 
 @router.post("/TeacherReg")
-async def teacher_register(teacher: Teacher, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
-
-    if teachers_collection.find_one({"email": teacher.email}):
-        raise HTTPException(status_code=400, detail="Email already exists")
+async def teacher_register(teacher: Teacher):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
 
     # Hash the password
     hashed_password = teacher.password
@@ -123,8 +122,13 @@ async def teacher_register(teacher: Teacher, db: MongoClient = Depends(get_datab
     if teacher_data.get("teachSclass"):
         teacher_data["teachSclass"] = ObjectId(teacher_data["teachSclass"])
 
-    new_teacher = teachers_collection.insert_one(teacher_data)
+    # Unique email index instead of a find_one first
+    try:
+        new_teacher = teachers_collection.insert_one(teacher_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already exists")
     teacher_id = new_teacher.inserted_id
+    index_teacher(teacher_data)
 
     # Update the subject with the teacher ID
     if teacher_data.get("teachSubject"):
@@ -134,11 +138,11 @@ async def teacher_register(teacher: Teacher, db: MongoClient = Depends(get_datab
         )
 
 @router.post("/TeacherLogin", response_model=TeacherLogin)
-async def teacher_login(login_data: LoginData, 
-                        teachers_collection: Collection = Depends(lambda: get_collection('teachers')),
-                        schools_collection: Collection = Depends(lambda: get_collection('admins')),
-                        subjects_collection: Collection = Depends(lambda: get_collection('subjects')),
-                        classes_collection: Collection = Depends(lambda: get_collection('sclasses'))):
+async def teacher_login(login_data: LoginData):
+    teachers_collection = get_collection('teachers')
+    schools_collection = get_collection('admins')
+    subjects_collection = get_collection('subjects')
+    classes_collection = get_collection('sclasses')
   
     teacher = teachers_collection.find_one({"email": login_data.email})
     if not teacher:
@@ -168,8 +172,6 @@ async def teacher_login(login_data: LoginData,
         class_data = classes_collection.find_one({"_id": ObjectId(teacher['teachSclass'])})
         if class_data:
             class_info = SclassInfo(**convert_objectid_to_str(class_data))
-    print(teacher['teachSclass'])
-    print(class_data)
     teacher_data = {
         "_id": str(teacher['_id']),
         "name": teacher['name'],
@@ -189,10 +191,10 @@ async def teacher_login(login_data: LoginData,
 
 
 @router.get("/Teachers/{school_id}", response_model=List[TeacherList])
-async def get_teachers(school_id: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
-    sclasses_collection = db.get_collection("sclasses")
+def get_teachers(school_id: str):
+    teachers_collection = get_collection("teachers", secondary=True)
+    subjects_collection = get_collection("subjects", secondary=True)
+    sclasses_collection = get_collection("sclasses", secondary=True)
 
     teachers = list(teachers_collection.find({"school": ObjectId(school_id)}))
 
@@ -239,11 +241,11 @@ async def get_teachers(school_id: str, db: MongoClient = Depends(get_database)):
     return result
 
 @router.get("/Teacher/{teacher_id}", response_model=TeacherGet)
-async def get_teacher_detail(teacher_id: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
-    sclasses_collection = db.get_collection("sclasses")
-    schools_collection = db.get_collection("admins")
+def get_teacher_detail(teacher_id: str):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
+    sclasses_collection = get_collection("sclasses")
+    schools_collection = get_collection("admins")
 
     teacher = teachers_collection.find_one({"_id": ObjectId(teacher_id)})
     if not teacher:
@@ -289,9 +291,9 @@ async def get_teacher_detail(teacher_id: str, db: MongoClient = Depends(get_data
     return TeacherGet(**teacher)
 
 @router.put("/TeacherSubject")
-async def update_teacher_subject(teacher_id: str, teach_subject: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
+async def update_teacher_subject(teacher_id: str, teach_subject: str):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
 
     updated_teacher = teachers_collection.find_one_and_update(
         {"_id": ObjectId(teacher_id)},
@@ -310,14 +312,15 @@ async def update_teacher_subject(teacher_id: str, teach_subject: str, db: MongoC
     return updated_teacher
 
 @router.delete("/Teacher/{teacher_id}")
-async def delete_teacher(teacher_id: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
+async def delete_teacher(teacher_id: str):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
 
     deleted_teacher = teachers_collection.find_one_and_delete({"_id": ObjectId(teacher_id)})
 
     if not deleted_teacher:
         raise HTTPException(status_code=404, detail="Teacher not found")
+    unindex(deleted_teacher)
 
     subjects_collection.update_one(
         {"teacher": deleted_teacher["_id"]},
@@ -327,11 +330,12 @@ async def delete_teacher(teacher_id: str, db: MongoClient = Depends(get_database
     return {"message": "Teacher deleted successfully"}
 
 @router.delete("/Teachers/{school_id}")
-async def delete_teachers(school_id: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
+async def delete_teachers(school_id: str):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
 
     deletion_result = teachers_collection.delete_many({"school": ObjectId(school_id)})
+    unindex_school(school_id)
 
     if deletion_result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="No teachers found to delete")
@@ -344,11 +348,12 @@ async def delete_teachers(school_id: str, db: MongoClient = Depends(get_database
     return {"deleted_count": deletion_result.deleted_count}
 
 @router.delete("/TeachersClass/{class_id}")
-async def delete_teachers_by_class(class_id: str, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
-    subjects_collection = db.get_collection("subjects")
+async def delete_teachers_by_class(class_id: str):
+    teachers_collection = get_collection("teachers")
+    subjects_collection = get_collection("subjects")
 
     deletion_result = teachers_collection.delete_many({"teachSclass": ObjectId(class_id)})
+    unindex_class("teacher", class_id)
 
     if deletion_result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="No teachers found to delete")
@@ -361,8 +366,8 @@ async def delete_teachers_by_class(class_id: str, db: MongoClient = Depends(get_
     return {"deleted_count": deletion_result.deleted_count}
 
 @router.post("/TeacherAttendance/{teacher_id}")
-async def teacher_attendance(teacher_id: str, status: str, date: datetime, db: MongoClient = Depends(get_database)):
-    teachers_collection = db.get_collection("teachers")
+async def teacher_attendance(teacher_id: str, status: str, date: datetime):
+    teachers_collection = get_collection("teachers")
 
     teacher = teachers_collection.find_one({"_id": ObjectId(teacher_id)})
 
@@ -1,41 +1,137 @@
-from fastapi import Depends, FastAPI, Request
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from controllers.admin import router as admin_router
-from controllers.sclass import router as sclass_router
-from controllers.subject import router as subject_router
-from controllers.student import router as student_router
-from controllers.complain import router as complain_router
-from controllers.teacher import router as teacher_router
-from controllers.notice import router as notice_router
-
-from utils.db import db, get_database
-
-app = FastAPI()
-
-# CORS configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:4200"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-@app.middleware("http")
-async def db_middleware(request: Request, call_next):
-    request.state.db = db
-    response = await call_next(request)
-    return response
-
-# Include routers
-app.include_router(admin_router, dependencies=[Depends(get_database)])
-app.include_router(sclass_router, dependencies=[Depends(get_database)])
-app.include_router(subject_router, dependencies=[Depends(get_database)])
-app.include_router(student_router, dependencies=[Depends(get_database)])
-app.include_router(complain_router, dependencies=[Depends(get_database)])
-app.include_router(teacher_router, dependencies=[Depends(get_database)])
-app.include_router(notice_router, dependencies=[Depends(get_database)])
+from contextlib import asynccontextmanager
+import asyncio
+from fastapi import Depends, FastAPI
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from utils.db import close, ensure_indexes, prepare_collections, warm_up
+    from controllers.notice import NOTICE_CHANGE_STREAM, start_change_feeds as start_notice_feeds
+    from utils.display_names import DISPLAY_NAME_CHANGE_STREAM, start_change_feeds as start_display_name_feeds
+    from utils.loop_monitor import LOOP_MONITOR, monitor
+
+    # Runs in every worker after fork: create the Mongo clients here, never at import time,
+    # and open the pool before the worker accepts traffic
+    await asyncio.to_thread(warm_up)
+    await asyncio.to_thread(ensure_indexes)
+    prepare_collections()
+    feeds = []
+    if LOOP_MONITOR:
+        feeds.append(monitor.start())
+    if NOTICE_CHANGE_STREAM:
+        feeds += start_notice_feeds()
+    if DISPLAY_NAME_CHANGE_STREAM:
+        feeds += start_display_name_feeds()
+    yield
+    for feed in feeds:
+        feed.stop()
+    close()
+
+
+def create_app() -> FastAPI:
+    """ Build the application. Importing this module stays cheap: controllers, .env and
+    middleware are only loaded here, Mongo clients only in the lifespan """
+    from fastapi.middleware.cors import CORSMiddleware
+    from controllers.admin import router as admin_router
+    from controllers.sclass import router as sclass_router
+    from controllers.subject import router as subject_router
+    from controllers.student import router as student_router
+    from controllers.complain import NEXT_CURSOR_HEADER, router as complain_router
+    from controllers.teacher import router as teacher_router
+    from controllers.notice import router as notice_router
+    from controllers.summary import router as summary_router
+    from controllers.export import router as export_router
+    from controllers.analytics import router as analytics_router
+    from controllers.absence import router as absence_router
+    from controllers.search import router as search_router
+    from controllers.metrics import router as metrics_router
+
+    from utils.db import CAUSAL_TOKEN_HEADER, TENANT_ROUTES, command_listeners
+    from utils.tenancy import bind_school
+    from utils.admission import AdmissionControlMiddleware
+    from utils.coalescing import COALESCE_REQUESTS, CoalescingMiddleware
+    from utils.deadline import DeadlineMiddleware
+    from utils.compression import CompressionMiddleware
+    from utils.profiling import (PROFILE_ID_HEADER, ProfilingCommandListener, ProfilingMiddleware, profile_threadpool,
+                                 profiling_enabled)
+    from utils.loop_monitor import LOOP_MONITOR, LoopMonitorMiddleware
+    from utils.slow_queries import SlowQueryListener, SlowQueryMiddleware, slow_query_listener, slow_query_log_enabled
+
+    app = FastAPI(lifespan=lifespan)
+
+    # Only pure ASGI middleware below: BaseHTTPMiddleware (@app.middleware("http")) wraps every request in extra tasks
+
+    # Per-school and global concurrency limits (inside CORS, so rejections carry CORS headers)
+    app.add_middleware(AdmissionControlMiddleware)
+    # Identical concurrent GETs on read routes share one response (outside admission: followers take no slot)
+    if COALESCE_REQUESTS:
+        app.add_middleware(CoalescingMiddleware)
+    # Per-request deadline, counted from arrival (queueing included) and passed to Mongo as maxTimeMS; 504 when spent
+    app.add_middleware(DeadlineMiddleware)
+    # Slow query log (SLOW_QUERY_MS): tells the command listener which route issued each command
+    if slow_query_log_enabled():
+        if not any(isinstance(listener, SlowQueryListener) for listener in command_listeners):
+            command_listeners.append(slow_query_listener())
+        app.add_middleware(SlowQueryMiddleware)
+    # Opt-in request profiling (PROFILE_TOKEN / PROFILE_SAMPLE_RATE); includes the admission queue wait
+    if profiling_enabled():
+        if not any(isinstance(listener, ProfilingCommandListener) for listener in command_listeners):
+            command_listeners.append(ProfilingCommandListener())
+        profile_threadpool()
+        app.add_middleware(ProfilingMiddleware)
+    # Route of the request running when the loop monitor catches a blocked event loop
+    if LOOP_MONITOR:
+        app.add_middleware(LoopMonitorMiddleware)
+    # gzip/Brotli for large JSON payloads such as /Students/{school_id}
+    app.add_middleware(CompressionMiddleware)
+
+    # CORS configuration
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["http://localhost:4200"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=[CAUSAL_TOKEN_HEADER, "Retry-After", NEXT_CURSOR_HEADER, PROFILE_ID_HEADER],
+    )
+
+    # Include routers; handlers fetch cached collection handles through get_collection
+    router_dependencies = []
+    if TENANT_ROUTES:
+        # Resolve the school first so get_collection picks its routed target
+        router_dependencies.append(Depends(bind_school))
+
+    app.include_router(admin_router, dependencies=router_dependencies)
+    app.include_router(sclass_router, dependencies=router_dependencies)
+    app.include_router(subject_router, dependencies=router_dependencies)
+    app.include_router(student_router, dependencies=router_dependencies)
+    app.include_router(complain_router, dependencies=router_dependencies)
+    app.include_router(teacher_router, dependencies=router_dependencies)
+    app.include_router(notice_router, dependencies=router_dependencies)
+    app.include_router(summary_router, dependencies=router_dependencies)
+    app.include_router(export_router, dependencies=router_dependencies)
+    app.include_router(analytics_router, dependencies=router_dependencies)
+    app.include_router(absence_router, dependencies=router_dependencies)
+    app.include_router(search_router, dependencies=router_dependencies)
+    app.include_router(metrics_router)
+
+    return app
+
+
+_app = None
+
+
+def __getattr__(name):
+    # "main:app" keeps working for uvicorn and tests; the app is built on first access
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    import uvicorn
+
+    uvicorn.run(create_app(), host="0.0.0.0", port=5000)
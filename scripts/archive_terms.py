@@ -0,0 +1,37 @@
+"""Move attendance and exam records of past terms out of the student documents.
+
+    python -m scripts.archive_terms [--school <school_id>] [--before YYYY-MM-DD]
+
+Records dated before the start of the term containing --before (default:
+today, so everything but the current term) go to the compressed
+studentArchive collection, see utils/archive. Terms start in TERM_START_MONTH.
+The tool can be stopped and rerun at any time; nothing is archived twice.
+"""
+import argparse
+from datetime import datetime
+
+from bson import ObjectId
+
+from utils.attendance_bits import term_start
+from utils.db import target_databases
+from utils.archive import archive_students
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive the records of past terms")
+    parser.add_argument("--school", help="only this school (admin id)")
+    parser.add_argument("--before", type=datetime.fromisoformat, default=datetime.now(),
+                        help="archive terms that ended before the term of this date (default: today)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    query = {"school": ObjectId(args.school)} if args.school else {}
+    boundary = term_start(args.before)
+    for database in target_databases():
+        counts = archive_students(database, query, boundary, args.batch_size)
+        print(f"{database.name}: archived {counts['records']} records of {counts['students']} students "
+              f"from before {boundary.date()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Check read-your-own-write against a running server backed by a replica set.
+
+    python -m scripts.check_causal_reads http://localhost:5000 <student_id> <subject_id>
+
+Writes a random mark with PUT /UpdateExamResult, then immediately reads
+/Student/{id} with the returned X-Causal-Token (which lets the read go to a
+secondary) and fails if the new mark is not visible.
+"""
+import argparse
+import random
+import sys
+
+import requests
+
+from utils.db import CAUSAL_TOKEN_HEADER
+
+
+def check(base_url, student_id, subject_id, rounds):
+    failures = 0
+    result_id = None
+    for _ in range(rounds):
+        marks = random.randint(0, 100)
+        exam = {"subName": subject_id, "marksObtained": marks}
+        if result_id:
+            exam["_id"] = result_id  # update the same record every round
+        response = requests.put(f"{base_url}/UpdateExamResult/{student_id}", json=exam)
+        response.raise_for_status()
+        if not result_id:
+            result_id = next(r["_id"] for r in response.json()["examResult"] if r["subName"] == subject_id)
+        token = response.headers.get(CAUSAL_TOKEN_HEADER)
+        if not token:
+            print("No causal token returned; is MONGO_URL pointing at a replica set?")
+            return 1
+
+        student = requests.get(f"{base_url}/Student/{student_id}", headers={CAUSAL_TOKEN_HEADER: token}).json()
+        seen = next((r["marksObtained"] for r in student["examResult"] if r["_id"] == result_id), None)
+        if seen != marks:
+            failures += 1
+            print(f"stale read: wrote {marks}, read {seen}")
+    print(f"{rounds - failures}/{rounds} reads saw their own write")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify causal reads after exam result updates")
+    parser.add_argument("base_url")
+    parser.add_argument("student_id")
+    parser.add_argument("subject_id")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    sys.exit(check(args.base_url.rstrip("/"), args.student_id, args.subject_id, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
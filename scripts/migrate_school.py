@@ -0,0 +1,210 @@
+"""Move one school's data to another routing target while the app keeps serving it.
+
+    python -m scripts.migrate_school <school_id> <target> [--purge-source]
+
+The target must already be declared in the TENANT_ROUTES table. The tool
+opens a change stream on the source, copies every school-scoped collection in
+batches and replays the writes that happened meanwhile. It then freezes the
+school in the routing table: workers answer its writes with 503 while reads
+go on. Once every worker has picked up the freeze and writes already running
+have finished, the last changes are replayed and the school is switched to the
+new target and unfrozen in one table update, so no write can land on the
+source after the switch and overwrite newer data on the destination. Change
+streams need a replica set; on a standalone server the school is frozen for
+the whole copy instead.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+
+from utils.db import MONGO_URL, TENANT_ROUTES, TENANT_ROUTES_RELOAD, connect
+from utils.deadline import REQUEST_DEADLINE, REQUEST_DEADLINE_EXPENSIVE
+from utils.tenancy import SCHOOL_SCOPED_COLLECTIONS, ClientPool, RoutingTable
+
+
+def school_filter(collection_name, school_id):
+    return {SCHOOL_SCOPED_COLLECTIONS[collection_name]: ObjectId(school_id)}
+
+
+def open_change_stream(source, school_id):
+    school = ObjectId(school_id)
+    # Deletes carry only the _id, so they all pass; apply_change ignores the ones the destination lacks
+    matches = [{"operationType": "delete", "ns.coll": {"$in": list(SCHOOL_SCOPED_COLLECTIONS)}}]
+    for name, field in SCHOOL_SCOPED_COLLECTIONS.items():
+        path = "documentKey._id" if field == "_id" else f"fullDocument.{field}"
+        matches.append({"ns.coll": name, path: school})
+    pipeline = [{"$match": {"$or": matches}}]
+    try:
+        return source.watch(pipeline, full_document="updateLookup")
+    except OperationFailure as e:
+        print(f"Change streams unavailable ({e}); copying without catch-up", file=sys.stderr)
+        return None
+
+
+def copy_indexes(source, destination):
+    for name in SCHOOL_SCOPED_COLLECTIONS:
+        for index_name, info in source[name].index_information().items():
+            if index_name == "_id_":
+                continue
+            options = {k: v for k, v in info.items() if k in ("unique", "sparse", "partialFilterExpression", "collation")}
+            destination[name].create_index(info["key"], name=index_name, **options)
+
+
+def copy_collection(source, destination, school_id, batch_size):
+    copied = 0
+    operations = []
+    for document in source.find(school_filter(source.name, school_id), batch_size=batch_size):
+        operations.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+        if len(operations) >= batch_size:
+            destination.bulk_write(operations, ordered=False)
+            copied += len(operations)
+            operations = []
+    if operations:
+        destination.bulk_write(operations, ordered=False)
+        copied += len(operations)
+    return copied
+
+
+def apply_change(destination, event, school_id):
+    collection_name = event["ns"]["coll"]
+    key = event["documentKey"]["_id"]
+    if event["operationType"] == "delete":
+        # The school of a deleted document is unknown, but _ids are unique so this is harmless
+        return destination[collection_name].delete_one({"_id": key}).deleted_count > 0
+    document = event.get("fullDocument")
+    if document is None or document.get(SCHOOL_SCOPED_COLLECTIONS[collection_name]) != ObjectId(school_id):
+        return False
+    destination[collection_name].replace_one({"_id": key}, document, upsert=True)
+    return True
+
+
+def replay(stream, destination, school_id, quiet_seconds, until=None):
+    """ Apply queued changes until none is applied for quiet_seconds (or until the deadline) """
+    applied = 0
+    last_applied = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if until is not None and now >= until:
+            return applied
+        if until is None and now - last_applied >= quiet_seconds:
+            return applied
+        event = stream.try_next()
+        if event is None:
+            time.sleep(0.1)
+            continue
+        if apply_change(destination, event, school_id):
+            applied += 1
+            last_applied = time.monotonic()
+
+
+def write_route(path, school_id, target=None, frozen=False):
+    """ Route school_id to target (when given) and freeze or unfreeze its writes, in one table update """
+    config = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+    if target is not None:
+        config.setdefault("schools", {})[school_id] = target
+    frozen_schools = [school for school in config.get("frozen", []) if school != school_id]
+    if frozen:
+        frozen_schools.append(school_id)
+    if frozen_schools:
+        config["frozen"] = frozen_schools
+    else:
+        config.pop("frozen", None)
+    # Write next to the table and rename, so workers never read a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def freeze(routes_path, school_id, stream, destination, drain_seconds, quiet_seconds):
+    """ Stop the school's writes and wait until the ones already running are replayed """
+    write_route(routes_path, school_id, frozen=True)
+    # Workers re-read the table every TENANT_ROUTES_RELOAD seconds; a write admitted just before
+    # may run for up to its deadline
+    until = time.monotonic() + 2 * TENANT_ROUTES_RELOAD + drain_seconds
+    print(f"Froze writes of {school_id} for up to {until - time.monotonic():.0f} s")
+    if stream is None:
+        time.sleep(max(until - time.monotonic(), 0))
+        return
+    applied = replay(stream, destination, school_id, quiet_seconds, until)
+    applied += replay(stream, destination, school_id, quiet_seconds)
+    print(f"Replayed {applied} changes while frozen")
+
+
+def migrate(school_id, target, routes_path, batch_size=1000, quiet_seconds=2.0, purge_source=False,
+            drain_seconds=None):
+    default_database = connect()
+    pool = ClientPool()
+    pool.add(MONGO_URL, default_database.client)
+    table = RoutingTable(routes_path, MONGO_URL, default_database.name, pool, reload_interval=0)
+    source_name = table.target_name_for(school_id)
+    if source_name == target:
+        print(f"School {school_id} already lives on {target}")
+        return
+    source = table.database_for_target(source_name)
+    destination = table.database_for_target(target)
+    if drain_seconds is None:
+        drain_seconds = max(REQUEST_DEADLINE, REQUEST_DEADLINE_EXPENSIVE)
+
+    stream = open_change_stream(source, school_id)
+    try:
+        copy_indexes(source, destination)
+        if stream is None:
+            # Nothing can catch up with writes made during the copy: keep them out
+            freeze(routes_path, school_id, stream, destination, drain_seconds, quiet_seconds)
+        for name in SCHOOL_SCOPED_COLLECTIONS:
+            copied = copy_collection(source[name], destination[name], school_id, batch_size)
+            print(f"{name}: copied {copied} documents")
+
+        if stream is not None:
+            print(f"Caught up {replay(stream, destination, school_id, quiet_seconds)} changes")
+            freeze(routes_path, school_id, stream, destination, drain_seconds, quiet_seconds)
+    except BaseException:
+        write_route(routes_path, school_id, frozen=False)
+        raise
+    finally:
+        if stream is not None:
+            stream.close()
+
+    write_route(routes_path, school_id, target, frozen=False)
+    print(f"Routing {school_id}: {source_name} -> {target}")
+
+    if purge_source:
+        # Workers still on the old table keep reading the source (and refuse writes) until they reload
+        time.sleep(2 * TENANT_ROUTES_RELOAD)
+        for name in SCHOOL_SCOPED_COLLECTIONS:
+            deleted = source[name].delete_many(school_filter(name, school_id)).deleted_count
+            print(f"{name}: removed {deleted} documents from {source_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move one school to another database target")
+    parser.add_argument("school_id")
+    parser.add_argument("target", help="target name from the routing table")
+    parser.add_argument("--routes", default=TENANT_ROUTES, help="routing table path (defaults to TENANT_ROUTES)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--quiet-seconds", type=float, default=2.0,
+                        help="how long the change stream must stay idle before switching")
+    parser.add_argument("--drain-seconds", type=float, default=None,
+                        help="how long writes running when the freeze starts may take "
+                             "(defaults to the longest request deadline)")
+    parser.add_argument("--purge-source", action="store_true", help="delete the school from the old target afterwards")
+    args = parser.parse_args()
+    if not args.routes:
+        parser.error("no routing table: pass --routes or set TENANT_ROUTES")
+    migrate(args.school_id, args.target, args.routes, args.batch_size, args.quiet_seconds, args.purge_source,
+            args.drain_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Back up or restore all data of one school.
+
+    python -m scripts.school_backup backup <school_id> <directory> [--workers 8] [--batch-size 1000]
+    python -m scripts.school_backup restore <school_id> <directory> [--workers 8] [--drop]
+
+A backup is a directory <directory>/<school_id>/ with one folder per
+school-scoped collection (admins, sclasses, subjects, students, teachers,
+notices, complains, studentArchive). Each folder holds gzip-compressed parts of
+raw BSON documents in _id order, the format of mongodump, so `bsondump` can read
+an uncompressed part. Collections are processed by parallel workers.
+manifest.json records every finished part; an interrupted backup or restore
+continues where it stopped when the same command is run again.
+
+The school is read from and restored into the database it is routed to
+(TENANT_ROUTES). Writes made while a backup runs may or may not be included.
+"""
+import argparse
+import gzip
+import os
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import bson
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from utils.db import ensure_indexes, get_database
+from utils.tenancy import SCHOOL_SCOPED_COLLECTIONS, current_school
+
+MANIFEST = "manifest.json"
+RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+def school_filter(collection_name, school_id):
+    return {SCHOOL_SCOPED_COLLECTIONS[collection_name]: ObjectId(school_id)}
+
+
+def part_path(directory, collection_name, number):
+    return os.path.join(directory, collection_name, f"{number:06d}.bson.gz")
+
+
+def scan_batch(batch: bytes):
+    """ Number of documents in a raw batch and its last document; only that one is decoded
+    (every BSON document starts with its int32 length) """
+    offset = count = 0
+    while True:
+        length = struct.unpack_from("<i", batch, offset)[0]
+        count += 1
+        if offset + length >= len(batch):
+            return count, bson.decode(batch[offset:offset + length])
+        offset += length
+
+
+def write_atomically(path, data: bytes):
+    # Write next to the target and rename, so a crash never leaves a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class Manifest:
+    """ Checkpoints shared by the workers: one section per collection, saved after every part """
+
+    def __init__(self, directory, school_id):
+        self.path = os.path.join(directory, MANIFEST)
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json_util.loads(f.read())
+        else:
+            self.data = {"school": school_id, "createdAt": datetime.now(), "complete": False,
+                         "collections": {}, "restore": {}}
+
+    def section(self, key, collection_name, default):
+        with self.lock:
+            return dict(self.data[key].setdefault(collection_name, default))
+
+    def update(self, key, collection_name, **values):
+        with self.lock:
+            self.data[key][collection_name].update(values)
+            self.save()
+
+    def set(self, **values):
+        with self.lock:
+            self.data.update(values)
+            self.save()
+
+    def save(self):
+        write_atomically(self.path, json_util.dumps(self.data, indent=2).encode())
+
+
+def backup_collection(collection, directory, school_id, manifest, batch_size, level):
+    state = manifest.section("collections", collection.name, {"parts": 0, "documents": 0, "lastId": None, "complete": False})
+    if state["complete"]:
+        return state
+    os.makedirs(os.path.join(directory, collection.name), exist_ok=True)
+    query = school_filter(collection.name, school_id)
+    if state["lastId"] is not None:
+        query["_id"] = {"$gt": state["lastId"]}
+    # Raw batches go to disk as they come from the server, without decoding the documents
+    for batch in collection.find_raw_batches(query, sort=[("_id", 1)], batch_size=batch_size):
+        if not batch:
+            continue
+        count, last = scan_batch(batch)
+        write_atomically(part_path(directory, collection.name, state["parts"] + 1), gzip.compress(batch, level))
+        state.update(parts=state["parts"] + 1, documents=state["documents"] + count, lastId=last["_id"])
+        manifest.update("collections", collection.name, **state)
+    state["complete"] = True
+    manifest.update("collections", collection.name, **state)
+    return state
+
+
+def restore_collection(collection, directory, school_id, manifest, drop):
+    backup = manifest.section("collections", collection.name, {})
+    state = manifest.section("restore", collection.name, {"parts": 0, "documents": 0})
+    if drop and state["parts"] == 0:
+        collection.delete_many(school_filter(collection.name, school_id))
+    for number in range(state["parts"] + 1, backup["parts"] + 1):
+        with open(part_path(directory, collection.name, number), "rb") as f:
+            documents = bson.decode_all(gzip.decompress(f.read()), RAW)
+        # Upserts by _id: restoring a part twice after an interruption changes nothing
+        try:
+            collection.bulk_write([ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+                                   for document in documents], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            raise SystemExit(f"{collection.name} part {number}: {len(errors)} documents rejected, "
+                             f"first: {errors[0].get('errmsg') if errors else e}")
+        state.update(parts=number, documents=state["documents"] + len(documents))
+        manifest.update("restore", collection.name, **state)
+    return state
+
+
+def run(command, school_id, directory, workers, batch_size=1000, drop=False, level=6):
+    directory = os.path.join(directory, school_id)
+    os.makedirs(directory, exist_ok=True)
+    manifest = Manifest(directory, school_id)
+    if command == "backup" and manifest.data["complete"]:
+        raise SystemExit(f"{directory} already holds a complete backup, choose another directory")
+    if command == "restore" and not manifest.data["complete"]:
+        raise SystemExit(f"The backup in {directory} is incomplete, run the backup again first")
+    # Resolve the school's database here: context variables do not reach the worker threads
+    current_school.set(school_id)
+    database = get_database()
+    if command == "restore":
+        ensure_indexes()
+
+    def task(name):
+        if command == "backup":
+            return name, backup_collection(database[name], directory, school_id, manifest, batch_size, level)
+        return name, restore_collection(database[name], directory, school_id, manifest, drop)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, state in executor.map(task, SCHOOL_SCOPED_COLLECTIONS):
+            print(f"{name}: {state['documents']} documents in {state['parts']} parts")
+    if command == "backup":
+        manifest.set(complete=True, completedAt=datetime.now())
+    else:
+        # Done: a later restore from the same backup starts from scratch
+        manifest.set(restore={})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up or restore one school")
+    parser.add_argument("command", choices=["backup", "restore"])
+    parser.add_argument("school_id")
+    parser.add_argument("directory")
+    parser.add_argument("--workers", type=int, default=len(SCHOOL_SCOPED_COLLECTIONS),
+                        help="collections processed in parallel")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per part (backup)")
+    parser.add_argument("--level", type=int, default=6, help="gzip level 1-9 (backup)")
+    parser.add_argument("--drop", action="store_true",
+                        help="delete the school's current documents before restoring")
+    args = parser.parse_args()
+    if not ObjectId.is_valid(args.school_id):
+        parser.error("invalid school id")
+    run(args.command, args.school_id, args.directory, args.workers, args.batch_size, args.drop, args.level)
+
+
+if __name__ == "__main__":
+    main()
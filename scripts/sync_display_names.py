@@ -0,0 +1,32 @@
+"""Rewrite the class, school and subject names copied into student documents.
+
+    python -m scripts.sync_display_names [--school <school_id>]
+
+Run it once after deploying the denormalized names, to backfill documents
+written before them. After that, run it whenever subjects, classes or schools
+are renamed outside the API, unless the app runs with
+DISPLAY_NAME_CHANGE_STREAM=1. Only stale copies are written, so repeated runs
+are cheap.
+"""
+import argparse
+
+from bson import ObjectId
+
+from utils.db import target_databases
+from utils.display_names import sync_display_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync denormalized display names")
+    parser.add_argument("--school", help="only this school (admin id)")
+    args = parser.parse_args()
+
+    school_id = ObjectId(args.school) if args.school else None
+    for database in target_databases():
+        modified = sync_display_names(database, school_id)
+        summary = ", ".join(f"{name}: {count}" for name, count in modified.items())
+        print(f"{database.name}: students updated per source ({summary})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Production entry point: several uvicorn workers with uvloop and httptools.
+
+    python serve.py
+
+Each worker builds its own Mongo clients in the app lifespan (after the
+worker process starts) and pings the database before it accepts traffic. On
+SIGTERM uvicorn stops accepting connections and lets in-flight requests
+finish for up to GRACEFUL_TIMEOUT seconds before the clients are closed.
+
+With more than one worker NOTICE_CHANGE_STREAM defaults to 1: notice events
+are otherwise only delivered to /NoticeStream clients of the worker that
+handled the write. Setting it to 0 explicitly refuses to start.
+
+Environment: HOST (0.0.0.0), PORT (5000), WEB_WORKERS (CPU count),
+GRACEFUL_TIMEOUT (30), KEEP_ALIVE (5), ACCESS_LOG (0).
+"""
+import importlib.util
+import os
+import sys
+
+import uvicorn
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    workers = int(os.environ.get("WEB_WORKERS") or os.cpu_count() or 1)
+    if workers > 1:
+        # Read by the workers when they import the app
+        os.environ.setdefault("NOTICE_CHANGE_STREAM", "1")
+        if os.environ["NOTICE_CHANGE_STREAM"] != "1":
+            sys.exit("NOTICE_CHANGE_STREAM=0 with several workers: /NoticeStream clients would miss notices "
+                     "posted through other workers. Unset it or set WEB_WORKERS=1.")
+    # uvloop does not exist on Windows; fall back to asyncio/h11 there
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "5000")),
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_graceful_shutdown=int(os.environ.get("GRACEFUL_TIMEOUT", "30")),
+        timeout_keep_alive=int(os.environ.get("KEEP_ALIVE", "5")),
+        access_log=os.environ.get("ACCESS_LOG", "0") == "1",
+    )
+
+
+if __name__ == "__main__":
+    main()
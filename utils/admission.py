@@ -0,0 +1,215 @@
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from utils.cache import TTLCache
+from utils.db import target_databases
+from utils.routes import match_route, school_of
+
+# Routes that scan or rewrite a whole school/class get their own, much smaller per-school limit
+EXPENSIVE_ROUTES = {
+    ("GET", "/Students/{school_id}"),
+    ("DELETE", "/Students/{school_id}"),
+    ("DELETE", "/StudentsClass/{class_id}"),
+    ("DELETE", "/Teachers/{school_id}"),
+    ("DELETE", "/TeachersClass/{class_id}"),
+    ("DELETE", "/Sclass/{id}"),
+    ("DELETE", "/Sclasses/{school_id}"),
+    ("DELETE", "/Subject/{subject_id}"),
+    ("DELETE", "/Subjects/{school_id}"),
+    ("DELETE", "/SubjectsClass/{class_id}"),
+    ("DELETE", "/Notices/{school_id}"),
+    ("DELETE", "/RemoveAllStudentsSubAtten/{school_id}"),
+    ("DELETE", "/RemoveAllStudentsAtten/{subject_id}"),
+    ("GET", "/ExportMarks/{school_id}"),
+    ("GET", "/ExportMarksClass/{class_id}"),
+    ("GET", "/ExportAttendance/{school_id}"),
+    ("GET", "/ExportAttendanceClass/{class_id}"),
+    ("GET", "/AbsenceReport/{school_id}"),
+    ("GET", "/AbsenceReportClass/{class_id}"),
+}
+
+# Long-lived routes (streams) that must not hold a slot
+EXEMPT_ROUTES = {
+    ("GET", "/NoticeStream/{school_id}"),
+}
+
+# Path params naming a school's document: requests addressed only by such an id
+# (e.g. DELETE /SubjectsClass/{class_id}) are limited under the school owning it
+OWNER_PARAMS = {
+    "class_id": "sclasses",
+    "sclass_id": "sclasses",
+    "id": "sclasses",
+    "subject_id": "subjects",
+    "student_id": "students",
+    "teacher_id": "teachers",
+    "notice_id": "notices",
+}
+ADMISSION_OWNER_TTL = float(os.environ.get("ADMISSION_OWNER_TTL", "300"))
+
+# (collection, id) -> owning school id, "" when the document is unknown
+owners = TTLCache(ADMISSION_OWNER_TTL, max_entries=10000)
+
+
+def lookup_owner(collection_name: str, document_id: str) -> Optional[str]:
+    try:
+        key = ObjectId(document_id)
+    except (InvalidId, TypeError):
+        return None
+    for database in target_databases():
+        document = database[collection_name].find_one({"_id": key}, {"school": 1})
+        if document is not None and document.get("school") is not None:
+            return str(document["school"])
+    return None
+
+
+def owner_param(path_params: dict) -> Optional[Tuple[str, str]]:
+    """ The (name, value) path param naming a school's document, if the route has one """
+    for name, value in path_params.items():
+        if name in OWNER_PARAMS:
+            return name, value
+    return None
+
+
+async def owner_of(name: str, value: str) -> Optional[str]:
+    """ School owning the document named by path param `name` (cached lookup in every routing
+    target); None when the document is unknown or MongoDB did not answer """
+    collection_name = OWNER_PARAMS[name]
+    owner = owners.get((collection_name, value))
+    if owner is None:
+        try:
+            owner = await asyncio.to_thread(lookup_owner, collection_name, value) or ""
+        except PyMongoError:
+            return None  # not cached: retried once Mongo answers again
+        owners.set((collection_name, value), owner)
+    return owner or None
+
+
+async def resolve_school(scope: Scope) -> Optional[str]:
+    """ The school owning the document in the path, else school_of(scope) """
+    param = owner_param(match_route(scope)[1])
+    if param is None:
+        return school_of(scope)
+    # Unknown ids still get a limit of their own
+    return await owner_of(*param) or school_of(scope) or "{}:{}".format(*param)
+
+
+class Limiter:
+    """ Concurrency limit with a bounded queue of waiters """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.semaphore.locked():
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    @property
+    def idle(self):
+        return self.active == 0 and self.waiting == 0
+
+
+class AdmissionControlMiddleware:
+    """ Per-school and global concurrency limits with fast rejection.
+
+    A school over its limit gets 429, a worker over its global limit gets 503,
+    both with Retry-After, instead of queueing without bound. Requests
+    addressed only by a class/subject/student/... id count against the school
+    owning that document. Limits are per worker process and configured
+    through the environment:
+
+        ADMISSION_MAX_IN_FLIGHT      global in-flight requests (default 64)
+        ADMISSION_SCHOOL_READ        per-school GET requests (default 8)
+        ADMISSION_SCHOOL_WRITE       per-school other requests (default 4)
+        ADMISSION_SCHOOL_EXPENSIVE   per-school EXPENSIVE_ROUTES requests (default 1)
+        ADMISSION_QUEUE_DEPTH        waiters allowed per limit (default 8)
+        ADMISSION_QUEUE_TIMEOUT      seconds a waiter may queue (default 2)
+        ADMISSION_RETRY_AFTER        Retry-After value in seconds (default 1)
+        ADMISSION_OWNER_TTL          seconds a document's owning school is cached (default 300)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.queue_depth = int(os.environ.get("ADMISSION_QUEUE_DEPTH", "8"))
+        self.queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2"))
+        self.retry_after = os.environ.get("ADMISSION_RETRY_AFTER", "1")
+        self.school_limits = {
+            "read": int(os.environ.get("ADMISSION_SCHOOL_READ", "8")),
+            "write": int(os.environ.get("ADMISSION_SCHOOL_WRITE", "4")),
+            "expensive": int(os.environ.get("ADMISSION_SCHOOL_EXPENSIVE", "1")),
+        }
+        self.global_limiter = Limiter(int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "64")), self.queue_depth)
+        self.school_limiters: Dict[Tuple[str, str], Limiter] = {}
+
+    def route_class(self, method: str, route: Optional[str]) -> str:
+        if (method, route) in EXPENSIVE_ROUTES:
+            return "expensive"
+        return "read" if method in ("GET", "HEAD") else "write"
+
+    def reject(self, status_code: int, detail: str):
+        return JSONResponse({"detail": detail}, status_code=status_code, headers={"Retry-After": self.retry_after})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        route = match_route(scope)[0]
+        if route is None or (scope["method"], route) in EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        school_limiter = None
+        school_id = await resolve_school(scope)
+        if school_id:
+            key = (school_id, self.route_class(scope["method"], route))
+            school_limiter = self.school_limiters.get(key)
+            if school_limiter is None:
+                school_limiter = Limiter(self.school_limits[key[1]], self.queue_depth)
+                self.school_limiters[key] = school_limiter
+            if not await school_limiter.acquire(self.queue_timeout):
+                self._discard_if_idle(key, school_limiter)
+                await self.reject(429, "Too many concurrent requests for this school")(scope, receive, send)
+                return
+
+        try:
+            if not await self.global_limiter.acquire(self.queue_timeout):
+                await self.reject(503, "Server is overloaded")(scope, receive, send)
+                return
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.global_limiter.release()
+        finally:
+            if school_limiter is not None:
+                school_limiter.release()
+                self._discard_if_idle(key, school_limiter)
+
+    def _discard_if_idle(self, key, limiter: Limiter):
+        # Drop limiters nobody holds, so the table only tracks currently busy schools
+        if limiter.idle and self.school_limiters.get(key) is limiter:
+            del self.school_limiters[key]
@@ -0,0 +1,102 @@
+""" Cold storage for the attendance and exam records of past terms.
+
+Each student document keeps the current term only. Older records are moved to
+the `studentArchive` collection, one document per student and term, in the
+same layout as the student (`attendance`, `attendanceBits`, `examResult`), so
+utils.attendance_bits.expand_attendance reads both. The collection is created
+with zstd block compression (ARCHIVE_COMPRESSOR). `/Student/{id}?history=true`
+merges it back.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+
+from utils.attendance_bits import term_start
+from utils.db import ARCHIVE_COLLECTION, create_collection
+
+ARCHIVED_ARRAYS = ("attendance", "attendanceBits", "examResult")
+STUDENT_PROJECTION = {"school": 1, "sclassName": 1, **{array: 1 for array in ARCHIVED_ARRAYS}}
+
+
+def split_terms(student: dict, boundary: datetime, class_subjects: Optional[set]) -> Dict[datetime, Dict[str, list]]:
+    """ Records of `student` from before `boundary`, grouped by term
+
+    Exam results carry no date: a result is archived when its subject no longer
+    belongs to the student's class, and is filed under the last archived term.
+    """
+    terms: Dict[datetime, Dict[str, list]] = {}
+
+    def add(term, array, item):
+        terms.setdefault(term, {}).setdefault(array, []).append(item)
+
+    for record in student.get("attendance") or []:
+        if isinstance(record.get("date"), datetime) and record["date"] < boundary:
+            add(term_start(record["date"]), "attendance", record)
+    for entry in student.get("attendanceBits") or []:
+        if entry["term"] < boundary:
+            add(entry["term"], "attendanceBits", entry)
+    if class_subjects:
+        last_term = term_start(boundary - timedelta(days=1))
+        for result in student.get("examResult") or []:
+            if result.get("subName") not in class_subjects:
+                add(last_term, "examResult", result)
+    return terms
+
+
+def archive_student(students, archive, student: dict, boundary: datetime, class_subjects: Optional[set]) -> int:
+    """ Copy the old records to the archive, then pull exactly those elements from the student
+
+    $addToSet makes a rerun after an interruption harmless, and pulling by value
+    leaves records changed in the meantime in place (a later run archives them).
+    """
+    terms = split_terms(student, boundary, class_subjects)
+    moved: Dict[str, list] = {}
+    for term, arrays in sorted(terms.items()):
+        archive.update_one(
+            {"student": student["_id"], "term": term},
+            {"$setOnInsert": {"school": student.get("school")},
+             "$set": {"archivedAt": datetime.now()},
+             "$addToSet": {array: {"$each": items} for array, items in arrays.items()}},
+            upsert=True,
+        )
+        for array, items in arrays.items():
+            moved.setdefault(array, []).extend(items)
+    if moved:
+        students.update_one({"_id": student["_id"]}, {"$pull": {array: {"$in": items} for array, items in moved.items()}})
+    return sum(len(items) for items in moved.values())
+
+
+def archive_students(database, query: dict, boundary: datetime, batch_size: int = 500) -> Dict[str, int]:
+    """ Archive every student matching `query`; boundary is rounded down to a term start """
+    boundary = term_start(boundary)
+    archive = create_collection(database, ARCHIVE_COLLECTION)
+    students = database["students"]
+    class_subjects: Dict[ObjectId, set] = {}
+    subject_query = {"school": query["school"]} if "school" in query else {}
+    for subject in database["subjects"].find(subject_query, {"sclassName": 1}):
+        class_subjects.setdefault(subject.get("sclassName"), set()).add(subject["_id"])
+
+    old = {"$or": [{"attendance.date": {"$lt": boundary}}, {"attendanceBits.term": {"$lt": boundary}},
+                   {"examResult.0": {"$exists": True}}]}
+    counts = {"students": 0, "records": 0}
+    for student in students.find({**query, **old}, STUDENT_PROJECTION, batch_size=batch_size):
+        moved = archive_student(students, archive, student, boundary, class_subjects.get(student.get("sclassName")))
+        if moved:
+            counts["students"] += 1
+            counts["records"] += moved
+    return counts
+
+
+def read_history(archive, student_id: ObjectId, session=None) -> List[dict]:
+    """ Archived terms of one student, oldest first """
+    return list(archive.find({"student": student_id}, {"term": 1, **{array: 1 for array in ARCHIVED_ARRAYS}},
+                             session=session).sort("term", 1))
+
+
+def merge_history(student: dict, history: List[dict]):
+    """ Put the archived records in front of the live ones """
+    for array in ARCHIVED_ARRAYS:
+        archived = [item for term in history for item in term.get(array) or []]
+        if archived:
+            student[array] = archived + list(student.get(array) or [])
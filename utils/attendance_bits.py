@@ -0,0 +1,181 @@
+""" Compact attendance storage: one pair of bitsets per student, subject and term.
+
+With ATTENDANCE_FORMAT=bitmap, update_student_attendance stores attendance in
+student.attendanceBits instead of one subdocument per lesson in
+student.attendance:
+
+    {"subName": <subject id>, "term": <first day of the term>,
+     "recorded": <bits>, "present": <bits>, "subjectInfo": {...}}
+
+Bit i (byte i // 8, mask 1 << (i % 8)) is day i counted from the term start
+in calendar days. "recorded" marks days with attendance taken and "present"
+holds the status. A full year per subject takes 2 x 46 bytes, compared with
+about 80 bytes per lesson for a record. Only the Present/Absent statuses are
+encodable; anything else stays a record.
+
+Reads expand both layouts into the usual record list (expand_attendance), so
+API responses do not change. Record ids in the expanded list are synthetic
+(day timestamp + subject id tail). Editing such a record moves its bit.
+Existing records of a student are converted the first time their attendance
+is written in bitmap mode.
+"""
+import base64
+import os
+import struct
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bson import Binary, ObjectId
+
+# "records" (one subdocument per lesson, the original layout) or "bitmap"
+ATTENDANCE_FORMAT = os.environ.get("ATTENDANCE_FORMAT", "records")
+# Terms (school years) start on the 1st of this month
+TERM_START_MONTH = int(os.environ.get("TERM_START_MONTH", "9"))
+
+STATUSES = {"Present": True, "Absent": False}
+TERM_DAYS = 366
+TERM_BYTES = (TERM_DAYS + 7) // 8
+
+
+def bitmap_enabled() -> bool:
+    return ATTENDANCE_FORMAT == "bitmap"
+
+
+def _day(value) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def term_start(day) -> datetime:
+    day = _day(day)
+    year = day.year if day.month >= TERM_START_MONTH else day.year - 1
+    return datetime(year, TERM_START_MONTH, 1)
+
+
+def record_id(subject_id: ObjectId, day) -> ObjectId:
+    """ Stable id of one expanded record: the day's timestamp followed by the subject id tail """
+    seconds = int(datetime.combine(_day(day), time(), timezone.utc).timestamp())
+    return ObjectId(struct.pack(">I", seconds) + subject_id.binary[4:])
+
+
+def _find_entry(entries: List[dict], subject_id: ObjectId, start: datetime) -> Optional[dict]:
+    for entry in entries:
+        if entry["subName"] == subject_id and entry["term"] == start:
+            return entry
+    return None
+
+
+def set_day(entries: List[dict], subject_id: ObjectId, day, status: str) -> bool:
+    """ Record one lesson; False when the status cannot be stored as a bit """
+    if status not in STATUSES:
+        return False
+    start = term_start(day)
+    entry = _find_entry(entries, subject_id, start)
+    if entry is None:
+        entry = {"subName": subject_id, "term": start,
+                 "recorded": Binary(bytes(TERM_BYTES)), "present": Binary(bytes(TERM_BYTES))}
+        entries.append(entry)
+    index = (_day(day) - start.date()).days
+    byte, mask = index >> 3, 1 << (index & 7)
+    recorded, present = bytearray(entry["recorded"]), bytearray(entry["present"])
+    recorded[byte] |= mask
+    if STATUSES[status]:
+        present[byte] |= mask
+    else:
+        present[byte] &= ~mask
+    entry["recorded"], entry["present"] = Binary(bytes(recorded)), Binary(bytes(present))
+    return True
+
+
+def clear_record(entries: List[dict], attendance_id: ObjectId) -> bool:
+    """ Remove the lesson behind a synthetic record id (see record_id) """
+    seconds = struct.unpack(">I", attendance_id.binary[:4])[0]
+    day = datetime.fromtimestamp(seconds, timezone.utc).date()
+    start = term_start(day)
+    for entry in entries:
+        if entry["term"] == start and entry["subName"].binary[4:] == attendance_id.binary[4:]:
+            index = (day - start.date()).days
+            byte, mask = index >> 3, 1 << (index & 7)
+            recorded, present = bytearray(entry["recorded"]), bytearray(entry["present"])
+            if not recorded[byte] & mask:
+                return False
+            recorded[byte] &= ~mask
+            present[byte] &= ~mask
+            entry["recorded"], entry["present"] = Binary(bytes(recorded)), Binary(bytes(present))
+            return True
+    return False
+
+
+def decode_entry(entry: dict) -> Iterator[dict]:
+    start = entry["term"]
+    recorded, present = bytes(entry["recorded"]), bytes(entry["present"])
+    subject_id, info = entry["subName"], entry.get("subjectInfo")
+    # record_id() inlined: the id only differs in the leading timestamp
+    tail = subject_id.binary[4:]
+    start_seconds = int(start.replace(tzinfo=timezone.utc).timestamp())
+    for byte_index, bits in enumerate(recorded):
+        if not bits:
+            continue
+        for bit in range(8):
+            if bits & (1 << bit):
+                index = byte_index * 8 + bit
+                record = {
+                    "_id": ObjectId(struct.pack(">I", start_seconds + index * 86400) + tail),
+                    "date": start + timedelta(days=index),
+                    "status": "Present" if present[byte_index] & (1 << bit) else "Absent",
+                    "subName": subject_id,
+                }
+                if info is not None:
+                    record["subjectInfo"] = info
+                yield record
+
+
+def expand_attendance(student: dict) -> List[dict]:
+    """ Records in the original layout, whichever way they are stored """
+    records = list(student.get("attendance") or [])
+    for entry in student.get("attendanceBits") or []:
+        records.extend(decode_entry(entry))
+    return records
+
+
+def compact_attendance(student: dict) -> Tuple[List[dict], List[dict]]:
+    """ Move every encodable record into bitsets; returns (remaining records, bitsets) """
+    entries = list(student.get("attendanceBits") or [])
+    bits = {(entry["subName"], entry["term"]): (bytearray(entry["recorded"]), bytearray(entry["present"]), entry)
+            for entry in entries}
+    remaining = []
+    for record in student.get("attendance") or []:
+        subject_id, day, status = record.get("subName"), record.get("date"), record.get("status")
+        if not (isinstance(subject_id, ObjectId) and day and status in STATUSES):
+            remaining.append(record)
+            continue
+        start = term_start(day)
+        key = (subject_id, start)
+        if key not in bits:
+            entry = {"subName": subject_id, "term": start}
+            entries.append(entry)
+            bits[key] = (bytearray(TERM_BYTES), bytearray(TERM_BYTES), entry)
+        recorded, present, entry = bits[key]
+        # Carry the subject name copy over (utils/display_names)
+        if "subjectInfo" in record and "subjectInfo" not in entry:
+            entry["subjectInfo"] = record["subjectInfo"]
+        index = (_day(day) - start.date()).days
+        byte, mask = index >> 3, 1 << (index & 7)
+        recorded[byte] |= mask
+        if STATUSES[status]:
+            present[byte] |= mask
+        else:
+            present[byte] &= ~mask
+    for recorded, present, entry in bits.values():
+        entry["recorded"], entry["present"] = Binary(bytes(recorded)), Binary(bytes(present))
+    return remaining, entries
+
+
+def wire_format(entries: List[dict]) -> List[Dict]:
+    """ Compact response for clients that opt in: the bitsets base64-encoded """
+    return [{
+        "subName": entry["subName"],
+        "subjectInfo": entry.get("subjectInfo"),
+        "term": entry["term"].date().isoformat(),
+        "recorded": base64.b64encode(bytes(entry["recorded"])).decode(),
+        "present": base64.b64encode(bytes(entry["present"])).decode(),
+    } for entry in entries]
@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, List, Optional
+
+
+class TTLCache:
+    """ Small in-process cache whose entries expire after `ttl` seconds.
+
+    Every worker has its own copy, so values can be up to `ttl` seconds stale
+    after a write handled by another worker. When more than `max_entries` keys
+    are stored the least recently used one is dropped. `get_or_set` does not
+    store a value computed while the same key was invalidated.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+        # Bumped by invalidate (per key) and clear (all keys); a load that
+        # started under an older generation is not stored
+        self._generations: "dict[Hashable, int]" = {}
+        self._epoch = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _generation(self, key: Hashable) -> tuple:
+        return self._epoch, self._generations.get(key, 0)
+
+    def get_or_set(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is None:
+            with self._lock:
+                generation = self._generation(key)
+            value = compute()
+            if self.ttl > 0:
+                with self._lock:
+                    if self._generation(key) == generation:
+                        self._store(key, value)
+        return value
+
+    def values(self) -> List[Any]:
+        """ Values that have not expired yet """
+        now = time.monotonic()
+        with self._lock:
+            return [value for expires_at, value in self._entries.values() if expires_at > now]
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._epoch += 1
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.deadline import DEADLINE_HEADER
+from utils.metrics import Counter, Histogram
+from utils.routes import match_route
+from utils.tenancy import SCHOOL_HEADER
+
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1") == "1"
+
+# Read-only routes whose response depends only on the URL and the school header.
+# Routes with per-session semantics (/Student/{student_id} with X-Causal-Token) and streams stay out.
+COALESCED_ROUTES = {
+    "/NoticeList/{school_id}",
+    "/ComplainList/{school_id}",
+    "/SclassList/{school_id}",
+    "/Sclass/{id}",
+    "/Sclass/Students/{id}",
+    "/AllSubjects/{school_id}",
+    "/ClassSubjects/{class_id}",
+    "/FreeSubjectList/{sclass_id}",
+    "/Subject/{subject_id}",
+    "/Students/{school_id}",
+    "/Teachers/{school_id}",
+    "/Teacher/{teacher_id}",
+    "/SchoolSummary/{school_id}",
+    "/ExamStats/{school_id}",
+    "/ExamStatsClass/{class_id}",
+}
+
+coalesced_requests = Counter(
+    "schooldb_coalesced_requests_total",
+    "GET requests on coalesced routes by role: leader (ran the handler), follower (got the leader's "
+    "response) or fallback (waited for a leader whose response could not be shared)",
+    ("route", "role"),
+)
+coalesced_followers = Histogram(
+    "schooldb_coalesced_followers",
+    "Requests served by one leader's response, besides the leader",
+    ("route",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+
+class Flight:
+    """ One running request and the response messages it sent so far """
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.messages: List[Message] = []
+        self.size = 0
+        self.shareable = True
+        self.complete = False
+        self.followers = 0
+
+
+def copy_message(message: Message) -> Message:
+    # Outer middleware (compression, CORS) edit the headers of the messages they forward in place
+    if message["type"] == "http.response.start":
+        return dict(message, headers=list(message.get("headers", [])))
+    return dict(message)
+
+
+class CoalescingMiddleware:
+    """ Single-flight for identical concurrent GET requests on COALESCED_ROUTES.
+
+    While one request (the leader) for a path, query string, X-School-ID and
+    X-Request-Timeout runs, identical requests wait for it and get a copy of
+    its response instead of running the same queries again. Nothing is cached: a request arriving after
+    the leader finished starts a new flight. If the leader fails, answers
+    with a status other than 2xx, or its response is larger than
+    COALESCE_MAX_BYTES, the waiting requests run on their own. Sits outside admission control, so followers take no slot.
+
+        COALESCE_REQUESTS    "0" disables coalescing (default "1")
+        COALESCE_MAX_BYTES   largest response body shared with followers (default 8 MB)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.max_bytes = int(os.environ.get("COALESCE_MAX_BYTES", str(8 * 1024 * 1024)))
+        self.flights: Dict[Tuple[str, bytes, Optional[bytes], Optional[bytes]], Flight] = {}
+
+    @staticmethod
+    def key(scope: Scope) -> Tuple[str, bytes, Optional[bytes], Optional[bytes]]:
+        # A client's own X-Request-Timeout changes the outcome (504 or not), so it is part of the key
+        school = timeout = None
+        for name, value in scope["headers"]:
+            if name == SCHOOL_HEADER.encode():
+                school = value
+            elif name == DEADLINE_HEADER:
+                timeout = value
+        return scope["path"], scope.get("query_string", b""), school, timeout
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        route = match_route(scope)[0]
+        if route not in COALESCED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        key = self.key(scope)
+        flight = self.flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            await flight.done.wait()
+            if flight.complete and flight.shareable:
+                coalesced_requests.inc(route, "follower")
+                for message in flight.messages:
+                    await send(copy_message(message))
+            else:
+                coalesced_requests.inc(route, "fallback")
+                await self.app(scope, receive, send)
+            return
+
+        flight = self.flights[key] = Flight()
+        coalesced_requests.inc(route, "leader")
+
+        async def send_and_record(message: Message):
+            if message["type"] == "http.response.start" and not 200 <= message["status"] < 300:
+                # Errors (404, 429 from admission, 504 deadline, ...) are the leader's own
+                flight.shareable = False
+            if flight.shareable:
+                if message["type"] == "http.response.body":
+                    flight.size += len(message.get("body", b""))
+                    if not message.get("more_body", False):
+                        flight.complete = True
+                if flight.size > self.max_bytes:
+                    flight.shareable = False
+                    flight.messages.clear()
+                else:
+                    flight.messages.append(copy_message(message))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            del self.flights[key]
+            flight.done.set()
+            coalesced_followers.observe(flight.followers, route)
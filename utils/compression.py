@@ -0,0 +1,138 @@
+import os
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # optional dependency, gzip only without it
+    brotli = None
+
+# Already compressed or event streams that must reach the client unbuffered
+UNCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "text/event-stream",
+                        "application/vnd.openxmlformats-officedocument")
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, finish: bool) -> bytes:
+        out = self._compressor.compress(data)
+        # Sync-flush every chunk so streamed data reaches the client as it is produced
+        return out + self._compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliCompressor:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes, finish: bool) -> bytes:
+        out = self._compressor.process(data)
+        return out + (self._compressor.finish() if finish else self._compressor.flush())
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """ Pick br or gzip from an Accept-Encoding header, honouring q-values (br wins ties) """
+    best, best_q = None, 0.0
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("br", "gzip") or (coding == "br" and brotli is None):
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if q > best_q or (q == best_q and coding == "br"):
+            best, best_q = coding, q
+    return best
+
+
+class CompressionMiddleware:
+    """ Negotiated gzip/Brotli compression of responses above a size threshold.
+
+    Bodies sent in several messages (StreamingResponse) are compressed chunk by
+    chunk as they are produced rather than after buffering. Configured through
+    COMPRESSION_MINIMUM_SIZE (bytes, default 1024), GZIP_LEVEL (1-9, default 5)
+    and BROTLI_QUALITY (0-11, default 4).
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.minimum_size = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", "1024"))
+        self.gzip_level = int(os.environ.get("GZIP_LEVEL", "5"))
+        self.brotli_quality = int(os.environ.get("BROTLI_QUALITY", "4"))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressingSend(send, encoding, self))
+
+
+class CompressingSend:
+    """ ASGI send wrapper that decides on the first body message whether to compress """
+
+    def __init__(self, send: Send, encoding: str, config: CompressionMiddleware):
+        self.send = send
+        self.encoding = encoding
+        self.config = config
+        self.start_message: Optional[Message] = None
+        self.compressor = None
+        self.passthrough = False
+
+    def new_compressor(self):
+        if self.encoding == "br":
+            return BrotliCompressor(self.config.brotli_quality)
+        return GzipCompressor(self.config.gzip_level)
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._flush_start()
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            content_type = headers.get("content-type", "")
+            if "content-encoding" in headers or content_type.startswith(UNCOMPRESSIBLE_TYPES) \
+                    or (not more_body and len(body) < self.config.minimum_size):
+                if not content_type.startswith(UNCOMPRESSIBLE_TYPES):
+                    headers.add_vary_header("Accept-Encoding")
+                self.passthrough = True
+                await self._flush_start()
+                await self.send(message)
+                return
+            self.compressor = self.new_compressor()
+            data = self.compressor.compress(body, finish=not more_body)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(data))
+            await self._flush_start()
+        else:
+            data = self.compressor.compress(body, finish=not more_body)
+        if data or not more_body:
+            await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+    async def _flush_start(self):
+        if self.start_message is not None:
+            message, self.start_message = self.start_message, None
+            await self.send(message)
@@ -1,32 +1,313 @@
-from pymongo import MongoClient
-from fastapi import HTTPException
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import CollectionInvalid, OperationFailure
+from pymongo.read_preferences import SecondaryPreferred
+from fastapi import HTTPException, Request, Response
 from dotenv import load_dotenv
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import bson
+import hashlib
+import hmac
+import logging
 import os
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+import re
+from utils.metrics import Gauge
+from utils.tenancy import SCHOOL_SCOPED_COLLECTIONS, ClientPool, RoutingTable, current_school
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # MongoDB client setup
 MONGO_URL = os.environ.get("MONGO_URL")
 GOOGLE_API = os.environ.get("GOOGLE_API")
+# Optional JSON routing table that moves individual schools to their own database/cluster
+TENANT_ROUTES = os.environ.get("TENANT_ROUTES")
+TENANT_ROUTES_RELOAD = float(os.environ.get("TENANT_ROUTES_RELOAD", "5"))
+# Read-only list/report routes may read from secondaries lagging at most this many seconds (driver minimum is 90)
+MONGO_MAX_STALENESS = int(os.environ.get("MONGO_MAX_STALENESS", "90"))
+MONGO_SECONDARY_READS = os.environ.get("MONGO_SECONDARY_READS", "1") == "1"
+
+# Connection pool per client; MONGO_MIN_POOL_SIZE connections are opened before a worker takes traffic
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "10"))
+# Set to 0 to skip the startup ping (benchmarks, offline tooling)
+MONGO_WARM_UP = os.environ.get("MONGO_WARM_UP", "1") == "1"
+# Wire compression offered to the server, in order of preference, e.g. "zstd,snappy,zlib".
+# zstd needs `pip install zstandard`, snappy `pip install python-snappy`; the driver skips unavailable ones
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "")
+# Set to 1 to read get_collection(..., raw=True) as RawBSONDocument instead of dicts. Off by default: on
+# projected documents the C decoder into dicts is faster (python -m benchmarks.bench_raw_bson)
+RAW_BSON_READS = os.environ.get("RAW_BSON_READS", "0") == "1"
+# Set to 0 when indexes are managed outside the app
+MONGO_ENSURE_INDEXES = os.environ.get("MONGO_ENSURE_INDEXES", "1") == "1"
+# Set to 1 to refuse to start when a unique index cannot be built (usually because of existing duplicates)
+MONGO_REQUIRE_UNIQUE_INDEXES = os.environ.get("MONGO_REQUIRE_UNIQUE_INDEXES", "0") == "1"
+
+CAUSAL_TOKEN_HEADER = "X-Causal-Token"
+# Key signing causal tokens; set the same value in every worker/instance, or each one
+# rejects the others' tokens (their reads then go to the primary)
+CAUSAL_TOKEN_SECRET = os.environ.get("CAUSAL_TOKEN_SECRET", "").encode() or os.urandom(32)
+
+# 1 per unique index of INDEXES that ensure_indexes could not build, 0 once it exists
+missing_unique_indexes = Gauge(
+    "schooldb_missing_unique_indexes", "Unique indexes that could not be created at startup",
+    ("database", "collection", "index")
+)
 
-client = MongoClient(MONGO_URL)
-db = client.test
+# pymongo CommandListeners given to every client (request profiling, slow query log); add them before connect()
+command_listeners = []
+
+# Created by connect() in each worker process (after fork), never at import time
+client = None
+db = None
+client_pool = None
+routing = None
+
+secondary_reads = SecondaryPreferred(max_staleness=MONGO_MAX_STALENESS)
+raw_codec_options = CodecOptions(document_class=RawBSONDocument)
+ARCHIVE_COLLECTION = "studentArchive"
+# WiredTiger block compressor of the term archive (utils/archive); other collections keep snappy
+ARCHIVE_COMPRESSOR = os.environ.get("ARCHIVE_COMPRESSOR", "zstd")
+# Collections that need creation options, created before their indexes
+COLLECTION_OPTIONS = {
+    ARCHIVE_COLLECTION: {"storageEngine": {"wiredTiger": {"configString": f"block_compressor={ARCHIVE_COMPRESSOR}"}}},
+}
+# Indexes created at startup on every target: collection -> [(keys, options)]
+# Unique indexes replace the duplicate checks of the registration routes; partial, so that
+# legacy documents without the field do not collide on null
+INDEXES = {
+    "admins": [
+        ([("email", ASCENDING)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}}),
+        # Google sign-ups may leave the school name empty
+        ([("schoolName", ASCENDING)], {"unique": True, "partialFilterExpression": {"schoolName": {"$gt": ""}}}),
+    ],
+    "sclasses": [
+        ([("school", ASCENDING)], {}),
+        ([("school", ASCENDING), ("sclassName", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"sclassName": {"$type": "string"}}}),
+    ],
+    "subjects": [
+        ([("school", ASCENDING)], {}),
+        ([("school", ASCENDING), ("subCode", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"subCode": {"$type": "string"}}}),
+    ],
+    "students": [
+        ([("school", ASCENDING)], {}),
+        # Class lists and exports in roll number order
+        ([("sclassName", ASCENDING), ("rollNum", ASCENDING)], {}),
+        ([("school", ASCENDING), ("rollNum", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {"rollNum": {"$exists": True}}}),
+    ],
+    "teachers": [
+        ([("school", ASCENDING)], {}),
+        ([("email", ASCENDING)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}}),
+    ],
+    "notices": [([("school", ASCENDING), ("date", DESCENDING)], {})],
+    # Newest-first complaint pages: equality on school, range and sort on date, _id breaks ties
+    "complains": [([("school", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)], {})],
+    ARCHIVE_COLLECTION: [
+        ([("school", ASCENDING)], {}),
+        ([("student", ASCENDING), ("term", ASCENDING)], {"unique": True}),
+    ],
+}
+
+# Collection handles per (database, name, secondary, raw), so handlers resolve them with a dict lookup
+_collections = {}
 
 def verify_google_token(token):
+    # google-auth is heavy to import and only needed by the Google login routes
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as google_requests
+
     try:
         idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), GOOGLE_API)
         return idinfo
     except ValueError:
         return None
 
-def get_database():
+def connect():
+    """ Create this process' Mongo clients. Called from the app lifespan; scripts get it lazily """
+    global client, db, client_pool, routing
+    if client is None:
+        client_options = {}
+        if MONGO_COMPRESSORS:
+            client_options["compressors"] = MONGO_COMPRESSORS
+        client_pool = ClientPool(maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+                                 event_listeners=list(command_listeners), **client_options)
+        client = client_pool.get(MONGO_URL)
+        db = client.test
+        if TENANT_ROUTES:
+            routing = RoutingTable(TENANT_ROUTES, MONGO_URL, db.name, client_pool, TENANT_ROUTES_RELOAD)
     return db
 
-def get_collection(collection_name: str):
+def warm_up():
+    """ Ping every target and open MONGO_MIN_POOL_SIZE connections per client up front """
+    connect()
+    if not MONGO_WARM_UP:
+        return
+    if routing is not None:
+        for name in routing.targets():
+            routing.database_for_target(name)
+    for mongo_client in client_pool.clients():
+        # Concurrent pings force the pool to open that many connections now
+        with ThreadPoolExecutor(max_workers=max(MONGO_MIN_POOL_SIZE, 1)) as executor:
+            list(executor.map(lambda _: mongo_client.admin.command("ping"), range(max(MONGO_MIN_POOL_SIZE, 1))))
+
+def target_databases():
+    """ The default database plus every database in the routing table """
+    connect()
+    if routing is None:
+        return [db]
+    return [routing.database_for_target(name) for name in routing.targets()]
+
+def ensure_indexes():
+    """ Create INDEXES on every routing target; a no-op for indexes that already exist """
+    if not MONGO_ENSURE_INDEXES:
+        return
+    missing = []
+    for database in target_databases():
+        for collection_name in COLLECTION_OPTIONS:
+            create_collection(database, collection_name)
+        for collection_name, indexes in INDEXES.items():
+            for keys, options in indexes:
+                index_name = options.get("name") or "_".join(f"{field}_{order}" for field, order in keys)
+                labels = (database.name, collection_name, index_name)
+                try:
+                    database[collection_name].create_index(keys, **options)
+                except OperationFailure:
+                    if not options.get("unique"):
+                        logger.exception("Could not create index %s on %s.%s", keys, database.name, collection_name)
+                        continue
+                    # Typically existing duplicates: without the index nothing stops new ones either
+                    logger.exception("Could not create UNIQUE index %s on %s.%s; duplicates are not prevented "
+                                     "until it exists", keys, database.name, collection_name)
+                    missing_unique_indexes.set(1, *labels)
+                    missing.append(".".join(labels))
+                else:
+                    if options.get("unique"):
+                        missing_unique_indexes.set(0, *labels)
+    if missing and MONGO_REQUIRE_UNIQUE_INDEXES:
+        raise RuntimeError(f"Unique indexes could not be created: {', '.join(missing)}")
+
+def create_collection(database, name: str):
+    """ Create a collection with its COLLECTION_OPTIONS unless it exists; returns the collection """
+    if not database.list_collection_names(filter={"name": name}):
+        try:
+            database.create_collection(name, **COLLECTION_OPTIONS.get(name, {}))
+        except CollectionInvalid:
+            pass  # created concurrently
+        except OperationFailure:
+            logger.exception("Could not create %s.%s with its options", database.name, name)
+    return database[name]
+
+def duplicate_key_fields(details: dict) -> set:
+    """ Fields of the unique index a DuplicateKeyError (error.details) or bulk write error violated """
+    if details.get("keyPattern"):
+        return set(details["keyPattern"])
+    # Servers before 4.4 only name the index: "... index: school_1_rollNum_1 dup key ..."
+    match = re.search(r"index: (\S+)", details.get("errmsg", ""))
+    return set(match.group(1).split("_")[::2]) if match else set()
+
+def close():
+    global client, db, client_pool, routing
+    if client_pool is not None:
+        client_pool.close()
+    _collections.clear()
+    client = db = client_pool = routing = None
+
+def get_database():
+    if client is None:
+        connect()
+    if routing is None:
+        return db
+    return routing.database_for(current_school.get())
+
+def _collection(database, collection_name: str, secondary: bool, raw: bool = False):
+    key = (id(database), collection_name, secondary, raw)
+    collection = _collections.get(key)
+    if collection is None:
+        try:
+            collection = database[collection_name]
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Collection {collection_name} not found")
+        if secondary:
+            collection = collection.with_options(read_preference=secondary_reads)
+        if raw:
+            collection = collection.with_options(codec_options=raw_codec_options)
+        _collections[key] = collection
+    return collection
+
+def get_collection(collection_name: str, secondary: bool = False, raw: bool = False):
+    """ secondary=True lets the read go to a secondary with bounded staleness; raw=True returns
+    RawBSONDocuments (see utils/raw_bson) when RAW_BSON_READS is on """
+    return _collection(get_database(), collection_name, secondary and MONGO_SECONDARY_READS, raw and RAW_BSON_READS)
+
+def prepare_collections(database=None):
+    """ Resolve the collection handles once at startup instead of on the first requests """
+    database = database if database is not None else connect()
+    for name in SCHOOL_SCOPED_COLLECTIONS:
+        _collection(database, name, False)
+        _collection(database, name, MONGO_SECONDARY_READS)
+
+def sign_causal_token(payload: bytes) -> str:
+    return base64.urlsafe_b64encode(hmac.new(CAUSAL_TOKEN_SECRET, payload, hashlib.sha256).digest()).decode()
+
+def encode_causal_token(session):
+    if session.operation_time is None:
+        return None
+    data = {"operationTime": session.operation_time}
+    if session.cluster_time is not None:
+        data["clusterTime"] = session.cluster_time
+    payload = base64.urlsafe_b64encode(bson.encode(data))
+    return f"{payload.decode()}.{sign_causal_token(payload)}"
+
+def decode_causal_token(token):
+    """ The times in a token this server signed, None for a missing, forged or garbled one """
+    if not token:
+        return None
+    payload, _, signature = token.encode("latin-1", "replace").partition(b".")
+    if not hmac.compare_digest(signature, sign_causal_token(payload).encode()):
+        return None
     try:
-        return db[collection_name]
-    except KeyError:
-        raise HTTPException(status_code=404, detail=f"Collection {collection_name} not found")
+        data = bson.decode(base64.urlsafe_b64decode(payload))
+    except (ValueError, bson.errors.BSONError):
+        return None
+    return data if "operationTime" in data else None
+
+def has_causal_token(request: Request) -> bool:
+    """ Whether the request carries a valid token, which makes a secondary read safe """
+    return decode_causal_token(request.headers.get(CAUSAL_TOKEN_HEADER)) is not None
+
+def advance_causal_token(session, token):
+    data = decode_causal_token(token)
+    if data is None:
+        return  # forged or garbled token: fall back to a fresh session
+    try:
+        if "clusterTime" in data:
+            session.advance_cluster_time(data["clusterTime"])
+        session.advance_operation_time(data["operationTime"])
+    except (ValueError, KeyError, TypeError):
+        pass
+
+@contextmanager
+def causal_session(request: Request, response: Response):
+    """ Causally consistent session carried between requests in the X-Causal-Token header.
+
+    Reads made after a write with the token returned by that write see the
+    write, even when they are served by a secondary. Tokens are signed with
+    CAUSAL_TOKEN_SECRET; others are ignored, so a client cannot push arbitrary
+    cluster/operation times into the session.
+    """
+    with get_database().client.start_session(causal_consistency=True) as session:
+        token = request.headers.get(CAUSAL_TOKEN_HEADER)
+        if token:
+            advance_causal_token(session, token)
+        yield session
+        token = encode_causal_token(session)
+        if token:
+            response.headers[CAUSAL_TOKEN_HEADER] = token
 
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from typing import Optional
+
+import pymongo
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.admission import EXEMPT_ROUTES, EXPENSIVE_ROUTES
+from utils.metrics import Counter
+from utils.routes import match_route
+
+# Seconds a request may take; 0 disables deadlines
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "10"))
+REQUEST_DEADLINE_EXPENSIVE = float(os.environ.get("REQUEST_DEADLINE_EXPENSIVE", "60"))
+# Optional client header with its own, shorter budget in seconds
+DEADLINE_HEADER = b"x-request-timeout"
+
+# Responses streamed from a live cursor: a deadline would cut them off halfway
+NO_DEADLINE_ROUTES = EXEMPT_ROUTES | {
+    ("GET", "/ExportMarks/{school_id}"),
+    ("GET", "/ExportMarksClass/{class_id}"),
+    ("GET", "/ExportAttendance/{school_id}"),
+    ("GET", "/ExportAttendanceClass/{class_id}"),
+}
+
+deadlines_exceeded = Counter(
+    "schooldb_deadline_exceeded_total", "Requests answered with 504 because their deadline passed", ("route",)
+)
+
+
+def is_deadline_error(error: BaseException) -> bool:
+    """ Errors pymongo raises once the timeout() budget is spent (client side or server maxTimeMS) """
+    return isinstance(error, PyMongoError) and error.timeout
+
+
+def reraise_deadline(error: BaseException):
+    """ Called first in the handlers' broad `except Exception` blocks, so a deadline still ends in a 504 """
+    if is_deadline_error(error):
+        raise error
+
+
+class DeadlineMiddleware:
+    """ Per-request deadline, enforced in the app and in MongoDB.
+
+    Each request gets REQUEST_DEADLINE seconds (REQUEST_DEADLINE_EXPENSIVE for
+    EXPENSIVE_ROUTES); a client may ask for less with X-Request-Timeout. The
+    budget is put into pymongo.timeout(), so every Mongo operation of the
+    request, including ones in worker threads, is sent with the remaining
+    time as maxTimeMS and fails once it is spent: the server stops working on
+    requests nobody waits for anymore. When the deadline passes before the
+    response has started, the request is cancelled and answered with 504.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def budget(scope: Scope, route: Optional[str]) -> Optional[float]:
+        key = (scope["method"], route)
+        if route is None or key in NO_DEADLINE_ROUTES or REQUEST_DEADLINE <= 0:
+            return None
+        budget = REQUEST_DEADLINE_EXPENSIVE if key in EXPENSIVE_ROUTES else REQUEST_DEADLINE
+        for name, value in scope["headers"]:
+            if name == DEADLINE_HEADER:
+                try:
+                    requested = float(value)
+                except ValueError:
+                    break
+                if requested > 0:
+                    budget = min(budget, requested)
+                break
+        return budget
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        route = match_route(scope)[0]
+        budget = self.budget(scope, route)
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        expired = started = False
+
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        timer = asyncio.get_running_loop().call_later(budget, expire)
+
+        async def send_and_disarm(message: Message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                # Too late for a 504; the body is sent in full
+                started = True
+                timer.cancel()
+            await send(message)
+
+        try:
+            with pymongo.timeout(budget):
+                await self.app(scope, receive, send_and_disarm)
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            task.uncancel()
+            await self.timed_out(route, scope, receive, send)
+        except PyMongoError as e:
+            if not is_deadline_error(e) or started:
+                raise
+            await self.timed_out(route, scope, receive, send)
+        finally:
+            timer.cancel()
+
+    @staticmethod
+    async def timed_out(route: str, scope: Scope, receive: Receive, send: Send):
+        deadlines_exceeded.inc(route)
+        await JSONResponse({"detail": "Request deadline exceeded"}, status_code=504)(scope, receive, send)
@@ -0,0 +1,178 @@
+""" Display names copied into student documents.
+
+Exam results and attendance records reference subjects by id (subName), and a
+student references its class (sclassName) and school. Next to each reference
+the student document keeps a small snapshot of what the UI shows:
+
+    examResult[].subjectInfo / attendance[].subjectInfo  {"subName", "sessions"}
+    attendanceBits[].subjectInfo                         (compact attendance, see utils/attendance_bits)
+    sclassInfo                                           {"sclassName"}
+    schoolInfo                                           {"schoolName"}
+
+The snapshots are written together with the reference, so student reads need
+no lookups. When a subject, class or school changes, sync_* rewrites the
+stale copies (scripts/sync_display_names.py, or live from change streams with
+DISPLAY_NAME_CHANGE_STREAM=1). Documents written before the snapshots existed
+are resolved by fill_display_names with one $in query per collection.
+"""
+import os
+from typing import Dict, Iterable, List, Optional
+
+from bson import ObjectId
+
+from utils.db import target_databases
+from utils.pubsub import ChangeStreamFeed
+
+# Sync the copies as soon as a subject, class or school changes (needs a replica set)
+DISPLAY_NAME_CHANGE_STREAM = os.environ.get("DISPLAY_NAME_CHANGE_STREAM", "0") == "1"
+
+# What GET /Student/{student_id} returns in its nested school/class/subject objects, besides _id;
+# the other fields of those documents are not part of the response (see README)
+SUBJECT_FIELDS = ("subName", "sessions")
+SCLASS_FIELDS = ("sclassName",)
+SCHOOL_FIELDS = ("schoolName",)
+
+RECORD_ARRAYS = ("examResult", "attendance", "attendanceBits")
+
+
+def snapshot(document: Optional[dict], fields) -> Optional[dict]:
+    if document is None:
+        return None
+    return {field: document.get(field) for field in fields}
+
+
+def subject_info(subject: Optional[dict]) -> Optional[dict]:
+    return snapshot(subject, SUBJECT_FIELDS)
+
+
+def sclass_info(sclass: Optional[dict]) -> Optional[dict]:
+    return snapshot(sclass, SCLASS_FIELDS)
+
+
+def school_info(school: Optional[dict]) -> Optional[dict]:
+    return snapshot(school, SCHOOL_FIELDS)
+
+
+def _object_ids(values: Iterable) -> List[ObjectId]:
+    return list({value for value in values if isinstance(value, ObjectId)})
+
+
+def find_infos(collection, ids: Iterable, fields, session=None) -> Dict[ObjectId, dict]:
+    """ Snapshots for many ids with a single $in query """
+    ids = _object_ids(ids)
+    if not ids:
+        return {}
+    projection = {field: 1 for field in fields}
+    return {document["_id"]: snapshot(document, fields)
+            for document in collection.find({"_id": {"$in": ids}}, projection, session=session)}
+
+
+def fill_display_names(students: List[dict], sclasses, subjects, schools=None, session=None,
+                       arrays=RECORD_ARRAYS):
+    """ Add the snapshots missing from (older) student documents, in memory only """
+    classes = find_infos(sclasses, (student.get("sclassName") for student in students
+                                    if "sclassInfo" not in student), SCLASS_FIELDS, session)
+    subject_ids = (record.get("subName") for student in students for array in arrays
+                   for record in student.get(array) or [] if "subjectInfo" not in record)
+    subject_infos = find_infos(subjects, subject_ids, SUBJECT_FIELDS, session)
+    school_infos = {}
+    if schools is not None:
+        school_infos = find_infos(schools, (student.get("school") for student in students
+                                            if "schoolInfo" not in student), SCHOOL_FIELDS, session)
+
+    for student in students:
+        if "sclassInfo" not in student and student.get("sclassName") in classes:
+            student["sclassInfo"] = classes[student["sclassName"]]
+        if "schoolInfo" not in student and student.get("school") in school_infos:
+            student["schoolInfo"] = school_infos[student["school"]]
+        for array in arrays:
+            for record in student.get(array) or []:
+                if "subjectInfo" not in record and record.get("subName") in subject_infos:
+                    record["subjectInfo"] = subject_infos[record["subName"]]
+
+
+def sync_subject(students, subject: dict, session=None) -> int:
+    """ Rewrite the subjectInfo copies of one subject; returns the number of students changed """
+    info = subject_info(subject)
+    modified = 0
+    for array in RECORD_ARRAYS:
+        result = students.update_many(
+            {"school": subject.get("school"),
+             array: {"$elemMatch": {"subName": subject["_id"], "subjectInfo": {"$ne": info}}}},
+            {"$set": {f"{array}.$[record].subjectInfo": info}},
+            array_filters=[{"record.subName": subject["_id"]}],
+            session=session,
+        )
+        modified += result.modified_count
+    return modified
+
+
+def sync_sclass(students, sclass: dict, session=None) -> int:
+    info = sclass_info(sclass)
+    result = students.update_many(
+        {"school": sclass.get("school"), "sclassName": sclass["_id"], "sclassInfo": {"$ne": info}},
+        {"$set": {"sclassInfo": info}},
+        session=session,
+    )
+    return result.modified_count
+
+
+def sync_school(students, school: dict, session=None) -> int:
+    info = school_info(school)
+    result = students.update_many(
+        {"school": school["_id"], "schoolInfo": {"$ne": info}},
+        {"$set": {"schoolInfo": info}},
+        session=session,
+    )
+    return result.modified_count
+
+
+# Source collection -> (fields copied into students, sync function)
+SYNCED_COLLECTIONS = {
+    "subjects": (SUBJECT_FIELDS, sync_subject),
+    "sclasses": (SCLASS_FIELDS, sync_sclass),
+    "admins": (SCHOOL_FIELDS, sync_school),
+}
+
+
+def sync_display_names(database, school_id: Optional[ObjectId] = None) -> Dict[str, int]:
+    """ Bring every copy up to date (also backfills documents without copies) """
+    students = database["students"]
+    modified = {}
+    for collection_name, (fields, sync) in SYNCED_COLLECTIONS.items():
+        query = {}
+        if school_id is not None:
+            query = {"_id": school_id} if collection_name == "admins" else {"school": school_id}
+        projection = {field: 1 for field in fields + ("school",)}
+        modified[collection_name] = sum(sync(students, document)
+                                        for document in database[collection_name].find(query, projection))
+    return modified
+
+
+def change_handler(database, collection_name: str):
+    """ ChangeStreamFeed handler: sync the copies when a copied field changes """
+    fields, sync = SYNCED_COLLECTIONS[collection_name]
+
+    def handle(change):
+        if change["operationType"] == "update":
+            updated = change.get("updateDescription", {}).get("updatedFields", {})
+            if not any(field in updated for field in fields):
+                return
+        elif change["operationType"] != "replace":
+            return
+        document = change.get("fullDocument")
+        if document is not None:
+            sync(database["students"], document)
+
+    return handle
+
+
+def start_change_feeds():
+    feeds = []
+    for database in target_databases():
+        for collection_name in SYNCED_COLLECTIONS:
+            feed = ChangeStreamFeed(database[collection_name], change_handler(database, collection_name),
+                                    full_document="updateLookup")
+            feed.start()
+            feeds.append(feed)
+    return feeds
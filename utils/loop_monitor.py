@@ -0,0 +1,137 @@
+""" Event loop lag monitor and blocking call detector.
+
+A task on the loop wakes up every LOOP_LAG_INTERVAL seconds and records how
+late it woke in the schooldb_event_loop_lag_seconds histogram (/metrics). Any
+lag means some callback kept the loop busy: typically a synchronous pymongo
+call or other blocking I/O inside an `async def` handler.
+
+A watchdog thread checks the same heartbeat. When the loop has been stuck
+for LOOP_BLOCK_THRESHOLD seconds, it takes the stack of the loop thread and
+the route of the request whose task is running. Once the loop is free again,
+it logs the stall with its duration as a warning on the
+"schooldb.blocking" logger and counts it in
+schooldb_event_loop_blocked_total. An identical stack on the same route is
+logged at most once every LOOP_BLOCK_LOG_INTERVAL seconds, but every
+occurrence is counted.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from utils.cache import TTLCache
+from utils.metrics import Counter, Histogram
+from utils.routes import match_route
+
+LOOP_MONITOR = os.environ.get("LOOP_MONITOR", "1") == "1"
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("LOOP_BLOCK_THRESHOLD", "0.1"))
+LOOP_BLOCK_LOG_INTERVAL = float(os.environ.get("LOOP_BLOCK_LOG_INTERVAL", "60"))
+
+logger = logging.getLogger("schooldb.blocking")
+
+loop_lag = Histogram(
+    "schooldb_event_loop_lag_seconds",
+    "How late the loop monitor woke up, sampled every LOOP_LAG_INTERVAL seconds",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+loop_blocked = Counter(
+    "schooldb_event_loop_blocked_total",
+    "Times the event loop was blocked for longer than LOOP_BLOCK_THRESHOLD, by route",
+    ("route",),
+)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float, log_interval: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.logged = TTLCache(log_interval, max_entries=256)
+        # Request task -> "METHOD /route", maintained by LoopMonitorMiddleware
+        self.routes: Dict[asyncio.Task, str] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.expected = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+
+    def start(self):
+        """ Start on the running loop (in the app lifespan) """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.expected = time.monotonic() + self.interval
+        self.running = True
+        self.task = self.loop.create_task(self.measure_lag())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def measure_lag(self):
+        while True:
+            self.expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            loop_lag.observe(max(time.monotonic() - self.expected, 0.0))
+
+    def watch(self):
+        stall = None
+        while self.running:
+            time.sleep(self.threshold / 2)
+            expected = self.expected
+            overdue = time.monotonic() - expected
+            if stall is not None and (stall["expected"] != expected or overdue <= self.threshold):
+                # The loop moved on: the stall is over
+                self.report(stall)
+                stall = None
+            if overdue > self.threshold:
+                if stall is None:
+                    stall = self.capture(expected)
+                stall["duration"] = overdue
+
+    def capture(self, expected: float) -> dict:
+        frame = sys._current_frames().get(self.loop_thread_id)
+        task = asyncio.current_task(self.loop)
+        return {
+            "expected": expected,
+            "route": self.routes.get(task, "none") if task is not None else "none",
+            "stack": "".join(traceback.format_stack(frame)) if frame is not None else "",
+        }
+
+    def report(self, stall: dict):
+        loop_blocked.inc(stall["route"])
+        key = (stall["route"], stall["stack"])
+        if self.logged.get(key):
+            return
+        self.logged.set(key, True)
+        logger.warning("Event loop blocked for about %.0f ms in %s:\n%s",
+                       stall["duration"] * 1000, stall["route"], stall["stack"])
+
+
+monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_BLOCK_LOG_INTERVAL)
+
+
+class LoopMonitorMiddleware:
+    """ Lets the watchdog tell which route a blocked request task belongs to """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        task = asyncio.current_task()
+        monitor.routes[task] = f"{scope['method']} {match_route(scope)[0] or 'unmatched'}"
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            monitor.routes.pop(task, None)
@@ -0,0 +1,288 @@
+""" Opt-in sampling profiler for individual requests.
+
+A request is profiled when it carries the PROFILE_TOKEN in the X-Profile header
+or the `profile` query parameter, or when it is picked by PROFILE_SAMPLE_RATE
+(optionally only for the schools in PROFILE_SCHOOLS). While it runs, a
+background thread samples the event loop thread every PROFILE_INTERVAL_MS
+whenever the request's task is the one running, and the threadpool threads
+running the request's sync (`def`) handler or response validation (see
+profile_threadpool). Each sample is attributed to
+Mongo, Pydantic, serialization or application code by the innermost frame
+that belongs to one of them, and command monitoring adds the time Mongo spent
+on each command. The result is written to PROFILE_DIR as a speedscope file
+(https://www.speedscope.app) named after the route and school; the response
+carries its name in X-Profile-Id.
+
+Other requests pay one header lookup, plus a random() call when sampling is on.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import fastapi.routing
+from pymongo import monitoring
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.routes import match_route, school_of
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SCHOOLS = frozenset(filter(None, os.environ.get("PROFILE_SCHOOLS", "").split(",")))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Below the interpreter switch interval (5 ms) the sampler rarely gets the GIL while handlers run
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY = "profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+# Innermost frame from one of these modules decides where a sample's time goes
+CATEGORIES = (
+    ("mongo", ("pymongo", "bson")),
+    ("pydantic", ("pydantic", "fastapi._compat")),
+    ("serialization", ("fastapi.encoders", "json", "starlette.responses")),
+)
+
+current_profile: ContextVar[Optional["Profile"]] = ContextVar("current_profile", default=None)
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def category_of(module: str) -> Optional[str]:
+    for category, prefixes in CATEGORIES:
+        for prefix in prefixes:
+            if module == prefix or module.startswith(prefix + "."):
+                return category
+    return None
+
+
+class Profile:
+    """ Samples of one request in speedscope's "sampled" layout """
+
+    def __init__(self, method: str, route: Optional[str], path: str, school: Optional[str]):
+        self.method = method
+        self.route = route or path
+        self.school = school
+        self.id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.thread_id = threading.get_ident()
+        # Threadpool threads currently running code of this request
+        self.worker_threads = set()
+        self.frames: Dict[tuple, int] = {}
+        self.frame_list: List[dict] = []
+        self.samples: List[List[int]] = []
+        self.weights: List[float] = []
+        self.sampled = dict.fromkeys(("mongo", "pydantic", "serialization", "app"), 0.0)
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.started = time.perf_counter()
+        self.wall_seconds = 0.0
+
+    @property
+    def filename(self) -> str:
+        route = re.sub(r"[^A-Za-z0-9]+", "_", self.route).strip("_")
+        return f"{self.id}-{self.method}-{route}-{self.school or 'none'}.speedscope.json"
+
+    def add_sample(self, frame, weight: float):
+        stack, category = [], None
+        while frame is not None:
+            code = frame.f_code
+            if category is None:
+                category = category_of(frame.f_globals.get("__name__", ""))
+            key = (code.co_name, code.co_filename, code.co_firstlineno)
+            index = self.frames.get(key)
+            if index is None:
+                index = self.frames[key] = len(self.frame_list)
+                self.frame_list.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+            stack.append(index)
+            frame = frame.f_back
+        stack.reverse()
+        self.samples.append(stack)
+        self.weights.append(weight)
+        self.sampled[category or "app"] += weight
+
+    def run_in_worker(self, function, *args, **kwargs):
+        """ Called in a threadpool thread: sample it while it runs `function` for this request """
+        thread_id = threading.get_ident()
+        self.worker_threads.add(thread_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.worker_threads.discard(thread_id)
+
+    def add_command(self, duration_micros: int):
+        self.mongo_commands += 1
+        self.mongo_seconds += duration_micros / 1e6
+
+    def summary(self) -> dict:
+        ms = lambda seconds: round(seconds * 1000, 2)
+        return {
+            "method": self.method,
+            "route": self.route,
+            "school": self.school,
+            "wallMs": ms(self.wall_seconds),
+            "sampledMs": {category: ms(seconds) for category, seconds in self.sampled.items()},
+            # Time the request was not running on the loop or in a worker thread: awaiting, or queued
+            # behind other requests
+            "notRunningMs": ms(max(self.wall_seconds - sum(self.sampled.values()), 0)),
+            "mongoCommands": self.mongo_commands,
+            "mongoCommandMs": ms(self.mongo_seconds),
+        }
+
+    def speedscope(self) -> dict:
+        summary = self.summary()
+        name = f"{self.method} {self.route} school={self.school} {summary['wallMs']} ms"
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "schooldb-profiler",
+            "name": name,
+            "activeProfileIndex": 0,
+            "shared": {"frames": self.frame_list},
+            "profiles": [{"type": "sampled", "name": name, "unit": "seconds", "startValue": 0,
+                          "endValue": self.wall_seconds, "samples": self.samples, "weights": self.weights}],
+            "metadata": summary,
+        }
+
+    def save(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.filename)
+        with open(path, "w") as f:
+            json.dump(self.speedscope(), f)
+        return path
+
+
+class Sampler:
+    """ One thread sampling every active profile; it exits when there is none left """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.profiles = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile):
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+                self.thread.start()
+
+    def remove(self, profile: Profile):
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def run(self):
+        last = time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            # Held for the whole pass, so a profile is never written to after remove()
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                now = time.perf_counter()
+                weight, last = now - last, now
+                frames = sys._current_frames()
+                for profile in self.profiles:
+                    for thread_id in tuple(profile.worker_threads):
+                        frame = frames.get(thread_id)
+                        if frame is not None:
+                            profile.add_sample(frame, weight)
+                    # The loop thread runs other requests too: only count samples taken while ours runs
+                    if asyncio.current_task(profile.loop) is not profile.task:
+                        continue
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        profile.add_sample(frame, weight)
+
+
+sampler = Sampler(PROFILE_INTERVAL)
+
+
+async def profiled_run_in_threadpool(function, *args, **kwargs):
+    profile = current_profile.get()
+    if profile is None:
+        return await run_in_threadpool(function, *args, **kwargs)
+    return await run_in_threadpool(profile.run_in_worker, function, *args, **kwargs)
+
+
+def profile_threadpool():
+    """ Route FastAPI's threadpool calls (sync endpoints and dependencies, response validation)
+    through profiled_run_in_threadpool, so the worker thread is sampled for profiled requests """
+    fastapi.routing.run_in_threadpool = profiled_run_in_threadpool
+
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    """ Adds the server-side duration of every command to the profile of the request issuing it """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add_command(event.duration_micros)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.token = PROFILE_TOKEN.encode("latin-1") if PROFILE_TOKEN else None
+
+    def wanted(self, scope: Scope) -> bool:
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.token)
+            query = scope.get("query_string", b"")
+            if PROFILE_QUERY.encode() in query:
+                for name, value in parse_qsl(query.decode("latin-1")):
+                    if name == PROFILE_QUERY:
+                        return hmac.compare_digest(value.encode("latin-1"), self.token)
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return not PROFILE_SCHOOLS or school_of(scope) in PROFILE_SCHOOLS
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = Profile(scope["method"], match_route(scope)[0], scope["path"], school_of(scope))
+
+        async def send_with_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(PROFILE_ID_HEADER, profile.filename)
+            await send(message)
+
+        token = current_profile.set(profile)
+        sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.remove(profile)
+            current_profile.reset(token)
+            profile.wall_seconds = time.perf_counter() - profile.started
+            path = await asyncio.to_thread(profile.save, PROFILE_DIR)
+            logger.info("Profiled %s %s: %s", profile.method, profile.route, path)
@@ -0,0 +1,156 @@
+import asyncio
+import itertools
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Set
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Put in a subscriber's queue when it fell too far behind and was dropped
+CLOSED = object()
+
+
+class Subscription:
+    def __init__(self, broker: "Broker", topic: str, max_queue: int):
+        self.broker = broker
+        self.topic = topic
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+
+    async def get(self, timeout: float):
+        """ Next (event_id, event), None after `timeout` seconds of silence, CLOSED when dropped """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """ In-process pub/sub keyed by topic (the school id for notices).
+
+    Subscribers live on the event loop; publish() may be called from the loop
+    or from any thread (change stream watchers). An idle subscriber is just a
+    queue waiting on the loop. A subscriber whose queue fills up is dropped
+    and receives CLOSED, so a stalled client cannot grow memory without bound.
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._topics: Dict[str, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ids = itertools.count(1)
+
+    def subscribe(self, topic: str) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(self, topic, self.max_queue)
+        self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._topics.get(subscription.topic)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._topics[subscription.topic]
+
+    def publish(self, topic: str, event: Any):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._deliver(topic, event)
+        else:
+            loop.call_soon_threadsafe(self._deliver, topic, event)
+
+    def _deliver(self, topic: str, event: Any):
+        subscriptions = self._topics.get(topic)
+        if not subscriptions:
+            return
+        item = (next(self._ids), event)
+        for subscription in list(subscriptions):
+            try:
+                subscription.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.unsubscribe(subscription)
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(CLOSED)
+
+    def subscriber_count(self, topic: Optional[str] = None) -> int:
+        if topic is not None:
+            return len(self._topics.get(topic, ()))
+        return sum(len(subscriptions) for subscriptions in self._topics.values())
+
+
+def change_streams_supported(database) -> bool:
+    """ Change streams need a replica set or a sharded cluster; checked once at startup, so a
+    standalone server is reported instead of failing in the feed thread every second """
+    try:
+        hello = database.client.admin.command("hello")
+    except PyMongoError:
+        logger.exception("Could not check whether %s supports change streams", database.name)
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+def enable_pre_images(collection) -> bool:
+    """ Record pre-images (MongoDB 6.0+), so delete events carry the deleted document """
+    try:
+        collection.database.command("collMod", collection.name, changeStreamPreAndPostImages={"enabled": True})
+    except OperationFailure as e:
+        logger.warning("Could not enable change stream pre-images on %s.%s: %s",
+                       collection.database.name, collection.name, e)
+        return False
+    return True
+
+
+class ChangeStreamFeed:
+    """ Background thread that passes every change on a collection (or database) to `handler`.
+
+    Used when several workers (or other services) write to the collection:
+    each worker watches the change stream and publishes to its own Broker.
+    The resume token survives transient errors, so no change is skipped.
+    """
+
+    def __init__(self, collection, handler: Callable[[dict], None], max_await_ms: int = 1000, **watch_options):
+        self.collection = collection
+        self.handler = handler
+        self.max_await_ms = max_await_ms
+        self.watch_options = watch_options
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"change-feed-{self.collection.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        resume_token = None
+        while not self._stop.is_set():
+            try:
+                with self.collection.watch(resume_after=resume_token, max_await_time_ms=self.max_await_ms,
+                                           **self.watch_options) as stream:
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        resume_token = stream.resume_token
+                        if change is not None:
+                            try:
+                                self.handler(change)
+                            except Exception:
+                                logger.exception("Change stream handler failed")
+            except PyMongoError:
+                logger.exception("Change stream on %s failed, reconnecting", self.collection.name)
+                self._stop.wait(1.0)
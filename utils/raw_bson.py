@@ -0,0 +1,52 @@
+""" Lean read path for list routes that forward documents almost unchanged.
+
+The handler fetches only the response fields (projection), converts the
+ObjectIds it returns and builds the JSON body itself, instead of decoding full
+documents, converting every ObjectId and validating the result with the
+response model.
+
+The documents may be dicts or RawBSONDocuments: get_collection(..., raw=True)
+returns the latter when RAW_BSON_READS=1. A RawBSONDocument keeps the bytes
+the driver received and decodes its top level on the first field lookup,
+leaving nested documents and arrays undecoded. That pays off for large
+documents read whole; on projected ones the C decoder into dicts is faster,
+hence the default. benchmarks/bench_raw_bson compares both.
+"""
+import json
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Iterable, List, Sequence
+
+from bson import ObjectId
+from fastapi.responses import Response
+
+
+def default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Mapping):
+        return dict(value)  # nested RawBSONDocument
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def projection(fields: Iterable[str]) -> dict:
+    """ Mongo projection of the response fields; _id is returned anyway """
+    return {field: 1 for field in fields if field != "_id"}
+
+
+def pick(document: Mapping, fields: Sequence[str], id_fields: Iterable[str] = ()) -> dict:
+    """ `fields` of `document` in that order, missing ones as None; ObjectIds in `id_fields` become strings """
+    item = {field: document.get(field) for field in fields}
+    for field in id_fields:
+        if item.get(field) is not None:
+            item[field] = str(item[field])
+    return item
+
+
+def json_list_response(documents: Iterable[Mapping], fields: Sequence[str], id_fields: Iterable[str] = ()) -> Response:
+    """ JSON array of `fields` of each document, encoded like FastAPI's JSONResponse """
+    items: List[dict] = [pick(document, fields, id_fields) for document in documents]
+    body = json.dumps(items, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=default)
+    return Response(body.encode("utf-8"), media_type="application/json")
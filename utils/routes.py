@@ -0,0 +1,40 @@
+from typing import Dict, Optional, Tuple
+
+from starlette.routing import Match
+from starlette.types import Scope
+
+from utils.tenancy import SCHOOL_HEADER, SCHOOL_PATH_PARAMS
+
+ROUTE_SCOPE_KEY = "schooldb.route"
+
+
+def match_route(scope: Scope) -> Tuple[Optional[str], Dict[str, str]]:
+    """ Route template and path params of a request, matched once and cached in the scope
+
+    Middleware runs before the router, so this is how it learns which endpoint
+    (e.g. "/Students/{school_id}") a request is heading for.
+    """
+    info = scope.get(ROUTE_SCOPE_KEY)
+    if info is None:
+        info = (None, {})
+        app = scope.get("app")
+        if app is not None:
+            for route in app.router.routes:
+                match, child_scope = route.matches(scope)
+                if match == Match.FULL:
+                    info = (route.path, child_scope.get("path_params", {}))
+                    break
+        scope[ROUTE_SCOPE_KEY] = info
+    return info
+
+
+def school_of(scope: Scope) -> Optional[str]:
+    """ School id of a request from the path, else the X-School-ID header, without reading the body """
+    path_params = match_route(scope)[1]
+    for name in SCHOOL_PATH_PARAMS:
+        if name in path_params:
+            return path_params[name]
+    for name, value in scope.get("headers", []):
+        if name == SCHOOL_HEADER.encode():
+            return value.decode("latin-1")
+    return None
@@ -0,0 +1,155 @@
+import bisect
+import heapq
+import re
+import unicodedata
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set
+
+# Letters NFKD does not decompose into base letter + accent
+FOLD = str.maketrans({"ł": "l", "Ł": "l", "ø": "o", "Ø": "o", "đ": "d", "Đ": "d", "ß": "ss"})
+WORD = re.compile(r"\w+")
+
+EXACT, PREFIX, FUZZY = 0, 1, 2
+FUZZY_MIN_LENGTH = 3
+
+
+def normalize(text) -> str:
+    """ Case- and accent-insensitive form ("Łukasz" -> "lukasz"), like a strength 1 collation """
+    text = unicodedata.normalize("NFKD", str(text).translate(FOLD)).casefold()
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def words(text) -> List[str]:
+    return WORD.findall(normalize(text))
+
+
+def deletions(token: str) -> Set[str]:
+    return {token[:index] + token[index + 1:] for index in range(len(token))}
+
+
+class SearchIndex:
+    """ In-memory token index: exact, prefix and one-typo matches over a set of documents
+
+    Every document is indexed under the words of its searchable values (and the
+    whole value for fields such as emails). Prefix lookups use a sorted token list
+    and bisect; typos use the one-deletion neighbourhood of each token, so a fuzzy
+    lookup costs len(word) dictionary probes instead of a scan.
+    """
+
+    def __init__(self):
+        self.documents: Dict[str, dict] = {}
+        self.sort_keys: Dict[str, str] = {}
+        self.tokens: Dict[str, Set[str]] = {}
+        self.postings: Dict[str, Set[str]] = {}
+        self.sorted_tokens: List[str] = []
+        self.variants: Dict[str, Set[str]] = {}
+        self._lock = Lock()
+
+    @classmethod
+    def build(cls, entries: Iterable[tuple]) -> "SearchIndex":
+        """ entries: (key, document, values, whole_values) """
+        index = cls()
+        with index._lock:
+            for key, document, values, whole_values in entries:
+                index._add(key, document, values, whole_values, sort=False)
+            index.sorted_tokens.sort()
+        return index
+
+    def add(self, key: str, document: dict, values: Iterable, whole_values: Iterable = ()):
+        """ Insert or replace a document """
+        with self._lock:
+            self._remove(key)
+            self._add(key, document, values, whole_values, sort=True)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def remove_where(self, predicate):
+        with self._lock:
+            for key in [key for key, document in self.documents.items() if predicate(document)]:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _add(self, key, document, values, whole_values, sort):
+        values = [value for value in values if value is not None]
+        tokens = {token for value in values for token in words(value)}
+        tokens.update(normalize(value) for value in whole_values if value)
+        self.documents[key] = document
+        self.sort_keys[key] = normalize(" ".join(str(value) for value in values))
+        self.tokens[key] = tokens
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = set()
+                if sort:
+                    bisect.insort(self.sorted_tokens, token)
+                else:
+                    self.sorted_tokens.append(token)
+                if len(token) >= FUZZY_MIN_LENGTH and not token.isdigit():
+                    for variant in deletions(token):
+                        self.variants.setdefault(variant, set()).add(token)
+            posting.add(key)
+
+    def _remove(self, key):
+        tokens = self.tokens.pop(key, None)
+        if tokens is None:
+            return
+        del self.documents[key], self.sort_keys[key]
+        for token in tokens:
+            posting = self.postings[token]
+            posting.discard(key)
+            if posting:
+                continue
+            del self.postings[token]
+            del self.sorted_tokens[bisect.bisect_left(self.sorted_tokens, token)]
+            if len(token) >= FUZZY_MIN_LENGTH and not token.isdigit():
+                for variant in deletions(token):
+                    similar = self.variants[variant]
+                    similar.discard(token)
+                    if not similar:
+                        del self.variants[variant]
+
+    def _similar_tokens(self, word: str) -> Set[str]:
+        # word + one insertion: indexed tokens whose deletions contain the word
+        similar = set(self.variants.get(word, ()))
+        for variant in deletions(word):
+            if variant in self.postings:  # one deletion
+                similar.add(variant)
+            similar.update(self.variants.get(variant, ()))  # substitution / transposition
+        similar.discard(word)
+        return similar
+
+    def _match(self, word: str) -> Dict[str, int]:
+        found = dict.fromkeys(self.postings.get(word, ()), EXACT)
+        position = bisect.bisect_right(self.sorted_tokens, word)
+        while position < len(self.sorted_tokens) and self.sorted_tokens[position].startswith(word):
+            for key in self.postings[self.sorted_tokens[position]]:
+                found.setdefault(key, PREFIX)
+            position += 1
+        if len(word) >= FUZZY_MIN_LENGTH and not word.isdigit():
+            for token in self._similar_tokens(word):
+                for key in self.postings[token]:
+                    found.setdefault(key, FUZZY)
+        return found
+
+    def search(self, query: str, limit: int, predicate=None) -> List[dict]:
+        """ Best `limit` documents matching every word of the query, exact before prefix before typo """
+        query_words = words(query)
+        if not query_words or limit <= 0:
+            return []
+        with self._lock:
+            scores: Optional[Dict[str, int]] = None
+            # Longest word first: usually the smallest candidate set
+            for word in sorted(query_words, key=len, reverse=True):
+                matches = self._match(word)
+                scores = matches if scores is None else \
+                    {key: score + matches[key] for key, score in scores.items() if key in matches}
+                if not scores:
+                    return []
+            if predicate is not None:
+                scores = {key: score for key, score in scores.items() if predicate(self.documents[key])}
+            best = heapq.nsmallest(limit, scores.items(), key=lambda item: (item[1], self.sort_keys[item[0]], item[0]))
+            return [self.documents[key] for key, _ in best]
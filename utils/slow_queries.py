@@ -0,0 +1,285 @@
+""" Slow query log built on pymongo command monitoring.
+
+With SLOW_QUERY_MS set, every command that takes at least that long is
+written to SLOW_QUERY_LOG (one JSON object per line, rotated at
+SLOW_QUERY_LOG_BYTES with SLOW_QUERY_LOG_BACKUPS old files) together with the
+route and school of the request that issued it, the collection, the shape of
+its filter (every value replaced by "?"), its duration and the number of
+documents it returned or changed.
+
+The first time a shape is seen (and again after SLOW_QUERY_EXPLAIN_TTL
+seconds, since plans change as a school grows) the command is re-run as
+`explain` with "executionStats" verbosity and the plan is logged under the
+same shape id. Literal values are kept out of the file: plan filters, index
+bounds and parsed queries are reduced to their shape as well, and failed
+commands are logged with their error code only (an errmsg can quote a
+duplicate key). Explains and file writes happen on a background thread; the
+request only pays for computing the shape of commands that were slow.
+
+RotatingFileHandler is not safe with several processes writing one file (each
+worker would rotate it under the others), so every process writes its own
+file: the process id goes before the extension of SLOW_QUERY_LOG, e.g.
+slow_queries.4711.log.
+"""
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Optional, Tuple
+
+from bson import json_util
+from pymongo import monitoring
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import utils.db
+from utils.cache import TTLCache
+from utils.routes import match_route
+from utils.tenancy import current_school
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_BYTES = int(os.environ.get("SLOW_QUERY_LOG_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.environ.get("SLOW_QUERY_LOG_BACKUPS", "5"))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "1") == "1"
+SLOW_QUERY_EXPLAIN_TTL = float(os.environ.get("SLOW_QUERY_EXPLAIN_TTL", "86400"))
+
+# Where the filter of each monitored command lives; getMore, insert etc. are logged without a shape
+FILTER_FIELDS = {
+    "find": ("filter", "sort", "projection"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "update", "sort"),
+}
+# Write commands carry a list of statements; the first one gives the shape
+STATEMENT_FIELDS = {"update": ("updates", ("q", "u")), "delete": ("deletes", ("q",))}
+# Fields of the original command that `explain` rejects or that belong to the session
+NOT_EXPLAINED = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+# Plan fields that hold the literal values of the query; their contents are logged as a shape
+PLAN_LITERAL_FIELDS = {"filter", "indexBounds", "parsedQuery", "postFilter"}
+# Plan fields dropped altogether: the SBE plan is a string with the values inlined
+PLAN_DROPPED_FIELDS = {"slotBasedPlan", "command"}
+
+# Route of the request being served, set by SlowQueryMiddleware
+current_route: ContextVar[Optional[str]] = ContextVar("current_route", default=None)
+
+
+def slow_query_log_enabled() -> bool:
+    return SLOW_QUERY_MS > 0
+
+
+def shape_of(value: Any) -> Any:
+    """ `value` with every literal replaced by "?"; operators, field names and nesting stay """
+    if isinstance(value, dict):
+        return {key: shape_of(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # $and/$or/pipelines keep one shape per distinct element; $in lists of values become "?"
+        shapes = []
+        for item in value:
+            item_shape = shape_of(item)
+            if item_shape not in shapes:
+                shapes.append(item_shape)
+        return shapes if any(isinstance(item, dict) for item in shapes) else "?"
+    return "?"
+
+
+def plan_shape(plan: Any) -> Any:
+    """ An explain output with the literal values of the query replaced by "?"
+
+    Aggregation stages other than $cursor are reduced to their shape entirely.
+    """
+    if isinstance(plan, dict):
+        shaped = {}
+        for key, value in plan.items():
+            if key in PLAN_DROPPED_FIELDS:
+                continue
+            if key in PLAN_LITERAL_FIELDS or (key.startswith("$") and key != "$cursor"):
+                shaped[key] = shape_of(value)
+            else:
+                shaped[key] = plan_shape(value)
+        return shaped
+    if isinstance(plan, list):
+        return [plan_shape(item) for item in plan]
+    return plan
+
+
+def failure_of(failure: dict) -> dict:
+    """ Error code of a failed command, without the errmsg that may quote the values involved """
+    return {"code": failure.get("code"), "codeName": failure.get("codeName")}
+
+
+def per_process(path: str) -> str:
+    """ `path` with the process id before its extension, one file per worker """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{extension}"
+
+
+def command_shape(name: str, command: dict) -> Optional[dict]:
+    if name in FILTER_FIELDS:
+        return {field: shape_of(command[field]) for field in FILTER_FIELDS[name] if field in command}
+    if name in STATEMENT_FIELDS:
+        statements_field, fields = STATEMENT_FIELDS[name]
+        statements = command.get(statements_field) or [{}]
+        return {field: shape_of(statements[0][field]) for field in fields if field in statements[0]}
+    return None
+
+
+def documents_of(name: str, reply: dict) -> Optional[int]:
+    """ Documents a command returned (reads) or matched (writes) """
+    try:
+        cursor = reply.get("cursor")
+        if cursor is not None:
+            return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        if name == "findAndModify":
+            return int(reply.get("value") is not None)
+        if name == "distinct":
+            return len(reply.get("values", []))
+        return reply.get("n")
+    except (TypeError, AttributeError):
+        return None  # raw batches (find_raw_batches) are not decoded here
+
+
+def client_for(address: Tuple[str, int]):
+    """ The client (routing target) that owns the connection a command ran on """
+    pool = utils.db.client_pool
+    for mongo_client in pool.clients() if pool is not None else []:
+        if address in mongo_client.nodes:
+            return mongo_client
+    return None
+
+
+class SlowQueryLog:
+    """ Writes slow commands and explains to a rotating file from one background thread """
+
+    def __init__(self, path: str, max_bytes: int, backups: int, explain: bool, explain_ttl: float):
+        self.explain = explain
+        self.explained = TTLCache(explain_ttl, max_entries=4096)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-log")
+        self.file_logger = logging.getLogger("schooldb.slow_queries")
+        self.file_logger.propagate = False
+        self.file_logger.setLevel(logging.INFO)
+        if not self.file_logger.handlers:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file_logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups))
+
+    def write(self, record: dict):
+        self.file_logger.info(json_util.dumps(record))
+
+    def record(self, record: dict, command: Optional[dict], address: Tuple[str, int], database_name: str):
+        self.write(record)
+        shape_id = record.get("shapeId")
+        if not self.explain or command is None or shape_id is None or self.explained.get(shape_id):
+            return
+        self.explained.set(shape_id, True)
+        mongo_client = client_for(address)
+        if mongo_client is None:
+            return
+        explained = {key: value for key, value in command.items()
+                     if key not in NOT_EXPLAINED and not key.startswith("$")}
+        for statements_field, _ in STATEMENT_FIELDS.values():
+            if statements_field in explained:
+                # explain takes a single statement; the first one is the one the shape describes
+                explained[statements_field] = explained[statements_field][:1]
+        try:
+            # Plans writes too, without applying them
+            plan = mongo_client[database_name].command({"explain": explained, "verbosity": "executionStats"})
+        except Exception as e:
+            self.write({"type": "explain", "shapeId": shape_id,
+                        "error": {"type": type(e).__name__, "code": getattr(e, "code", None)}})
+            return
+        entry = {"type": "explain", "shapeId": shape_id, "collection": record["collection"]}
+        if "stages" in plan:
+            entry["stages"] = plan_shape(plan["stages"])  # aggregations with more than a $cursor stage
+        else:
+            entry["winningPlan"] = plan_shape(plan.get("queryPlanner", {}).get("winningPlan"))
+            entry["executionStats"] = plan_shape(plan.get("executionStats"))
+        self.write(entry)
+
+    def submit(self, record: dict, command: Optional[dict], address: Tuple[str, int], database_name: str):
+        self.executor.submit(self.record_safely, record, command, address, database_name)
+
+    def record_safely(self, *args):
+        try:
+            self.record(*args)
+        except Exception:
+            logger.exception("Could not write the slow query log")
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """ Keeps each command until it finishes and hands the slow ones to SlowQueryLog """
+
+    def __init__(self, log: SlowQueryLog, threshold_ms: float):
+        self.log = log
+        self.threshold_micros = threshold_ms * 1000
+        self.pending: Dict[tuple, dict] = {}
+
+    def started(self, event):
+        self.pending[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event):
+        self.finished(event, event.reply, None)
+
+    def failed(self, event):
+        # Timeouts and other errors are usually the slowest commands of all
+        self.finished(event, None, event.failure)
+
+    def finished(self, event, reply: Optional[dict], failure: Optional[dict]):
+        command = self.pending.pop((event.connection_id, event.request_id), None)
+        if command is None or event.duration_micros < self.threshold_micros:
+            return
+        name = event.command_name
+        collection = command.get(name)
+        # Runs on the thread that issued the command, so the request's context variables are visible
+        record = {
+            "type": "slow",
+            "at": datetime.now().isoformat(timespec="milliseconds"),
+            "route": current_route.get(),
+            "school": current_school.get(),
+            "database": event.database_name,
+            "collection": collection if isinstance(collection, str) else command.get("collection"),
+            "command": name,
+            "durationMs": round(event.duration_micros / 1000, 2),
+            "documents": documents_of(name, reply) if reply is not None else None,
+        }
+        if name in STATEMENT_FIELDS:
+            record["statements"] = len(command.get(STATEMENT_FIELDS[name][0]) or [])
+        if failure is not None:
+            record["error"] = failure_of(failure)
+        shape = command_shape(name, command)
+        if shape is not None:
+            record["shape"] = shape
+            key = json.dumps([event.database_name, record["collection"], name, shape], sort_keys=True)
+            record["shapeId"] = hashlib.sha1(key.encode()).hexdigest()[:12]
+        self.log.submit(record, command if shape is not None else None, event.connection_id, event.database_name)
+
+
+def slow_query_listener() -> SlowQueryListener:
+    log = SlowQueryLog(per_process(SLOW_QUERY_LOG), SLOW_QUERY_LOG_BYTES, SLOW_QUERY_LOG_BACKUPS,
+                       SLOW_QUERY_EXPLAIN, SLOW_QUERY_EXPLAIN_TTL)
+    return SlowQueryListener(log, SLOW_QUERY_MS)
+
+
+class SlowQueryMiddleware:
+    """ Makes the route template of each request visible to SlowQueryListener """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_route.set(f"{scope['method']} {match_route(scope)[0] or scope['path']}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
@@ -0,0 +1,198 @@
+import json
+import os
+import time
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi import HTTPException, Request
+from pymongo import MongoClient
+from pymongo.database import Database
+
+# Collections that hold school data and the field pointing at the school (admin) id
+SCHOOL_SCOPED_COLLECTIONS = {
+    "admins": "_id",
+    "sclasses": "school",
+    "subjects": "school",
+    "students": "school",
+    "teachers": "school",
+    "notices": "school",
+    "complains": "school",
+    "studentArchive": "school",
+}
+
+DEFAULT_TARGET = "default"
+SCHOOL_HEADER = "x-school-id"
+SCHOOL_PATH_PARAMS = ("school_id", "admin_id")
+SCHOOL_BODY_FIELDS = ("adminID", "school")
+
+# School the current request belongs to, set by bind_school
+current_school: ContextVar[Optional[str]] = ContextVar("current_school", default=None)
+
+
+class ClientPool:
+    """ One MongoClient per connection string, shared by every school routed to it """
+
+    def __init__(self, **client_options):
+        self._clients: Dict[str, MongoClient] = {}
+        self._lock = Lock()
+        self.client_options = client_options
+
+    def add(self, url: str, client: MongoClient):
+        with self._lock:
+            self._clients.setdefault(url, client)
+
+    def get(self, url: str) -> MongoClient:
+        client = self._clients.get(url)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(url)
+                if client is None:
+                    client = MongoClient(url, **self.client_options)
+                    self._clients[url] = client
+        return client
+
+    def clients(self):
+        with self._lock:
+            return list(self._clients.values())
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+class RoutingTable:
+    """ Maps school ids to targets (connection string + database name).
+
+    The table is a JSON file:
+
+        {
+            "targets": {"big": {"url": "mongodb://shard-b:27017", "database": "school_big"}},
+            "schools": {"<school_id>": "big"},
+            "frozen": ["<school_id>"]
+        }
+
+    Schools that are not listed use the "default" target, which falls back to
+    MONGO_URL / test. Writes of frozen schools are refused while they are being
+    moved. The file is re-read when it changes, so a school can be moved by
+    editing the table (see scripts/migrate_school.py).
+    """
+
+    def __init__(self, path: str, default_url: str, default_database: str = "test",
+                 pool: Optional[ClientPool] = None, reload_interval: float = 5.0):
+        self.path = path
+        self.pool = pool or ClientPool()
+        self.reload_interval = reload_interval
+        self._default = (default_url, default_database)
+        self._targets: Dict[str, Tuple[str, str]] = {}
+        self._schools: Dict[str, str] = {}
+        self._frozen: Set[str] = set()
+        self._databases: Dict[Tuple[str, str], Database] = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime == self._mtime:
+            return
+        config = {}
+        if mtime is not None:
+            with open(self.path) as f:
+                config = json.load(f)
+        targets = {DEFAULT_TARGET: self._default}
+        for name, target in config.get("targets", {}).items():
+            targets[name] = (target.get("url") or self._default[0], target.get("database") or self._default[1])
+        self._targets = targets
+        self._schools = dict(config.get("schools", {}))
+        self._frozen = set(config.get("frozen", []))
+        self._mtime = mtime
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self.reload()
+
+    def target_name_for(self, school_id: Optional[str]) -> str:
+        self._maybe_reload()
+        name = self._schools.get(school_id, DEFAULT_TARGET) if school_id else DEFAULT_TARGET
+        return name if name in self._targets else DEFAULT_TARGET
+
+    def is_frozen(self, school_id: Optional[str]) -> bool:
+        self._maybe_reload()
+        return bool(school_id) and school_id in self._frozen
+
+    def has_frozen(self) -> bool:
+        self._maybe_reload()
+        return bool(self._frozen)
+
+    def database_for_target(self, name: str) -> Database:
+        if name not in self._targets:
+            raise KeyError(f"Unknown routing target {name}")
+        key = self._targets[name]
+        database = self._databases.get(key)
+        if database is None:
+            url, database_name = key
+            database = self.pool.get(url)[database_name]
+            self._databases[key] = database
+        return database
+
+    def database_for(self, school_id: Optional[str]) -> Database:
+        return self.database_for_target(self.target_name_for(school_id))
+
+    def targets(self):
+        self._maybe_reload()
+        return dict(self._targets)
+
+
+async def bind_school(request: Request):
+    """ Router dependency: remember which school the request belongs to.
+
+    Looked up in the school_id/admin_id path parameters, then adminID/school
+    in a JSON body, then as the owner of the class/subject/student/teacher/
+    notice named in the path (utils.admission.owner_of), and only then in the
+    X-School-ID header, so the header cannot move a request to another
+    school's target or past its freeze. The logins need the header for
+    schools that live outside the default target. Writes of a school frozen in
+    the routing table are answered with 503, and so are writes to a document
+    whose school cannot be resolved while any school is frozen.
+    """
+    from utils import db  # imported here: utils.db imports this module
+    from utils.admission import owner_of, owner_param
+
+    school_id = None
+    for name in SCHOOL_PATH_PARAMS:
+        if name in request.path_params:
+            school_id = request.path_params[name]
+            break
+    if not school_id and request.method in ("POST", "PUT") \
+            and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            for field in SCHOOL_BODY_FIELDS:
+                if isinstance(body.get(field), str):
+                    school_id = body[field]
+                    break
+    unresolved = False
+    if not school_id:
+        param = owner_param(request.path_params)
+        if param is not None:
+            school_id = await owner_of(*param)
+            unresolved = school_id is None
+    if not school_id:
+        school_id = request.headers.get(SCHOOL_HEADER)
+    if request.method not in ("GET", "HEAD") and db.routing is not None \
+            and (db.routing.is_frozen(school_id) or unresolved and db.routing.has_frozen()):
+        raise HTTPException(status_code=503, detail="School is being moved, retry shortly",
+                            headers={"Retry-After": str(max(int(db.routing.reload_interval), 1))})
+    if school_id:
+        current_school.set(school_id)